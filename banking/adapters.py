@@ -1,31 +1,134 @@
+import asyncio
+import contextvars
+import copy
+import functools
+import itertools
 import logging
+import threading
+import time
 from datetime import date, datetime
+from decimal import Decimal
+from typing import List, Optional, Tuple
 
 from mutpy.utils import notmutate
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     Date,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     MetaData,
     Numeric,
     String,
     Table,
     Enum,
+    TypeDecorator,
+    cast,
+    event,
+    literal,
+    text,
+    type_coerce,
 )
-from sqlalchemy.orm import mapper, relationship, sessionmaker
+from sqlalchemy.orm import (
+    attributes,
+    class_mapper,
+    column_property,
+    mapper,
+    relationship,
+    sessionmaker,
+)
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import QueuePool
 
-from banking import domain, interfaces, repositories
+from banking import domain, exceptions, interfaces, repositories
 from banking.domain import TransactionTypeEnum
+from banking.metrics import current_request_timing, record_request_phase
 
 LOGGER = logging.getLogger(__name__)
 metadata = MetaData()
 
 
+class MoneyNumeric(TypeDecorator):
+    """Stores a `domain.Money` in a NUMERIC(10, 2) column"""
+
+    impl = Numeric(10, 2)
+
+    def as_cents(self, expression):
+        """Converts a column of this type to BIGINT cents in SQL"""
+
+        return cast(type_coerce(expression, self.impl) * 100, BigInteger)
+
+    def from_cents(self, expression):
+        """Converts an SQL expression in cents to this type"""
+
+        hundred = literal(Decimal(100), self.impl)
+        return type_coerce(cast(expression, self.impl) / hundred, self)
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            value = domain.Money.parse(value).to_decimal()
+        return value
+
+    def process_result_value(self, value, dialect):
+        # The column has two decimal places, so the value is whole cents
+        if value is not None:
+            value = domain.Money(int(value * 100))
+        return value
+
+
+class MoneyCents(TypeDecorator):
+    """Stores a `domain.Money` as its number of cents in a BIGINT column.
+
+    It has no ceiling of 99,999,999.99 like the NUMERIC(10, 2) column and
+    the database driver exchanges plain integers."""
+
+    impl = BigInteger
+
+    def as_cents(self, expression):
+        """Converts a column of this type to BIGINT cents in SQL"""
+
+        return type_coerce(expression, self.impl)
+
+    def from_cents(self, expression):
+        """Converts an SQL expression in cents to this type"""
+
+        return type_coerce(expression, self)
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            value = domain.Money.parse(value).cents
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = domain.Money(int(value))
+        return value
+
+
+# The column types which can store the amounts of money
+MONEY_TYPES = {"numeric": MoneyNumeric, "cents": MoneyCents}
+
+
 @notmutate
-def sqlalchemy_schema(Numeric=Numeric):
+def sqlalchemy_schema(Money=MoneyNumeric, partitioned=False, event_sourced=False):
+    """Declares the database tables.
+
+    The amounts of money are stored with the `Money` column type, one of
+    the `MONEY_TYPES`.
+
+    When `partitioned` is True the transactions table is declared as
+    partitioned by month of creation on PostgreSQL. Its primary key then
+    includes the creation date, as PostgreSQL requires. Other databases
+    ignore the partitioning and create a regular table.
+
+    When `event_sourced` is True the balance of the accounts is kept as the
+    ledger of their transactions, see `repositories.LedgerAccountRepository`.
+    The transactions are then also indexed by account and id, the index
+    the balances use to sum the transactions after the account snapshot."""
+
     people = Table(
         "people",
         metadata,
@@ -46,7 +149,7 @@ def sqlalchemy_schema(Numeric=Numeric):
         metadata,
         Column("idTransacao", Integer, key="id", primary_key=True, autoincrement=True),
         Column("idConta", ForeignKey("accounts.id"), key="account_id", nullable=False),
-        Column("valor", Numeric(10, 2), key="value", nullable=False),
+        Column("valor", Money, key="value", nullable=False),
         Column(
             "tipo",
             Enum(
@@ -62,23 +165,106 @@ def sqlalchemy_schema(Numeric=Numeric):
             key="created_at",
             nullable=False,
             default=datetime.utcnow,
+            primary_key=partitioned,
         ),
+        postgresql_partition_by='RANGE ("dataCriacao")' if partitioned else None,
+    )
+
+    # The account statements filter by account and creation date
+    Index(
+        "ix_transactions_account_id_created_at",
+        transactions.c.account_id,
+        transactions.c.created_at,
     )
 
+    if event_sourced:
+        Index(
+            "ix_transactions_account_id_id",
+            transactions.c.account_id,
+            transactions.c.id,
+        )
+
     accounts = Table(
         "accounts",
         metadata,
         Column("idConta", Integer, key="id", primary_key=True, autoincrement=True),
         Column("idPessoa", ForeignKey("people.id"), key="person_id", nullable=False),
-        Column("saldo", Numeric(10, 2), key="balance", nullable=False),
+        Column("saldo", Money, key="balance", nullable=False, default=0),
         Column(
             "limiteSaqueDiario",
-            Numeric(10, 2),
+            Money,
             key="daily_withdrawal_limit",
             nullable=False,
         ),
         Column("flagAtivo", Boolean, key="active", nullable=False, default=True),
         Column("tipoConta", Integer, key="type", nullable=False, default=1),
+        Column("versao", Integer, key="version", nullable=False),
+        Column(
+            "valorSacadoDia",
+            Money,
+            key="withdrawn_today",
+            nullable=False,
+            default=0,
+        ),
+        Column("dataSaque", Date, key="withdrawal_day", nullable=True),
+        Column(
+            "dataCriacao",
+            DateTime,
+            key="created_at",
+            nullable=False,
+            default=datetime.utcnow,
+        ),
+        info={"event_sourced": event_sourced},
+    )
+
+    balance_checkpoints = Table(
+        "balance_checkpoints",
+        metadata,
+        Column(
+            "idConta",
+            ForeignKey("accounts.id"),
+            key="account_id",
+            primary_key=True,
+        ),
+        Column("data", Date, key="day", primary_key=True),
+        Column("saldo", Money, key="balance", nullable=False),
+    )
+
+    account_snapshots = Table(
+        "account_snapshots",
+        metadata,
+        Column(
+            "idConta",
+            ForeignKey("accounts.id"),
+            key="account_id",
+            primary_key=True,
+        ),
+        Column("idTransacao", Integer, key="transaction_id", nullable=False),
+        Column("saldo", Money, key="balance", nullable=False),
+        Column(
+            "dataCriacao",
+            DateTime,
+            key="created_at",
+            nullable=False,
+            default=datetime.utcnow,
+        ),
+    )
+
+    outbox = Table(
+        "outbox",
+        metadata,
+        Column("idEvento", Integer, key="id", primary_key=True, autoincrement=True),
+        Column(
+            "tipo",
+            Enum(
+                domain.AccountEventTypeEnum,
+                values_callable=lambda enum: [e.value for e in enum],
+            ),
+            key="type",
+            nullable=False,
+        ),
+        Column("idConta", Integer, key="account_id", nullable=False),
+        Column("valor", Money, key="value", nullable=True),
         Column(
             "dataCriacao",
             DateTime,
@@ -88,11 +274,61 @@ def sqlalchemy_schema(Numeric=Numeric):
         ),
     )
 
-    return {"people": people, "transactions": transactions, "accounts": accounts}
+    idempotency_keys = Table(
+        "idempotency_keys",
+        metadata,
+        Column("chave", String(255), key="key", primary_key=True),
+        Column("requisicao", String(255), key="request", nullable=False),
+        Column("saldo", Money, key="balance", nullable=True),
+        Column(
+            "dataCriacao",
+            DateTime,
+            key="created_at",
+            nullable=False,
+            default=datetime.utcnow,
+            index=True,
+        ),
+    )
+
+    batch_job_chunks = Table(
+        "batch_job_chunks",
+        metadata,
+        Column("tarefa", String(255), key="job", primary_key=True),
+        Column("idContaInicial", Integer, key="first_id", primary_key=True),
+        Column("idContaFinal", Integer, key="last_id", nullable=False),
+        Column("contas", Integer, key="accounts", nullable=False, default=0),
+        Column(
+            "dataConclusao",
+            DateTime,
+            key="finished_at",
+            nullable=False,
+            default=datetime.utcnow,
+        ),
+    )
+
+    return {
+        "people": people,
+        "transactions": transactions,
+        "accounts": accounts,
+        "balance_checkpoints": balance_checkpoints,
+        "account_snapshots": account_snapshots,
+        "outbox": outbox,
+        "idempotency_keys": idempotency_keys,
+        "batch_job_chunks": batch_job_chunks,
+    }
 
 
 @notmutate
-def start_mappers(people, accounts, transactions):
+def start_mappers(
+    people,
+    accounts,
+    transactions,
+    balance_checkpoints,
+    account_snapshots,
+    outbox,
+    idempotency_keys,
+    batch_job_chunks,
+):
     """It starts the mapper between sqlalchemy and the domain classes"""
 
     LOGGER.debug("Starting mappers")
@@ -104,46 +340,462 @@ def start_mappers(people, accounts, transactions):
             "accounts": relationship(domain.Account, back_populates="person"),
         },
     )
+    properties = {"person": relationship(people_mapper, back_populates="accounts")}
+    event_sourced = accounts.info.get("event_sourced", False)
+
+    if event_sourced:
+        # The balance is read from the snapshot and the transactions after
+        # it whenever an account is loaded, and it is never written
+        properties["balance"] = column_property(
+            repositories.ledger_balance(accounts, transactions, account_snapshots)
+        )
+
     accounts_mapper = mapper(
         domain.Account,
         accounts,
-        properties={
-            "transactions": relationship(domain.Transaction, back_populates="account"),
-            "person": relationship(people_mapper, back_populates="accounts"),
-        },
+        version_id_col=accounts.c.version,
+        properties=properties,
+        exclude_properties=[accounts.c.balance] if event_sourced else None,
     )
 
-    mapper(
-        domain.Transaction,
-        transactions,
-        properties={
-            "account": relationship(accounts_mapper, back_populates="transactions")
-        },
-    )
+    # The transactions are written and read by the TransactionRepository.
+    # An account only lists the transactions added to it since it was
+    # loaded, so adding one never loads the whole account history
+    event.listen(accounts_mapper, "load", _start_transactions)
 
+    mapper(domain.Transaction, transactions, primary_key=[transactions.c.id])
 
-class SqlSessionFactory:
-    """Creates a session factory object to be used during an transaction"""
+    mapper(domain.BalanceCheckpoint, balance_checkpoints)
+    mapper(domain.AccountSnapshot, account_snapshots)
+    mapper(domain.OutboxEvent, outbox)
+    mapper(domain.IdempotencyKey, idempotency_keys)
+    mapper(domain.BatchJobChunk, batch_job_chunks)
+
+
+def _start_transactions(account: domain.Account, context) -> None:
+    account.transactions = []
+
+
+def monthly_partitions(since: date, months: int) -> List[Tuple[str, date, date]]:
+    """Returns the name and the date range of the transactions table
+    partitions, one per month, starting at the month of `since`"""
+
+    partitions = []
+    start = since.replace(day=1)
+
+    for _ in range(months):
+        end = date(start.year + start.month // 12, start.month % 12 + 1, 1)
+        name = "transactions_y%04dm%02d" % (start.year, start.month)
+        partitions.append((name, start, end))
+        start = end
+
+    return partitions
+
+
+def create_transactions_partitions(engine, since: date = None, months_ahead=3):
+    """Creates the monthly partitions of the transactions table for the
+    month of `since` and the `months_ahead` following months, plus a
+    default partition for rows outside of them.
+
+    It is safe to run it many times, existing partitions are kept. It does
+    nothing when the database is not a PostgreSQL or the table was not
+    created as partitioned. Returns the names of the partitions."""
+
+    if engine.dialect.name != "postgresql":
+        return []
+
+    with engine.begin() as connection:
+        partitioned = connection.execute(
+            text(
+                "SELECT 1 FROM pg_partitioned_table "
+                "WHERE partrelid = to_regclass('transactions')"
+            )
+        ).scalar()
+
+        if not partitioned:
+            return []
+
+        partitions = monthly_partitions(since or date.today(), months_ahead + 1)
+
+        for name, start, end in partitions:
+            LOGGER.debug("Creating the partition %s", name)
+            connection.execute(
+                text(
+                    "CREATE TABLE IF NOT EXISTS %s PARTITION OF transactions "
+                    "FOR VALUES FROM ('%s') TO ('%s')"
+                    % (name, start.isoformat(), end.isoformat())
+                )
+            )
+
+        connection.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS transactions_default "
+                "PARTITION OF transactions DEFAULT"
+            )
+        )
+
+    return [name for name, _, _ in partitions]
+
+
+class PoolMetrics:
+    """Collects connection pool usage from the pool events.
+
+    The checkouts, checkins and new connections are counted by listening
+    the pool events. The time spent waiting for a connection is reported
+    by the `InstrumentedQueuePool`, other pool classes will report zero."""
+
+    def __init__(self, engine):
+        self.pool = engine.pool
+        self.pool.metrics = self
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+        event.listen(self.pool, "checkout", self._on_checkout)
+        event.listen(self.pool, "checkin", self._on_checkin)
+        event.listen(self.pool, "connect", self._on_connect)
+        event.listen(self.pool, "invalidate", self._on_invalidate)
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def record_wait(self, seconds: float) -> None:
+        """Accounts the time a caller waited for a connection"""
+
+        with self._lock:
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def snapshot(self) -> dict:
+        """Returns the current pool usage numbers"""
+
+        with self._lock:
+            checkouts = self.checkouts
+            snapshot = {
+                "checkouts": checkouts,
+                "checkins": self.checkins,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "in_use": checkouts - self.checkins,
+                "wait_seconds_total": self.wait_total,
+                "wait_seconds_max": self.wait_max,
+                "wait_seconds_avg": self.wait_total / checkouts if checkouts else 0.0,
+            }
+
+        if isinstance(self.pool, QueuePool):
+            snapshot.update(
+                size=self.pool.size(),
+                idle=self.pool.checkedin(),
+                overflow=self.pool.overflow(),
+            )
+        else:
+            snapshot.update(size=0, idle=0, overflow=0)
+
+        return snapshot
+
+
+class QueryTimer:
+    """Adds the time spent running the statements of the engine to the
+    `db_sql` phase of the request being served, see `RequestTiming`"""
 
     def __init__(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def _before_execute(self, connection, cursor, statement, *args):
+        if current_request_timing.get() is not None:
+            connection.info["query_started"] = time.perf_counter()
+
+    def _after_execute(self, connection, cursor, statement, *args):
+        # The start of a statement which failed is overwritten by the next
+        started = connection.info.pop("query_started", None)
+
+        if started is not None:
+            record_request_phase("db_sql", time.perf_counter() - started)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool which reports how long the callers waited for a
+    connection to the `PoolMetrics` attached to it.
+
+    The time to check out a connection, the wait, the connect and the
+    ping included, is added to the `db_checkout` phase of the request
+    being served."""
+
+    metrics = None
+
+    def connect(self):
+        return self._timed_checkout(super().connect)
+
+    def unique_connection(self):
+        return self._timed_checkout(super().unique_connection)
+
+    def _timed_checkout(self, checkout):
+        started = time.perf_counter()
+
+        try:
+            return checkout()
+        finally:
+            record_request_phase("db_checkout", time.perf_counter() - started)
+
+    def _do_get(self):
+        started = time.perf_counter()
+
+        try:
+            return super()._do_get()
+        finally:
+            if self.metrics is not None:
+                self.metrics.record_wait(time.perf_counter() - started)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+
+        if self.metrics is not None:
+            self.metrics.pool = pool
+
+        return pool
+
+
+def replication_lag(engine) -> float:
+    """Returns how many seconds a PostgreSQL replica is behind the primary.
+
+    A replica which replayed everything it received is not lagging, even
+    if the primary had no writes for a while."""
+
+    with engine.connect() as connection:
+        return connection.execute(
+            text(
+                "SELECT CASE WHEN NOT pg_is_in_recovery() "
+                "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) "
+                "END"
+            )
+        ).scalar()
+
+
+class ReplicaRouter:
+    """Chooses the replica engine used by a read-only session.
+
+    The `round_robin` strategy rotates over the replicas and the
+    `least_loaded` one picks the replica with less connections checked out.
+    When `max_lag` is given, replicas further behind the primary than
+    `max_lag` seconds, or which could not be probed, are skipped. The lag
+    is probed at most once every `lag_check_interval` seconds per replica.
+    `pick` returns None when no replica can be used."""
+
+    strategies = ("round_robin", "least_loaded")
+
+    def __init__(
+        self,
+        engines,
+        strategy: str = "round_robin",
+        max_lag: float = None,
+        lag_probe=replication_lag,
+        lag_check_interval: float = 1.0,
+    ):
+        if strategy not in self.strategies:
+            raise ValueError("Unknown replica routing strategy '%s'" % strategy)
+
+        self.engines = list(engines)
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.lag_probe = lag_probe
+        self.lag_check_interval = lag_check_interval
+        self._counter = itertools.count()
+        self._lags = {}
+
+    def pick(self):
+        candidates = [engine for engine in self.engines if self._is_fresh(engine)]
+
+        if not candidates:
+            return None
+        elif self.strategy == "least_loaded":
+            return min(candidates, key=self._checked_out)
+
+        return candidates[next(self._counter) % len(candidates)]
+
+    @staticmethod
+    def _checked_out(engine) -> int:
+        if isinstance(engine.pool, QueuePool):
+            return engine.pool.checkedout()
+
+        return 0
+
+    def _is_fresh(self, engine) -> bool:
+        if self.max_lag is None:
+            return True
+
+        lag = self._lag(engine)
+        return lag is not None and lag <= self.max_lag
+
+    def _lag(self, engine) -> Optional[float]:
+        now = time.monotonic()
+        checked_at, lag = self._lags.get(engine, (None, None))
+
+        if checked_at is None or now - checked_at >= self.lag_check_interval:
+            try:
+                lag = self.lag_probe(engine)
+            except Exception:
+                LOGGER.exception("Could not probe the replication lag of %s", engine)
+                lag = None
+
+            self._lags[engine] = (now, lag)
+
+        return lag
+
+
+class SqlSessionFactory:
+    """Creates a session factory object to be used during an transaction.
+
+    The sessions are bound to the primary `engine`. When a ReplicaRouter is
+    given as `replicas`, the sessions of the read-only unit of works are
+    bound to the replica it picks or to the primary when none can be used.
+    Extra keyword arguments are handed to the sessionmaker, e.g.
+    `expire_on_commit=False`."""
+
+    def __init__(self, engine, replicas: ReplicaRouter = None, **options):
         self.engine = engine
+        self.replicas = replicas
+        self.sessionmaker = sessionmaker(bind=engine, **options)
 
     def __call__(self):
-        return sessionmaker(bind=self.engine)()
+        return self.sessionmaker()
+
+    def for_reading(self):
+        """Returns the session factory used by read-only unit of works"""
+
+        if self.replicas is None:
+            return self
+
+        return ReplicaSessionFactory(self)
+
+
+class ReplicaSessionFactory:
+    """Creates the sessions of read-only unit of works bound to a replica"""
+
+    def __init__(self, session_factory: SqlSessionFactory):
+        self.session_factory = session_factory
+
+    def __call__(self):
+        engine = self.session_factory.replicas.pick()
+
+        if engine is None:
+            LOGGER.debug("No replica available, reading from the primary")
+            engine = self.session_factory.engine
+
+        return self.session_factory.sessionmaker(bind=engine)
+
+
+def track_changed_accounts(session, flush_context) -> None:
+    """Collects the ids of the accounts written by the session flushes"""
+
+    changed = session.info.setdefault("changed_accounts", set())
+
+    for entity in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(entity, domain.Account):
+            changed.add(entity.id)
+
+
+def track_outbox_events(session, flush_context) -> None:
+    """Collects the events of the transactions and of the blocks written by
+    the session flushes, see OutboxRepository"""
+
+    outbox = repositories.OutboxRepository(session)
+
+    for entity in session.new:
+        if isinstance(entity, domain.Transaction):
+            outbox.record(entity.type, entity.account_id, entity.value)
+
+    for entity in session.dirty:
+        if isinstance(entity, domain.Account):
+            if attributes.get_history(entity, "active").has_changes():
+                outbox.record(
+                    domain.AccountEventTypeEnum.unblock
+                    if entity.active
+                    else domain.AccountEventTypeEnum.block,
+                    entity.id,
+                )
 
 
 class SqlUnitOfWork(interfaces.AbstractUnitOfWork):
-    """Represents a unit of work used during the interaction with database"""
+    """Represents a unit of work used during the interaction with database.
+
+    With an AccountCache the read-only unit of works read the accounts
+    through it, and the accounts written are invalidated after the commit.
+    With a `key_cache` the idempotency keys committed are kept in it. With
+    `publish_events` the deposits, withdraws and blocks are written to the
+    outbox in the same commit, see OutboxRepository."""
 
     @notmutate
-    def __init__(self, session_factory: SqlSessionFactory):
+    def __init__(
+        self,
+        session_factory: SqlSessionFactory,
+        cache=None,
+        key_cache=None,
+        publish_events: bool = False,
+    ):
         self.session_factory = session_factory
+        self.cache = cache
+        self.key_cache = key_cache
+        self.publish_events = publish_events
+
+    @property
+    def event_sourced(self) -> bool:
+        """Tells whether the accounts were declared event-sourced by
+        `sqlalchemy_schema`"""
+
+        return class_mapper(domain.Account).local_table.info["event_sourced"]
 
     @notmutate
     def __enter__(self):
         self.session = self.session_factory()
+        self._track_changes()
         return super().__enter__()
 
+    def _track_changes(self) -> None:
+        if self.cache is not None and not self.read_only:
+            event.listen(self.session, "after_flush", track_changed_accounts)
+
+        if self.publish_events and not self.read_only:
+            self.session.info["outbox"] = []
+            event.listen(self.session, "after_flush", track_outbox_events)
+
+    def for_reading(self) -> "SqlUnitOfWork":
+        """Returns a copy of this unit of work whose sessions may be bound
+        to a read replica, if the session factory knows any, and which
+        reads the accounts through the cache, if there is one"""
+
+        for_reading = getattr(self.session_factory, "for_reading", None)
+
+        if for_reading is None and self.cache is None:
+            return self
+
+        unit = copy.copy(self)
+        unit.read_only = True
+
+        if for_reading is not None:
+            unit.session_factory = for_reading()
+
+        return unit
+
     def __exit__(self, exc_type, exc, exc_tb) -> None:
 
         if exc_type:
@@ -153,9 +805,16 @@ class SqlUnitOfWork(interfaces.AbstractUnitOfWork):
                 "Some exception was raised during __exit__ invocation."
                 " Rolling back the transaction."
             )
+
+            if issubclass(exc_type, StaleDataError):
+                raise exceptions.ConcurrentModification(str(exc)) from exc
         else:
             try:
                 self.commit()
+            except StaleDataError as exc:
+                self.rollback()
+                self.session.close()  # pylint: disable=no-member
+                raise exceptions.ConcurrentModification(str(exc)) from exc
             except Exception:
                 self.rollback()
                 self.session.close()  # pylint: disable=no-member
@@ -167,11 +826,51 @@ class SqlUnitOfWork(interfaces.AbstractUnitOfWork):
     def rollback(self):
         self.session.rollback()  # pylint: disable=no-member
 
+        if self.cache is not None or self.key_cache is not None:
+            self.session.info.pop("changed_accounts", None)
+            self.session.info.pop("idempotency_keys", None)
+
+        if self.publish_events and not self.read_only:
+            del self.session.info["outbox"][:]
+
     def commit(self):
+        published = False
+
+        if self.publish_events and not self.read_only:
+            # The ORM changes are flushed first, so their events are collected
+            self.session.flush()  # pylint: disable=no-member
+            repositories.OutboxRepository(self.session).write_pending()
+
+        if self.cache is not None and not self.read_only:
+            # The invalidation is published by the transaction itself when
+            # the channel can, so it is only delivered if the write commits
+            self.session.flush()  # pylint: disable=no-member
+            changed = self.session.info.get("changed_accounts")
+
+            if changed:
+                published = self.cache.publish_in(
+                    self.session.connection(), changed  # pylint: disable=no-member
+                )
+
         self.session.commit()  # pylint: disable=no-member
 
+        if self.cache is not None:
+            changed = self.session.info.pop("changed_accounts", None)
+
+            if changed:
+                self.cache.invalidate(changed, published)
+
+        if self.key_cache is not None:
+            for key in self.session.info.pop("idempotency_keys", ()):
+                self.key_cache.put(key.key, key)
+
     @property
     def accounts(self) -> repositories.AccountRepository:
+        if self.read_only and self.cache is not None:
+            return repositories.CachedAccountRepository(self.session, self.cache)
+        elif self.event_sourced:
+            return repositories.LedgerAccountRepository(self.session)
+
         return repositories.AccountRepository(self.session)
 
     @property
@@ -180,4 +879,98 @@ class SqlUnitOfWork(interfaces.AbstractUnitOfWork):
 
     @property
     def people(self) -> repositories.PersonRepository:
-        return repositories.PersonRepository(self.session)
\ No newline at end of file
+        return repositories.PersonRepository(self.session)
+
+    @property
+    def checkpoints(self) -> repositories.BalanceCheckpointRepository:
+        if self.event_sourced:
+            return repositories.LedgerBalanceCheckpointRepository(self.session)
+
+        return repositories.BalanceCheckpointRepository(self.session)
+
+    @property
+    def snapshots(self) -> repositories.AccountSnapshotRepository:
+        return repositories.AccountSnapshotRepository(self.session)
+
+    @property
+    def outbox(self) -> repositories.OutboxRepository:
+        return repositories.OutboxRepository(self.session)
+
+    @property
+    def idempotency_keys(self) -> repositories.IdempotencyKeyRepository:
+        return repositories.IdempotencyKeyRepository(self.session, self.key_cache)
+
+    @property
+    def batch_jobs(self) -> repositories.BatchJobRepository:
+        return repositories.BatchJobRepository(self.session)
+
+
+class AsyncSqlUnitOfWork(SqlUnitOfWork):
+    """Represents a unit of work used as an `async with` block.
+
+    SQLAlchemy 1.3 has no asyncio driver, so the blocking database work
+    is handed to the executor and awaited from the event loop. The size
+    of the executor bounds the threads used by the database layer no
+    matter how many requests are in flight."""
+
+    @notmutate
+    def __init__(
+        self,
+        session_factory: SqlSessionFactory,
+        executor=None,
+        cache=None,
+        key_cache=None,
+        publish_events: bool = False,
+    ):
+        super().__init__(session_factory, cache, key_cache, publish_events)
+        self.executor = executor
+
+    async def run(self, function, *args, **kwargs):
+        """Runs a blocking callable in the executor and awaits its result"""
+
+        loop = asyncio.get_event_loop()
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, function, *args, **kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    async def __aenter__(self):
+        # Creating the session may block too, e.g. probing the replication
+        # lag of the replicas, see ReplicaRouter
+        self.session = await self.run(self.session_factory)
+        self._track_changes()
+        return self
+
+    async def __aexit__(self, exc_type, exc, exc_tb) -> None:
+        await self.run(self.__exit__, exc_type, exc, exc_tb)
+
+    @property
+    def accounts(self) -> repositories.AsyncRepository:
+        return repositories.AsyncRepository(super().accounts, self.run)
+
+    @property
+    def transactions(self) -> repositories.AsyncRepository:
+        return repositories.AsyncRepository(super().transactions, self.run)
+
+    @property
+    def people(self) -> repositories.AsyncRepository:
+        return repositories.AsyncRepository(super().people, self.run)
+
+    @property
+    def checkpoints(self) -> repositories.AsyncRepository:
+        return repositories.AsyncRepository(super().checkpoints, self.run)
+
+    @property
+    def snapshots(self) -> repositories.AsyncRepository:
+        return repositories.AsyncRepository(super().snapshots, self.run)
+
+    @property
+    def outbox(self) -> repositories.AsyncRepository:
+        return repositories.AsyncRepository(super().outbox, self.run)
+
+    @property
+    def idempotency_keys(self) -> repositories.AsyncRepository:
+        return repositories.AsyncRepository(super().idempotency_keys, self.run)
+
+    @property
+    def batch_jobs(self) -> repositories.AsyncRepository:
+        return repositories.AsyncRepository(super().batch_jobs, self.run)
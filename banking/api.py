@@ -1,25 +1,74 @@
-from datetime import datetime, timedelta
-from decimal import Decimal
-from typing import List, Optional
-
-from fastapi import Depends, FastAPI, HTTPException, Response
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Response
+from fastapi.routing import APIRoute
 from pydantic import (
     BaseModel,
     BaseSettings,
     constr,
 )  # pylint: disable=no-name-in-module
 from sqlalchemy import create_engine
+from starlette.responses import StreamingResponse
 
 from banking import exceptions
+from banking.cache import (
+    AccountCache,
+    LocalInvalidationChannel,
+    LRUCache,
+    PostgresInvalidationChannel,
+)
 from banking.adapters import (
+    MONEY_TYPES,
+    AsyncSqlUnitOfWork,
+    InstrumentedQueuePool,
+    PoolMetrics,
+    QueryTimer,
+    ReplicaRouter,
     SqlSessionFactory,
     SqlUnitOfWork,
+    create_transactions_partitions,
     metadata,
     sqlalchemy_schema,
     start_mappers,
 )
-from banking.domain import TransactionTypeEnum
-from banking.services import get_commands
+from banking.domain import Money, TransactionTypeEnum, WithdrawalCalendar
+from banking.jobs import compact_account_snapshots, purge_idempotency_keys
+from banking.metrics import (
+    PHASE_BUCKETS,
+    REQUEST_PHASES,
+    HistogramFamily,
+    RequestTiming,
+    current_request_timing,
+    prometheus_histogram,
+    prometheus_metric,
+)
+from banking.outbox import FileSink, OutboxDispatcher, QueueSink
+from banking.services import (
+    ASYNC_COMMANDS,
+    EXPORT_MEDIA_TYPES,
+    AsyncAccountAtomicDepositCommand,
+    AsyncAccountAtomicWithdrawCommand,
+    AsyncAccountBalanceAtCommand,
+    AsyncAccountBlockCommand,
+    AsyncAccountFetchCommand,
+    AsyncAccountFetchManyCommand,
+    AsyncAccountRegisterCommand,
+    AsyncAccountTransactionsExportCommand,
+    AsyncAccountTransactionsPageCommand,
+    AsyncAccountTransactionsSummaryCommand,
+    AsyncAccountTransferCommand,
+    AsyncPersonRegisterCommand,
+    CommandBus,
+    LoggingMiddleware,
+    RetryMiddleware,
+    RetryPolicy,
+    TimingMiddleware,
+    WriteCoalescer,
+)
 
 
 def datetime_last_30_days() -> datetime:
@@ -32,6 +81,41 @@ class Settings(BaseSettings):
     It gives preference for environment variables of course."""
 
     sqlalchemy_database_url: str
+    sqlalchemy_pool_size: int = 20
+    sqlalchemy_max_overflow: int = 10
+    sqlalchemy_pool_timeout: float = 30.0
+    sqlalchemy_pool_recycle: int = 1800
+    sqlalchemy_pool_pre_ping: bool = True
+    sqlalchemy_replica_urls: List[str] = []
+    sqlalchemy_replica_strategy: str = "round_robin"
+    sqlalchemy_replica_max_lag: Optional[float] = None
+    command_retry_attempts: int = 3
+    command_retry_delay: float = 0.01
+    command_retry_max_delay: float = 0.2
+    transactions_partitioned: bool = False
+    transactions_partitions_ahead: int = 3
+    group_commit_enabled: bool = False
+    group_commit_max_batch_size: int = 64
+    group_commit_max_delay: float = 0.002
+    withdrawal_day_utc_offset: int = 0
+    withdrawal_day_rollover_hour: int = 0
+    account_cache_size: int = 0
+    account_cache_ttl: float = 5.0
+    account_cache_channel: str = "local"
+    idempotency_key_ttl: float = 24 * 60 * 60
+    idempotency_key_cache_size: int = 10000
+    idempotency_key_purge_interval: float = 60 * 60
+    money_column_type: str = "numeric"
+    accounts_balances_max_ids: int = 1000
+    event_sourced_accounts: bool = False
+    account_snapshot_every: int = 100
+    account_snapshot_interval: float = 10.0
+    outbox_enabled: bool = False
+    outbox_sink: str = "file"
+    outbox_file: str = "outbox.jsonl"
+    outbox_batch_size: int = 500
+    outbox_interval: float = 0.5
+    server_timing_header: bool = True
 
     class Config:
         """Read file"""
@@ -39,39 +123,383 @@ class Settings(BaseSettings):
         env_file = ".env"
 
 
+def timed_endpoint(endpoint):
+    """Wraps the endpoint to time the `app` phase of the request"""
+
+    if asyncio.iscoroutinefunction(endpoint):
+
+        @functools.wraps(endpoint)
+        async def timed_async(*args, **kwargs):
+            timing = current_request_timing.get()
+
+            if timing is None:
+                return await endpoint(*args, **kwargs)
+
+            timing.start_endpoint()
+
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                timing.finish_endpoint()
+
+        return timed_async
+
+    @functools.wraps(endpoint)
+    def timed(*args, **kwargs):
+        timing = current_request_timing.get()
+
+        if timing is None:
+            return endpoint(*args, **kwargs)
+
+        timing.start_endpoint()
+
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            timing.finish_endpoint()
+
+    return timed
+
+
+class TimedRoute(APIRoute):
+    """A route which labels the request timing with its method and path,
+    and times the `parse`, `app` and `serialize` phases of its handler"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = "%s %s" % (",".join(sorted(self.methods)), self.path)
+
+        async def timed_handler(request):
+            timing = current_request_timing.get()
+
+            if timing is None:
+                return await handler(request)
+
+            timing.start_handler(route)
+
+            try:
+                return await handler(request)
+            finally:
+                timing.finish_handler()
+
+        return timed_handler
+
+
+class ServerTimingMiddleware:
+    """Times the requests by phase, see `RequestTiming`.
+
+    The phases timed until the response starts are sent in the
+    Server-Timing header when `header` is set. The phases of the whole
+    request, a streamed body included, are observed in the histograms of
+    each phase labeled by the route once the response is sent. The
+    requests which matched no route are not observed."""
+
+    def __init__(self, app, histograms: Dict[str, HistogramFamily], header: bool):
+        self.app = app
+        self.histograms = histograms
+        self.header = header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = current_request_timing.set(timing)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and self.header:
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timing.server_timing().encode()))
+                message = dict(message, headers=headers)
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_request_timing.reset(token)
+            self.observe(timing)
+
+    def observe(self, timing: RequestTiming) -> None:
+        if timing.route is None:
+            return
+
+        for phase, seconds in timing.phases.items():
+            self.histograms[phase].labels(timing.route).observe(seconds)
+
+        self.histograms["total"].labels(timing.route).observe(timing.elapsed())
+
+
 # loads application settings
 settings = Settings()
 
 # instantiate the application var
 app = FastAPI()
 
+# Times the phases of the requests to the endpoints declared below
+app.router.route_class = TimedRoute
+
+
+def create_pooled_engine(url: str):
+    """Builds an engine using the connection pool settings"""
+
+    engine = create_engine(
+        name_or_url=url,
+        poolclass=InstrumentedQueuePool,
+        pool_size=settings.sqlalchemy_pool_size,
+        max_overflow=settings.sqlalchemy_max_overflow,
+        pool_timeout=settings.sqlalchemy_pool_timeout,
+        pool_recycle=settings.sqlalchemy_pool_recycle,
+        pool_pre_ping=settings.sqlalchemy_pool_pre_ping,
+    )
+    QueryTimer(engine)
+    return engine
+
+
 # Builds the engine used to open database connections
-engine = create_engine(
-    name_or_url=settings.sqlalchemy_database_url,
+engine = create_pooled_engine(settings.sqlalchemy_database_url)
+
+# Builds the read replicas engines, used by the read-only commands
+replicas = None
+
+if settings.sqlalchemy_replica_urls:
+    replicas = ReplicaRouter(
+        [create_pooled_engine(url) for url in settings.sqlalchemy_replica_urls],
+        strategy=settings.sqlalchemy_replica_strategy,
+        max_lag=settings.sqlalchemy_replica_max_lag,
+    )
+
+# Retries the commands which lost a race against a concurrent update
+retry_policy = RetryPolicy(
+    attempts=settings.command_retry_attempts,
+    delay=settings.command_retry_delay,
+    max_delay=settings.command_retry_max_delay,
+)
+
+# Tells the day counted by the daily withdrawal limit
+withdrawal_calendar = WithdrawalCalendar(
+    utc_offset=settings.withdrawal_day_utc_offset,
+    rollover_hour=settings.withdrawal_day_rollover_hour,
 )
 
+# Collects the connection pool usage numbers
+pool_metrics = PoolMetrics(engine)
+
+# Collects the latency of the commands run by the endpoints
+command_latency = HistogramFamily()
+
+# Collects the time of each phase of the requests, and their total, by route
+request_latency = {
+    phase: HistogramFamily(PHASE_BUCKETS) for phase in REQUEST_PHASES + ("total",)
+}
+
+app.add_middleware(
+    ServerTimingMiddleware,
+    histograms=request_latency,
+    header=settings.server_timing_header,
+)
+
+# Runs the commands of the endpoints, which are registered once here
+command_bus = CommandBus(
+    ASYNC_COMMANDS.values(),
+    middlewares=[
+        LoggingMiddleware(),
+        TimingMiddleware(command_latency),
+        RetryMiddleware(retry_policy),
+    ],
+    calendar=withdrawal_calendar,
+)
+
+# The objects are read after the commit by the response serialization,
+# which runs in the event loop, so they must not be expired by the commit
+session_factory = SqlSessionFactory(engine, replicas=replicas, expire_on_commit=False)
+
+# Keeps the recently read accounts. The workers invalidate the accounts
+# they write in each other through the channel
+account_cache = None
+
+if settings.account_cache_size > 0:
+    account_cache = AccountCache(
+        max_size=settings.account_cache_size,
+        ttl=settings.account_cache_ttl,
+        channel=PostgresInvalidationChannel(engine)
+        if settings.account_cache_channel == "postgresql"
+        else LocalInvalidationChannel(),
+    )
+
+# Answers the replays of recent idempotent requests without a query
+idempotency_key_cache = LRUCache(
+    max_size=settings.idempotency_key_cache_size, ttl=settings.idempotency_key_ttl
+)
+
+# Runs the blocking database work. It has one thread per connection
+# the pools can hand out, more threads would only wait for a connection
+database_executor = ThreadPoolExecutor(
+    max_workers=(settings.sqlalchemy_pool_size + settings.sqlalchemy_max_overflow)
+    * (1 + len(settings.sqlalchemy_replica_urls)),
+    thread_name_prefix="database",
+)
+
+
+# Applies the deposits and withdraws in groups sharing a single commit
+write_coalescer = WriteCoalescer(
+    SqlUnitOfWork(
+        SqlSessionFactory(engine),
+        cache=account_cache,
+        publish_events=settings.outbox_enabled,
+    ),
+    max_batch_size=settings.group_commit_max_batch_size,
+    max_delay=settings.group_commit_max_delay,
+    calendar=withdrawal_calendar,
+)
+
+# Delivers the events written to the outbox by the unit of works
+outbox_dispatcher = OutboxDispatcher(
+    SqlUnitOfWork(SqlSessionFactory(engine)),
+    QueueSink() if settings.outbox_sink == "queue" else FileSink(settings.outbox_file),
+    batch_size=settings.outbox_batch_size,
+    interval=settings.outbox_interval,
+)
+
+# Tasks which run in background while the application is up
+background_tasks = []
+
+
+async def maintain_transactions_partitions(interval: float = 24 * 60 * 60):
+    """Creates the transactions partitions of the next months ahead of time"""
+
+    loop = asyncio.get_event_loop()
+
+    while True:
+        await asyncio.sleep(interval)
+        await loop.run_in_executor(
+            database_executor,
+            create_transactions_partitions,
+            engine,
+            None,
+            settings.transactions_partitions_ahead,
+        )
+
+
+async def purge_expired_idempotency_keys(interval: float):
+    """Deletes the expired idempotency keys from time to time"""
+
+    loop = asyncio.get_event_loop()
+    unit_of_work = SqlUnitOfWork(SqlSessionFactory(engine))
+
+    while True:
+        await asyncio.sleep(interval)
+        await loop.run_in_executor(
+            database_executor,
+            purge_idempotency_keys,
+            unit_of_work,
+            timedelta(seconds=settings.idempotency_key_ttl),
+        )
+
+
+async def compact_account_snapshots_periodically(interval: float):
+    """Snapshots the event-sourced accounts from time to time, so reading a
+    balance sums about `account_snapshot_every` transactions at most"""
+
+    loop = asyncio.get_event_loop()
+    unit_of_work = SqlUnitOfWork(SqlSessionFactory(engine))
+
+    while True:
+        await asyncio.sleep(interval)
+        await loop.run_in_executor(
+            database_executor,
+            compact_account_snapshots,
+            unit_of_work,
+            settings.account_snapshot_every,
+        )
+
 
 @app.on_event("startup")
 async def startup_event():
     """Starts the database schema when applications is booted"""
 
-    schema = sqlalchemy_schema()
+    schema = sqlalchemy_schema(
+        Money=MONEY_TYPES[settings.money_column_type],
+        partitioned=settings.transactions_partitioned,
+        event_sourced=settings.event_sourced_accounts,
+    )
     start_mappers(**schema)
     metadata.create_all(engine)
 
+    if settings.transactions_partitioned:
+        create_transactions_partitions(
+            engine, months_ahead=settings.transactions_partitions_ahead
+        )
+        background_tasks.append(
+            asyncio.ensure_future(maintain_transactions_partitions())
+        )
+
+    background_tasks.append(
+        asyncio.ensure_future(
+            purge_expired_idempotency_keys(settings.idempotency_key_purge_interval)
+        )
+    )
+
+    if settings.event_sourced_accounts:
+        background_tasks.append(
+            asyncio.ensure_future(
+                compact_account_snapshots_periodically(
+                    settings.account_snapshot_interval
+                )
+            )
+        )
+
+    if settings.group_commit_enabled:
+        write_coalescer.start()
+
+    if settings.outbox_enabled:
+        outbox_dispatcher.start()
+
+    if account_cache is not None:
+        account_cache.channel.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stops the background tasks and waits the pending database work
+    before the application stops"""
+
+    for task in background_tasks:
+        task.cancel()
+
+    if settings.group_commit_enabled:
+        write_coalescer.stop()
+
+    if settings.outbox_enabled:
+        outbox_dispatcher.stop()
+
+    if account_cache is not None:
+        account_cache.channel.close()
+
+    database_executor.shutdown(wait=True)
+
 
 # Yields the UnitOfWork used to do the job
 # This pattern is strange but its the way that
 # FastAPI does.
 # Maybe it could be modified to an middleware or something
 # like that.
-def get_uow_instance():
-    """Yield a UnitOfWork used to do database operations.
+async def get_uow_instance():
+    """Yield an AsyncSqlUnitOfWork used to do database operations.
 
     Here we made a glue between API layer and adapter layer."""
 
-    session_factory = SqlSessionFactory(engine)
-    unit = SqlUnitOfWork(session_factory)
+    unit = AsyncSqlUnitOfWork(
+        session_factory,
+        executor=database_executor,
+        cache=account_cache,
+        key_cache=idempotency_key_cache,
+        publish_events=settings.outbox_enabled,
+    )
 
     try:
         yield unit
@@ -84,6 +512,10 @@ class OrmMode(BaseModel):
 
     class Config:
         orm_mode = True
+        # The amounts are answered as strings formatted from their integer
+        # cents, exact at any size, which a JSON number read as a float is
+        # not beyond 2 ** 53 cents
+        json_encoders = {Money: Money.format}
 
 
 class Detail(BaseModel):
@@ -112,7 +544,7 @@ class AccountReadSchema(OrmMode):
     """Schema used to shows an account public information"""
 
     id: int
-    daily_withdrawal_limit: Decimal
+    daily_withdrawal_limit: Money
     active: bool
     created_at: datetime
 
@@ -127,29 +559,154 @@ class AccountCreateSchema(BaseModel):
 class AccountBalanceSchema(OrmMode):
     """Schema used to shows an account balance"""
 
-    balance: Decimal
+    balance: Money
+
+
+class AccountBalanceItemSchema(OrmMode):
+    """Schema used to shows the balance of one of many accounts"""
+
+    id: int
+    balance: Money
+
+
+class AccountsBalancesSchema(OrmMode):
+    """Schema used to shows the balances of many accounts, in the order
+    of the ids requested, and the ids which do not exist"""
+
+    balances: List[AccountBalanceItemSchema]
+    missing: List[int]
 
 
 class DepositRequestSchema(BaseModel):
     """Schema used to receive a deposit value from body request"""
 
-    value: Decimal
+    value: Money
 
 
 class WithdrawRequestSchema(BaseModel):
     """Schema used to receive a withdraw value from body request"""
 
-    value: Decimal
+    value: Money
+
+
+class TransferRequestSchema(BaseModel):
+    """Schema used to receive a transfer between two accounts"""
+
+    source_id: int
+    target_id: int
+    value: Money
+
+
+class TransferReadSchema(OrmMode):
+    """Schema used to shows a transfer and the new source account balance"""
+
+    source_id: int
+    target_id: int
+    value: Money
+    balance: Money
 
 
 class AccountTransactionsSchema(OrmMode):
     """Schema used to shows a transaction information"""
 
-    value: Decimal
+    value: Money
     type: TransactionTypeEnum
     created_at: datetime
 
 
+class AccountTransactionsPageSchema(BaseModel):
+    """Schema used to shows a page of transactions and the cursor used
+    to read the next page"""
+
+    transactions: List[AccountTransactionsSchema]
+    next: Optional[str]
+
+    class Config:
+        json_encoders = OrmMode.Config.json_encoders
+
+
+class TransactionsTotalSchema(OrmMode):
+    """Schema used to shows the totals of a transaction type"""
+
+    count: int
+    total: Money
+    min: Optional[Money]
+    max: Optional[Money]
+    mean: Optional[Money]
+
+
+class DailyBalanceSchema(OrmMode):
+    """Schema used to shows the net flow and final balance of a day"""
+
+    day: date
+    net_flow: Money
+    balance: Money
+
+
+class AccountTransactionsSummarySchema(OrmMode):
+    """Schema used to shows the statistics of the account transactions"""
+
+    opening_balance: Money
+    closing_balance: Money
+    net_flow: Money
+    deposits: TransactionsTotalSchema
+    withdraws: TransactionsTotalSchema
+    days: List[DailyBalanceSchema]
+
+
+class PoolMetricsSchema(BaseModel):
+    """Schema used to shows the database connection pool usage"""
+
+    size: int
+    overflow: int
+    in_use: int
+    idle: int
+    checkouts: int
+    checkins: int
+    connects: int
+    invalidations: int
+    wait_seconds_total: float
+    wait_seconds_max: float
+    wait_seconds_avg: float
+
+
+class CommandMetricsSchema(BaseModel):
+    """Schema used to shows the latency of a command in seconds"""
+
+    count: int
+    sum: float
+    p50: float
+    p95: float
+    p99: float
+
+
+class OutboxMetricsSchema(BaseModel):
+    """Schema used to shows the delivery of the outbox events, the lags
+    are in seconds and the throughput in events per second"""
+
+    delivered: int
+    batches: int
+    failures: int
+    lag_seconds: float
+    throughput: float
+    delivery_lag_p50: float
+    delivery_lag_p95: float
+    delivery_lag_p99: float
+
+
+class CacheMetricsSchema(BaseModel):
+    """Schema used to shows the account cache usage"""
+
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+    listening: bool
+    listener_failures: int
+
+
 @app.post(
     "/people",
     response_model=PersonReadSchema,
@@ -161,10 +718,12 @@ class AccountTransactionsSchema(OrmMode):
     status_code=201,
     tags=["people"]
 )
-def person_register(data: PersonCreateSchema, uow=Depends(get_uow_instance)):
+async def person_register(data: PersonCreateSchema, uow=Depends(get_uow_instance)):
     """Register a person"""
     try:
-        person = get_commands(uow)["person_register"](**data.dict())
+        person = await command_bus.dispatch(
+            AsyncPersonRegisterCommand, uow, **data.dict()
+        )
     except ValueError as e:
         raise HTTPException(status_code=422, detail=str(e))
     else:
@@ -182,10 +741,12 @@ def person_register(data: PersonCreateSchema, uow=Depends(get_uow_instance)):
     },
     status_code=201,
 )
-def account_register(user: AccountCreateSchema, uow=Depends(get_uow_instance)):
+async def account_register(user: AccountCreateSchema, uow=Depends(get_uow_instance)):
     """Register an account"""
     try:
-        account = get_commands(uow)["account_register"](**user.dict())
+        account = await command_bus.dispatch(
+            AsyncAccountRegisterCommand, uow, **user.dict()
+        )
     except exceptions.DoesNotExist:
         raise HTTPException(status_code=404, detail="Person not found")
     except ValueError as e:
@@ -194,6 +755,32 @@ def account_register(user: AccountCreateSchema, uow=Depends(get_uow_instance)):
         return account
 
 
+@app.get(
+    "/accounts/balances",
+    response_model=AccountsBalancesSchema,
+    responses={422: {"model": Detail}},
+)
+async def accounts_balances(
+    ids: str = Query(..., regex=r"^\d+(,\d+)*$", example="1,2,3"),
+    uow=Depends(get_uow_instance),
+):
+    """Retrieves the balances of many accounts by their comma separated
+    ids, with a single query per few hundred ids"""
+
+    ids = [int(id) for id in ids.split(",")]
+
+    if len(ids) > settings.accounts_balances_max_ids:
+        raise HTTPException(
+            status_code=422,
+            detail="At most %d ids are accepted" % settings.accounts_balances_max_ids,
+        )
+
+    accounts, missing = await command_bus.dispatch(
+        AsyncAccountFetchManyCommand, uow, ids
+    )
+    return {"balances": accounts, "missing": missing}
+
+
 @app.get(
     "/accounts/{id}/balance",
     response_model=AccountBalanceSchema,
@@ -201,10 +788,19 @@ def account_register(user: AccountCreateSchema, uow=Depends(get_uow_instance)):
         404: {"model": Detail},
     },
 )
-def account_balance(id: int, uow=Depends(get_uow_instance)):
-    """Retrieves an existing account by id and show its balance"""
+async def account_balance(
+    id: int, as_of: Optional[datetime] = None, uow=Depends(get_uow_instance)
+):
+    """Retrieves an existing account by id and show its balance. With
+    `as_of` it shows the balance the account had at that moment"""
     try:
-        account = get_commands(uow)["account_fetch"](id)
+        if as_of is not None:
+            balance = await command_bus.dispatch(
+                AsyncAccountBalanceAtCommand, uow, id, as_of
+            )
+            return {"balance": balance}
+
+        account = await command_bus.dispatch(AsyncAccountFetchCommand, uow, id)
     except exceptions.DoesNotExist:
         raise HTTPException(status_code=404, detail="Account not found")
     else:
@@ -223,10 +819,27 @@ def account_balance(id: int, uow=Depends(get_uow_instance)):
     },
     status_code=205,
 )
-def account_deposit(id: int, data: DepositRequestSchema, uow=Depends(get_uow_instance)):
-    """Deposit some amount to the account"""
+async def account_deposit(
+    id: int,
+    data: DepositRequestSchema,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    uow=Depends(get_uow_instance),
+):
+    """Deposit some amount to the account.
+
+    A request retried with the same Idempotency-Key is deposited once."""
     try:
-        get_commands(uow)["account_deposit"](id, **data.dict())
+        # The keyed requests record the key in their own transaction
+        if settings.group_commit_enabled and idempotency_key is None:
+            await asyncio.wrap_future(write_coalescer.deposit(id, data.value))
+        else:
+            await command_bus.dispatch(
+                AsyncAccountAtomicDepositCommand,
+                uow,
+                id,
+                data.value,
+                idempotency_key,
+            )
     except exceptions.DoesNotExist:
         raise HTTPException(status_code=404, detail="Account not found")
     except ValueError as e:
@@ -244,12 +857,26 @@ def account_deposit(id: int, data: DepositRequestSchema, uow=Depends(get_uow_ins
     },
     status_code=205,
 )
-def account_withdraw(
-    id: int, data: WithdrawRequestSchema, uow=Depends(get_uow_instance)
+async def account_withdraw(
+    id: int,
+    data: WithdrawRequestSchema,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    uow=Depends(get_uow_instance),
 ):
-    """Withdraw some amount from an account"""
+    """Withdraw some amount from an account.
+
+    A request retried with the same Idempotency-Key is withdrawn once."""
     try:
-        get_commands(uow)["account_withdraw"](id, **data.dict())
+        if settings.group_commit_enabled and idempotency_key is None:
+            await asyncio.wrap_future(write_coalescer.withdraw(id, data.value))
+        else:
+            await command_bus.dispatch(
+                AsyncAccountAtomicWithdrawCommand,
+                uow,
+                id,
+                data.value,
+                idempotency_key,
+            )
     except exceptions.DoesNotExist:
         raise HTTPException(status_code=404, detail="Account not found")
     except ValueError as e:
@@ -258,11 +885,44 @@ def account_withdraw(
         return Response(content=None, status_code=205)
 
 
+@app.post(
+    "/transfers",
+    response_model=TransferReadSchema,
+    responses={404: {"model": Detail}},
+    status_code=201,
+)
+async def transfer(
+    data: TransferRequestSchema,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    uow=Depends(get_uow_instance),
+):
+    """Transfer some amount from the source to the target account.
+
+    Both sides are posted in the same transaction. A request retried with
+    the same Idempotency-Key is transferred once."""
+    try:
+        balance = await command_bus.dispatch(
+            AsyncAccountTransferCommand,
+            uow,
+            data.source_id,
+            data.target_id,
+            data.value,
+            idempotency_key,
+        )
+    except exceptions.DoesNotExist:
+        raise HTTPException(status_code=404, detail="Account not found")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    else:
+        return TransferReadSchema(balance=balance, **data.dict())
+
+
 @app.patch(
     "/accounts/{id}/block",
     response_model=AccountReadSchema,
     responses={
         404: {"model": Detail},
+        409: {"model": Detail},
         205: {
             "content": None,
             "description": "Set the status account as 'inactive'",
@@ -270,12 +930,16 @@ def account_withdraw(
     },
     status_code=205,
 )
-def account_block(id: int, uow=Depends(get_uow_instance)):
+async def account_block(id: int, uow=Depends(get_uow_instance)):
     """Set the status account as 'inactive'"""
     try:
-        account = get_commands(uow)["account_block"](id)
+        account = await command_bus.dispatch(AsyncAccountBlockCommand, uow, id)
     except exceptions.DoesNotExist:
         raise HTTPException(status_code=404, detail="Account not found")
+    except exceptions.ConcurrentModification:
+        raise HTTPException(
+            status_code=409, detail="The account was changed by another request"
+        )
     except ValueError as e:
         raise HTTPException(status_code=422, detail=str(e))
     else:
@@ -284,22 +948,222 @@ def account_block(id: int, uow=Depends(get_uow_instance)):
 
 @app.get(
     "/accounts/{id}/transactions",
-    response_model=List[AccountTransactionsSchema],
+    response_model=AccountTransactionsPageSchema,
     responses={
         404: {"model": Detail},
+        422: {"model": Detail},
     },
 )
-def account_transactions(
+async def account_transactions(
+    id: int,
+    since: Optional[datetime] = datetime_last_30_days(),
+    until: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    uow=Depends(get_uow_instance),
+):
+    """Lists a page of the account transactions. The `next` cursor of the
+    response is used to read the following page"""
+
+    try:
+        transactions, next_cursor = await command_bus.dispatch(
+            AsyncAccountTransactionsPageCommand, uow, id, since, until, limit, cursor
+        )
+    except exceptions.DoesNotExist:
+        raise HTTPException(status_code=404, detail="Account not found")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    else:
+        return {"transactions": transactions, "next": next_cursor}
+
+
+@app.get(
+    "/accounts/{id}/transactions/summary",
+    response_model=AccountTransactionsSummarySchema,
+    responses={404: {"model": Detail}},
+)
+async def account_transactions_summary(
     id: int,
     since: Optional[datetime] = datetime_last_30_days(),
     until: Optional[datetime] = None,
     uow=Depends(get_uow_instance),
 ):
-    command = get_commands(uow)["account_transactions"]
+    """Sums up the account transactions: the totals, counts and tickets by
+    type, the net flow and the balance at the end of each day"""
 
     try:
-        transactions = command(id, since, until)
+        summary = await command_bus.dispatch(
+            AsyncAccountTransactionsSummaryCommand, uow, id, since, until
+        )
     except exceptions.DoesNotExist:
         raise HTTPException(status_code=404, detail="Account not found")
     else:
-        return transactions
+        return summary
+
+
+@app.get(
+    "/accounts/{id}/transactions/export",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "content": {media_type: {} for media_type in EXPORT_MEDIA_TYPES.values()}
+        },
+        404: {"model": Detail},
+        422: {"model": Detail},
+    },
+)
+async def account_transactions_export(
+    id: int,
+    since: Optional[datetime] = datetime_last_30_days(),
+    until: Optional[datetime] = None,
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    gzip: bool = False,
+    uow=Depends(get_uow_instance),
+):
+    """Exports all the account transactions as NDJSON or CSV. The
+    transactions are streamed while they are read from the database"""
+
+    try:
+        chunks = await command_bus.dispatch(
+            AsyncAccountTransactionsExportCommand, uow, id, since, until, format, gzip
+        )
+    except exceptions.DoesNotExist:
+        raise HTTPException(status_code=404, detail="Account not found")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    headers = {
+        "Content-Disposition": 'attachment; filename="transactions-%s.%s"'
+        % (id, format)
+    }
+
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+
+    return StreamingResponse(
+        chunks, media_type=EXPORT_MEDIA_TYPES[format], headers=headers
+    )
+
+
+@app.get("/metrics/pool", response_model=PoolMetricsSchema, tags=["metrics"])
+def pool_metrics_detail():
+    """Shows the database connection pool usage"""
+    return pool_metrics.snapshot()
+
+
+@app.get(
+    "/metrics/commands",
+    response_model=Dict[str, CommandMetricsSchema],
+    tags=["metrics"],
+)
+def command_metrics_detail():
+    """Shows the latency of the commands run by the endpoints, with the
+    percentiles estimated from the histogram buckets"""
+
+    return command_latency.snapshot()
+
+
+@app.get(
+    "/metrics/outbox",
+    response_model=OutboxMetricsSchema,
+    responses={404: {"model": Detail}},
+    tags=["metrics"],
+)
+def outbox_metrics_detail():
+    """Shows the delivery of the outbox events: the age of the oldest event
+    of the last batch, the events delivered per second in the last minute
+    and the percentiles of the time the events waited in the outbox"""
+
+    if not settings.outbox_enabled:
+        raise HTTPException(status_code=404, detail="The outbox is disabled")
+
+    return outbox_dispatcher.snapshot()
+
+
+@app.get(
+    "/metrics/cache",
+    response_model=CacheMetricsSchema,
+    responses={404: {"model": Detail}},
+    tags=["metrics"],
+)
+def cache_metrics_detail():
+    """Shows the account cache usage"""
+
+    if account_cache is None:
+        raise HTTPException(status_code=404, detail="The account cache is disabled")
+
+    return account_cache.snapshot()
+
+
+@app.get("/metrics", response_class=Response, tags=["metrics"])
+def prometheus_metrics():
+    """Exposes the time of each phase of the requests by route, the latency
+    of the commands, the connection pool usage and the outbox delivery in
+    the Prometheus text format"""
+
+    lines = prometheus_histogram(
+        "banking_request_phase_seconds",
+        "Time of each phase of the requests, and their total, by route.",
+        [
+            (dict(zip(("method", "route"), label.split(" ", 1)), phase=phase), value)
+            for phase, histograms in request_latency.items()
+            for label, value in histograms.items()
+        ],
+    )
+    lines += prometheus_histogram(
+        "banking_command_seconds",
+        "Latency of the commands run by the endpoints.",
+        [({"command": label}, value) for label, value in command_latency.items()],
+    )
+
+    pool = pool_metrics.snapshot()
+    lines += prometheus_metric(
+        "banking_pool_connections",
+        "Connections of the pool by state.",
+        "gauge",
+        [({"state": state}, pool[state]) for state in ("in_use", "idle")],
+    )
+    lines += prometheus_metric(
+        "banking_pool_size",
+        "Connections kept open by the pool.",
+        "gauge",
+        [({}, pool["size"])],
+    )
+
+    for name, key, help in (
+        ("checkouts", "checkouts", "Connections checked out of the pool."),
+        ("connects", "connects", "Connections opened by the pool."),
+        ("invalidations", "invalidations", "Connections invalidated by the pool."),
+        ("wait_seconds", "wait_seconds_total", "Time waited for a connection."),
+    ):
+        lines += prometheus_metric(
+            "banking_pool_%s_total" % name, help, "counter", [({}, pool[key])]
+        )
+
+    if settings.outbox_enabled:
+        outbox = outbox_dispatcher.snapshot()
+        lines += prometheus_metric(
+            "banking_outbox_delivered_total",
+            "Events delivered from the outbox.",
+            "counter",
+            [({}, outbox["delivered"])],
+        )
+        lines += prometheus_metric(
+            "banking_outbox_failures_total",
+            "Batches of the outbox which failed to be delivered.",
+            "counter",
+            [({}, outbox["failures"])],
+        )
+        lines += prometheus_metric(
+            "banking_outbox_lag_seconds",
+            "Age of the oldest event of the last batch delivered.",
+            "gauge",
+            [({}, outbox["lag_seconds"])],
+        )
+        lines += prometheus_histogram(
+            "banking_outbox_delivery_lag_seconds",
+            "Time the events waited in the outbox.",
+            [({}, outbox_dispatcher.delivery_lag)],
+        )
+
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
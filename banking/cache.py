@@ -0,0 +1,344 @@
+import logging
+import select
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, List
+
+from sqlalchemy import func
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LocalInvalidationChannel:
+    """Delivers the invalidated account ids to the caches of this process"""
+
+    # Whether the invalidations published are received, the caches are
+    # bypassed while they are not
+    listening = True
+    failures = 0
+
+    def __init__(self):
+        self._subscribers: List[Callable[[Iterable[int]], None]] = []
+        self._resets: List[Callable[[], None]] = []
+
+    def subscribe(
+        self,
+        callback: Callable[[Iterable[int]], None],
+        reset: Callable[[], None] = None,
+    ) -> None:
+        """Calls `callback` with the ids invalidated, and `reset` when the
+        invalidations published for a while may have been missed"""
+
+        self._subscribers.append(callback)
+
+        if reset is not None:
+            self._resets.append(reset)
+
+    def publish(self, ids: Iterable[int]) -> None:
+        for callback in self._subscribers:
+            callback(ids)
+
+    def publish_in(self, connection, ids: Iterable[int]) -> bool:
+        """Publishes the ids in the transaction of the `connection`, so they
+        are only delivered if it commits. Returns False when the channel
+        can not, the ids are then published after the commit"""
+
+        return False
+
+    def _reset(self) -> None:
+        for reset in self._resets:
+            reset()
+
+    def start(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class PostgresInvalidationChannel(LocalInvalidationChannel):
+    """Delivers the invalidated account ids to the caches of every process
+    connected to the PostgreSQL database with LISTEN/NOTIFY.
+
+    The ids are published with `pg_notify`, in the transaction which
+    changed the accounts when possible, and a background thread listens to
+    the `channel` in a dedicated connection, handing the ids received to
+    the subscribers of this process. When the connection fails the caches
+    are bypassed and the thread reconnects every `timeout` seconds, the
+    caches are then emptied, the invalidations in between were lost."""
+
+    # The NOTIFY payload must be shorter than 8000 bytes
+    max_payload = 7000
+
+    def __init__(self, engine, channel: str = "account_changes", timeout=1.0):
+        super().__init__()
+        self.engine = engine
+        self.channel = channel
+        self.timeout = timeout
+        self.listening = False
+        self.failures = 0
+        self._running = False
+        self._thread = None
+
+    def publish(self, ids: Iterable[int]) -> None:
+        with self.engine.begin() as connection:
+            self.publish_in(connection, ids)
+
+    def publish_in(self, connection, ids: Iterable[int]) -> bool:
+        for payload in self._payloads(ids):
+            connection.execute(func.pg_notify(self.channel, payload))
+
+        return True
+
+    def _payloads(self, ids: Iterable[int]) -> Iterable[str]:
+        payload = []
+        size = 0
+
+        for id in map(str, ids):
+            if size + len(id) >= self.max_payload:
+                yield ",".join(payload)
+                payload, size = [], 0
+
+            payload.append(id)
+            size += len(id) + 1
+
+        if payload:
+            yield ",".join(payload)
+
+    def start(self) -> None:
+        connection = self._connect()
+        self.listening = True
+
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._listen,
+            args=(connection,),
+            name="cache-invalidation",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def close(self) -> None:
+        self._running = False
+
+        if self._thread is not None:
+            self._thread.join()
+
+    def _connect(self):
+        connection = self.engine.raw_connection()
+        connection.detach()
+        connection.connection.autocommit = True
+        connection.cursor().execute('LISTEN "%s"' % self.channel)
+        return connection.connection
+
+    def _listen(self, connection) -> None:
+        while self._running:
+            if connection is None:
+                try:
+                    connection = self._connect()
+                except Exception:
+                    LOGGER.exception("The cache invalidation listener can not connect")
+                    time.sleep(self.timeout)
+                    continue
+
+                self._reset()
+                self.listening = True
+                LOGGER.info("The cache invalidation listener is connected again")
+
+            try:
+                self._receive(connection)
+            except Exception:
+                self.listening = False
+                self.failures += 1
+                LOGGER.exception(
+                    "The cache invalidation listener failed, the account cache"
+                    " is bypassed until it reconnects"
+                )
+                connection.close()
+                connection = None
+
+        self.listening = False
+
+        if connection is not None:
+            connection.close()
+
+    def _receive(self, connection) -> None:
+        if select.select([connection], [], [], self.timeout) == ([], [], []):
+            return
+
+        connection.poll()
+
+        while connection.notifies:
+            notify = connection.notifies.pop(0)
+            ids = [int(id) for id in notify.payload.split(",") if id]
+            super().publish(ids)
+
+
+class LRUCache:
+    """Keeps at most `max_size` values in memory for `ttl` seconds.
+
+    The least recently used value is evicted when it is full. Hits, misses
+    and evictions are counted."""
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value or None"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] <= self.clock():
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value) -> None:
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, keys: Iterable) -> None:
+        """Drops the values of the keys"""
+
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class AccountCache(LRUCache):
+    """Keeps recently read accounts in memory.
+
+    The ids invalidated by `invalidate` are dropped here and published in
+    the `channel`, so the caches of the other processes drop them too.
+
+    An account read before its invalidation is not stored after it, so a
+    read racing with a write can not put back the old account."""
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl: float = 5.0,
+        channel: LocalInvalidationChannel = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__(max_size, ttl, clock)
+        self.channel = channel or LocalInvalidationChannel()
+        self.generation = 0
+        self._discarded = OrderedDict()
+        self._oldest_discard = 0
+        self.channel.subscribe(self.discard, self.clear)
+
+    def get(self, id: int):
+        """Returns the cached account or None, always None while the channel
+        does not receive the invalidations"""
+
+        if not self.channel.listening:
+            with self._lock:
+                self.misses += 1
+
+            return None
+
+        return super().get(id)
+
+    def put(self, id: int, account, generation: int) -> None:
+        """Stores the account read when the cache was in `generation`"""
+
+        with self._lock:
+            if self._discarded.get(id, self._oldest_discard) > generation:
+                return
+
+            self._put(id, account)
+
+    def discard(self, ids: Iterable[int]) -> None:
+        """Drops the accounts from this cache only"""
+
+        with self._lock:
+            self.generation += 1
+
+            for id in ids:
+                if self._entries.pop(id, None) is not None:
+                    self.invalidations += 1
+
+                self._discarded[id] = self.generation
+                self._discarded.move_to_end(id)
+
+            # Forgets the oldest discards, the ids without one are compared
+            # with the most recent discard forgotten
+            while len(self._discarded) > self.max_size:
+                _, self._oldest_discard = self._discarded.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drops every account, and does not store the accounts read before"""
+
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._discarded.clear()
+            self._oldest_discard = self.generation
+
+    def publish_in(self, connection, ids: Iterable[int]) -> bool:
+        """Publishes the invalidation of the accounts in the transaction of
+        the `connection`, so the other caches only drop them if it commits.
+        Returns False when the channel can not, see `invalidate`"""
+
+        return self.channel.publish_in(connection, ids)
+
+    def invalidate(self, ids: Iterable[int], published: bool = False) -> None:
+        """Drops the accounts from this cache and from the caches which
+        share its channel, unless `publish_in` published them already"""
+
+        ids = list(ids)
+        self.discard(ids)
+
+        if published:
+            return
+
+        try:
+            self.channel.publish(ids)
+        except Exception:
+            LOGGER.exception("Could not publish the invalidation of %s", ids)
+
+    def snapshot(self) -> dict:
+        snapshot = super().snapshot()
+        snapshot["listening"] = self.channel.listening
+        snapshot["listener_failures"] = self.channel.failures
+        return snapshot
@@ -1,10 +1,11 @@
 import enum
+import re
 from decimal import Decimal
-from decimal import InvalidOperation as DecimalException
+from fractions import Fraction
 
-from typing import List
+from typing import List, NamedTuple, Union
 
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from dataclasses import dataclass
 
 
@@ -27,13 +28,176 @@ class TransactionTypeEnum(str, enum.Enum):
     withdraw = "withdraw"
 
 
+class AccountEventTypeEnum(str, enum.Enum):
+    deposit = "deposit"
+    withdraw = "withdraw"
+    block = "block"
+    unblock = "unblock"
+
+
+class Money:
+    """Amount of money held as an integer number of cents.
+
+    The arithmetic is integer arithmetic, so it is exact and cheap. An
+    amount compares equal to the int or Decimal with the same value and it
+    is added to or subtracted from them when they have no fraction of a
+    cent. Use `parse` to read the amounts sent by the clients."""
+
+    __slots__ = ("cents",)
+
+    _pattern = re.compile(r"([+-]?)(\d+)(?:\.(\d{1,2}))?")
+
+    def __init__(self, cents: int = 0):
+        self.cents = cents
+
+    @classmethod
+    def parse(cls, value: Union[str, int, float, Decimal, "Money"]) -> "Money":
+        """Reads an amount with at most two decimal places.
+
+        Raises ValueError for anything else, exponents, NaN, infinities and
+        fractions of a cent included."""
+
+        if isinstance(value, Money):
+            return value
+        elif isinstance(value, int) and not isinstance(value, bool):
+            return cls(value * 100)
+        elif isinstance(value, float):
+            value = repr(value)
+        elif isinstance(value, Decimal):
+            if value.is_finite():
+                cents = value.scaleb(2)
+
+                if cents == cents.to_integral_value():
+                    return cls(int(cents))
+
+            raise ValueError("The amount '%s' is not valid" % value)
+
+        match = cls._pattern.fullmatch(value) if isinstance(value, str) else None
+
+        if match is None:
+            raise ValueError("The amount '%s' is not valid" % value)
+
+        sign, units, fraction = match.groups()
+        cents = int(units) * 100 + int((fraction or "0").ljust(2, "0"))
+        return cls(-cents if sign == "-" else cents)
+
+    @classmethod
+    def __get_validators__(cls):
+        """Lets the pydantic models read Money fields with `parse`"""
+
+        yield cls.parse
+
+    @classmethod
+    def __modify_schema__(cls, field_schema: dict) -> None:
+        # Read from numbers or strings, written as strings, see `format`
+        field_schema.update(
+            anyOf=[
+                {"type": "string", "pattern": "^%s$" % cls._pattern.pattern},
+                {"type": "number", "multipleOf": 0.01},
+            ]
+        )
+
+    def to_decimal(self) -> Decimal:
+        return Decimal(self.cents).scaleb(-2)
+
+    def format(self) -> str:
+        """Formats the amount with exactly two decimal places from its
+        integer cents, e.g. '-1.50'"""
+
+        units, cents = divmod(abs(self.cents), 100)
+        return "%s%d.%02d" % ("-" if self.cents < 0 else "", units, cents)
+
+    __str__ = format
+
+    def __repr__(self) -> str:
+        return "Money('%s')" % self
+
+    def __float__(self) -> float:
+        return self.cents / 100
+
+    def __bool__(self) -> bool:
+        return self.cents != 0
+
+    def __hash__(self) -> int:
+        # Equal to the hash of the int or Decimal with the same value
+        if self.cents % 100 == 0:
+            return hash(self.cents // 100)
+
+        return hash(Fraction(self.cents, 100))
+
+    @staticmethod
+    def _cents(other) -> int:
+        if type(other) is Money:
+            return other.cents
+        elif isinstance(other, (int, Decimal)) and not isinstance(other, bool):
+            return Money.parse(other).cents
+
+        return NotImplemented
+
+    def _compare(self, other):
+        if type(other) is Money:
+            return self.cents - other.cents
+        elif isinstance(other, Decimal) and other.is_finite():
+            return self.to_decimal() - other
+        elif isinstance(other, int) and not isinstance(other, bool):
+            return self.cents - other * 100
+
+        return NotImplemented
+
+    def __eq__(self, other):
+        difference = self._compare(other)
+        return difference if difference is NotImplemented else difference == 0
+
+    def __lt__(self, other):
+        difference = self._compare(other)
+        return difference if difference is NotImplemented else difference < 0
+
+    def __le__(self, other):
+        difference = self._compare(other)
+        return difference if difference is NotImplemented else difference <= 0
+
+    def __gt__(self, other):
+        difference = self._compare(other)
+        return difference if difference is NotImplemented else difference > 0
+
+    def __ge__(self, other):
+        difference = self._compare(other)
+        return difference if difference is NotImplemented else difference >= 0
+
+    def __add__(self, other):
+        if type(other) is Money:
+            return Money(self.cents + other.cents)
+
+        cents = self._cents(other)
+        return cents if cents is NotImplemented else Money(self.cents + cents)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if type(other) is Money:
+            return Money(self.cents - other.cents)
+
+        cents = self._cents(other)
+        return cents if cents is NotImplemented else Money(self.cents - cents)
+
+    def __rsub__(self, other):
+        cents = self._cents(other)
+        return cents if cents is NotImplemented else Money(cents - self.cents)
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __abs__(self):
+        return Money(abs(self.cents))
+
+
 @dataclass
 class Transaction:
     """Responsible to hold informations about a account transaction"""
 
     id: int = None
     account_id: int = None
-    value: Decimal = None
+    value: Money = None
     type: TransactionTypeEnum = None
     created_at: datetime = None
 
@@ -44,18 +208,164 @@ class Transaction:
         )
 
 
+class TransactionRow(NamedTuple):
+    """Read-only copy of a transaction returned by the listing queries.
+
+    The mapped classes keep their state in the instance `__dict__`, which
+    the mappers need, so they can not use `__slots__`. The rows are plain
+    tuples, smaller and faster to build, and are not tracked by a session."""
+
+    id: int
+    account_id: int
+    value: Money
+    type: TransactionTypeEnum
+    created_at: datetime
+
+
+@dataclass
+class BalanceCheckpoint:
+    """Holds the balance of an account at the end of a day"""
+
+    account_id: int = None
+    day: date = None
+    balance: Money = None
+
+
+@dataclass
+class AccountSnapshot:
+    """Holds the balance of an account after its transactions up to the
+    `transaction_id`, the event-sourced accounts replay only the later ones"""
+
+    account_id: int = None
+    transaction_id: int = None
+    balance: Money = None
+    created_at: datetime = None
+
+
+@dataclass
+class OutboxEvent:
+    """Tells other systems about a change of an account, it waits in the
+    outbox until it is delivered"""
+
+    id: int = None
+    type: AccountEventTypeEnum = None
+    account_id: int = None
+    value: Money = None
+    created_at: datetime = None
+
+
+@dataclass
+class IdempotencyKey:
+    """Remembers the result of a request sent with an Idempotency-Key"""
+
+    key: str = None
+    request: str = None
+    balance: Money = None
+    created_at: datetime = None
+
+
+@dataclass
+class TransactionsTotal:
+    """Sums up the transactions of one type in a period"""
+
+    count: int
+    total: Money
+    min: Money = None
+    max: Money = None
+    mean: Money = None
+
+
+@dataclass
+class DailyBalance:
+    """Holds the net flow of a day and the balance at its end"""
+
+    day: date
+    net_flow: Money
+    balance: Money
+
+
+@dataclass
+class TransactionsSummary:
+    """Sums up the transactions of an account in a period"""
+
+    opening_balance: Money
+    closing_balance: Money
+    net_flow: Money
+    deposits: TransactionsTotal
+    withdraws: TransactionsTotal
+    days: List[DailyBalance]
+
+
+@dataclass(frozen=True)
+class WithdrawalCalendar:
+    """Tells the day a withdraw counts for in the daily withdrawal limit.
+
+    The day starts at `rollover_hour` in the timezone `utc_offset` minutes
+    away from UTC, so a bank may reset the limits at 03:00 in UTC-03:00."""
+
+    utc_offset: int = 0
+    rollover_hour: int = 0
+
+    def day(self, moment: datetime = None) -> date:
+        """Returns the day of the naive UTC `moment`, by default now"""
+
+        moment = datetime.utcnow() if moment is None else moment
+        return (
+            moment + timedelta(minutes=self.utc_offset, hours=-self.rollover_hour)
+        ).date()
+
+
+@dataclass(frozen=True)
+class MaintenanceFee:
+    """Charges the `fee` from the accounts as a withdraw. An account with a
+    smaller balance is charged its whole balance."""
+
+    fee: Money
+    type = TransactionTypeEnum.withdraw
+
+    def amount(self, balance: Money) -> Money:
+        return min(balance, self.fee)
+
+
+@dataclass(frozen=True)
+class Interest:
+    """Pays the interest `rate` over the balance of the accounts as a
+    deposit, rounded down to the cent"""
+
+    rate: Decimal
+    type = TransactionTypeEnum.deposit
+
+    def amount(self, balance: Money) -> Money:
+        rate = Fraction(self.rate)
+        return Money(max(balance.cents, 0) * rate.numerator // rate.denominator)
+
+
+@dataclass
+class BatchJobChunk:
+    """Records the accounts with ids from `first_id` to `last_id` as done
+    by the `job` run and how many of them were posted"""
+
+    job: str = None
+    first_id: int = None
+    last_id: int = None
+    accounts: int = None
+    finished_at: datetime = None
+
+
 class Account:
     """Responsible to manage operations over the application"""
 
     def __init__(
         self,
         id: int,
-        balance: Decimal,
-        daily_withdrawal_limit: Decimal,
+        balance: Money,
+        daily_withdrawal_limit: Money,
         active: bool,
         type: bool,
         person_id: int,
         transactions: List[Transaction] = None,
+        withdrawn_today: Money = Money(0),
+        withdrawal_day: date = None,
     ):
         self.id = id
         self.balance = balance
@@ -64,13 +374,15 @@ class Account:
         self.type = type
         self.person_id: int = person_id
         self.transactions = [] if transactions is None else transactions
+        self.withdrawn_today = withdrawn_today
+        self.withdrawal_day = withdrawal_day
 
     @staticmethod
     def new():
         return Account(
             id=None,
-            balance=Decimal("0.00"),
-            daily_withdrawal_limit=Decimal("1000.00"),
+            balance=Money(0),
+            daily_withdrawal_limit=Money(100000),
             active=True,
             type=1,
             person_id=None,
@@ -93,54 +405,90 @@ class Account:
 
         self.transactions.append(t)
 
-    def deposit(self, value: str) -> None:
-        """Adds an amout to the account balance.
+    @staticmethod
+    def deposit_amount(value: str) -> Money:
+        """Validates and returns the amount of a deposit.
+
         It does some minimal validations related to business model like the
         signal of number or if the value interfaces is a number"""
 
         try:
-            _value = Decimal(str(value))
-        except (ValueError, DecimalException):
+            _value = Money.parse(value)
+        except ValueError:
             raise ValueError(
                 "Could not deposit the amount '%s' because it isn't"
                 " a valid value" % value
             ) from None
-        else:
-            if _value <= 0:
-                raise ValueError(
-                    "Could not deposit the value '%s'. "
-                    "Only positive values are accepted" % _value
-                )
-            self.balance = self.balance + _value
-
-    def withdraw(self, value: str) -> None:
-        """Withdraw an amount from the account balance.
 
-        It does some minimal validations related to the business model like the
-        value interfaces or amount of money withdrawn. Only business model
-        validations should be puted here."""
+        if _value <= 0:
+            raise ValueError(
+                "Could not deposit the value '%s'. "
+                "Only positive values are accepted" % value
+            )
+
+        return _value
+
+    @staticmethod
+    def withdraw_amount(value: str) -> Money:
+        """Validates and returns the amount of a withdraw.
+
+        The balance is not verified here, it is a rule over the account
+        state and it is done by the `withdraw` method."""
 
         try:
-            _value = Decimal(str(value))
-        except (ValueError, DecimalException):
+            _value = Money.parse(value)
+        except ValueError:
             raise ValueError(
                 "Could not withdraw the amount '%s' because it isn't"
                 " a valid value" % value
             ) from None
 
+        if _value == 0:
+            raise ValueError("Could not withdraw an amout of zero from the account")
+        elif _value < 0:
+            raise ValueError(
+                "Could not withdraw the value '%s'. Only positive "
+                "values are accepted" % value
+            )
+
+        return _value
+
+    def deposit(self, value: str) -> None:
+        """Adds an amout to the account balance.
+        It does some minimal validations related to business model like the
+        signal of number or if the value interfaces is a number"""
+
+        self.balance = self.balance + self.deposit_amount(value)
+
+    def withdraw(self, value: str, day: date = None) -> None:
+        """Withdraw an amount from the account balance.
+
+        It does some minimal validations related to the business model like the
+        value interfaces or amount of money withdrawn. Only business model
+        validations should be puted here.
+
+        The amount withdrawn in the `day`, by default the current UTC day, is
+        kept in a running counter checked against the daily withdrawal limit.
+        The counter starts from zero when the day changes."""
+
+        _value = self.withdraw_amount(value)
         new_balance = self.balance - _value
 
         if new_balance < 0:
             raise ValueError(
                 "The account balance is insufficient "
-                "to withdraw the '%s' ammount" % _value
+                "to withdraw the '%s' ammount" % value
             ) from None
-        elif _value == 0:
-            raise ValueError("Could not withdraw an amout of zero from the account")
-        elif _value < 0:
+
+        day = WithdrawalCalendar().day() if day is None else day
+        withdrawn = self.withdrawn_today if self.withdrawal_day == day else 0
+
+        if withdrawn + _value > self.daily_withdrawal_limit:
             raise ValueError(
-                "Could not withdraw the value '%s'. Only positive "
-                "values are accepted" % _value
+                "The daily withdrawal limit of the account does not "
+                "allow to withdraw the '%s' ammount" % value
             )
-        else:
-            self.balance = new_balance
+
+        self.balance = new_balance
+        self.withdrawn_today = withdrawn + _value
+        self.withdrawal_day = day
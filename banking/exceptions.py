@@ -1,4 +1,11 @@
 class DoesNotExist(Exception):
     """Should be raised when an entity is not found in a datastore.
     
-    This exception is not recoverable."""
\ No newline at end of file
+    This exception is not recoverable."""
+
+
+class ConcurrentModification(Exception):
+    """Should be raised when an entity was changed by another transaction
+    after it was loaded.
+
+    This exception is recoverable, the operation can be retried."""
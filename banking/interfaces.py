@@ -19,9 +19,19 @@ class AbstractUnitOfWork(abc.ABC):
 
     The concrete class must know how the methods should work."""
 
+    read_only = False
+
     def __enter__(self):
         return self
 
+    def for_reading(self) -> "AbstractUnitOfWork":
+        """Returns the unit of work used by read-only commands.
+
+        The concrete class may route it to a read replica, by default it
+        is the same unit of work."""
+
+        return self
+
     @abc.abstractmethod
     def __exit__(self, exc_type, exc, exc_tb) -> None:
         raise NotImplementedError
@@ -47,4 +57,29 @@ class AbstractUnitOfWork(abc.ABC):
     @property
     @abc.abstractmethod
     def people(self) -> AbstractRepository:
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+    @property
+    @abc.abstractmethod
+    def checkpoints(self) -> AbstractRepository:
+        raise NotImplementedError
+
+    @property
+    @abc.abstractmethod
+    def snapshots(self) -> AbstractRepository:
+        raise NotImplementedError
+
+    @property
+    @abc.abstractmethod
+    def outbox(self) -> AbstractRepository:
+        raise NotImplementedError
+
+    @property
+    @abc.abstractmethod
+    def idempotency_keys(self) -> AbstractRepository:
+        raise NotImplementedError
+
+    @property
+    @abc.abstractmethod
+    def batch_jobs(self) -> AbstractRepository:
+        raise NotImplementedError
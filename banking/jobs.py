@@ -0,0 +1,453 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import List, Tuple, Union
+
+from banking import domain
+from banking.interfaces import AbstractUnitOfWork
+from banking.outbox import FileSink, OutboxDispatcher
+
+LOGGER = logging.getLogger(__name__)
+
+Posting = Union[domain.MaintenanceFee, domain.Interest]
+
+# The unit of work of a posting worker process, see `posting_workers`
+_worker_unit_of_work = None
+
+
+def backfill_balance_checkpoints(
+    unit_of_work: AbstractUnitOfWork, batch_size: int = 500, until: date = None
+) -> int:
+    """Recomputes the balance checkpoints of all the accounts for the days
+    before `until`, today by default.
+
+    The accounts are processed `batch_size` at a time, each batch in its
+    own transaction. The checkpoints of `until` on are kept up to date by
+    the commands. Returns the number of checkpoints written."""
+
+    until = until or datetime.utcnow().date()
+    last_id = 0
+    written = 0
+
+    while True:
+        with unit_of_work as uow:
+            ids = uow.accounts.ids_after(last_id, batch_size)
+
+            if not ids:
+                break
+
+            written += uow.checkpoints.backfill(ids, until)
+
+        last_id = ids[-1]
+        LOGGER.info("Balance checkpoints written up to the account %d", last_id)
+
+    return written
+
+
+def purge_idempotency_keys(
+    unit_of_work: AbstractUnitOfWork, ttl: timedelta, batch_size: int = 1000
+) -> int:
+    """Deletes the idempotency keys older than `ttl`.
+
+    The keys are deleted `batch_size` at a time, each batch in its own
+    short transaction, so the purge does not hold locks for long. Returns
+    the number of keys deleted."""
+
+    before = datetime.utcnow() - ttl
+    deleted = 0
+
+    while True:
+        with unit_of_work as uow:
+            count = uow.idempotency_keys.purge(before, batch_size)
+
+        deleted += count
+
+        if count < batch_size:
+            return deleted
+
+
+def compact_account_snapshots(
+    unit_of_work: AbstractUnitOfWork,
+    every: int = 100,
+    chunk_size: int = 1000,
+) -> int:
+    """Snapshots the event-sourced accounts with at least `every`
+    transactions after their last snapshot.
+
+    The account ids are walked in ranges of `chunk_size` ids, each in its
+    own transaction. The accounts with transactions running are left for
+    the next run, see `AccountSnapshotRepository.compact`. Returns the
+    number of snapshots written."""
+
+    written = 0
+
+    with unit_of_work as uow:
+        last_id = uow.accounts.last_id()
+
+    for first_id in range(1, last_id + 1, chunk_size):
+        with unit_of_work as uow:
+            written += uow.snapshots.compact(first_id, first_id + chunk_size - 1, every)
+
+    return written
+
+
+@dataclass
+class BatchJobReport:
+    """Tells how many chunks and accounts a batch job run processed"""
+
+    job: str
+    chunks: int
+    accounts: int
+    seconds: float
+
+    @property
+    def accounts_per_second(self) -> float:
+        return self.accounts / self.seconds if self.seconds else 0.0
+
+
+def post_chunk(
+    unit_of_work: AbstractUnitOfWork,
+    job: str,
+    posting: Posting,
+    first_id: int,
+    last_id: int,
+) -> int:
+    """Applies the posting to the accounts with ids from `first_id` to
+    `last_id` and records the chunk as done by the `job` run, both in the
+    same transaction.
+
+    Returns the number of accounts posted, zero when the chunk was done
+    already. Raises RuntimeError when the transaction did not commit."""
+
+    with unit_of_work as uow:
+        if not uow.batch_jobs.claim(job, first_id, last_id):
+            return 0
+
+        posted = uow.accounts.apply_posting(posting, first_id, last_id)
+        uow.batch_jobs.complete(job, first_id, posted)
+
+    # The unit of work logs the errors of the commit without raising them,
+    # so the chunk is only counted once its record is read back
+    with unit_of_work as uow:
+        if uow.batch_jobs.posted(job, first_id) != posted:
+            raise RuntimeError(
+                "Job %s: the chunk %d-%d was not committed" % (job, first_id, last_id)
+            )
+
+    return posted
+
+
+def pending_chunks(
+    last_id: int, chunk_size: int, finished: List[Tuple[int, int]]
+) -> List[Tuple[int, int]]:
+    """Splits the account ids up to `last_id` not covered by the `finished`
+    ranges, ordered by their first id, in ranges of `chunk_size` ids at
+    most.
+
+    A chunk ends before the next finished range, so a run resumed with a
+    chunk size other than the one of the stopped run does not post twice
+    to an account."""
+
+    chunks = []
+    first_id = 1
+
+    for done_first_id, done_last_id in finished + [(last_id + 1, None)]:
+        for chunk_first_id in range(first_id, done_first_id, chunk_size):
+            chunk_last_id = chunk_first_id + chunk_size - 1
+
+            if done_last_id is not None:
+                chunk_last_id = min(chunk_last_id, done_first_id - 1)
+
+            chunks.append((chunk_first_id, chunk_last_id))
+
+        if done_last_id is not None:
+            first_id = max(first_id, done_last_id + 1)
+
+    return chunks
+
+
+def run_postings(
+    unit_of_work: AbstractUnitOfWork,
+    job: str,
+    posting: Posting,
+    chunk_size: int = 1000,
+    executor: Executor = None,
+) -> BatchJobReport:
+    """Applies the posting to every account, a `domain.MaintenanceFee` or
+    `domain.Interest`, as the run named `job`.
+
+    The account ids are split in ranges of `chunk_size` ids, each posted
+    in its own transaction. The chunks are handed to the `executor`, e.g.
+    the process pool of `posting_workers`, or posted one after the other
+    in this process when there is none. The chunks done by the run are
+    recorded, so running the same `job` again resumes a run which stopped
+    and posts nothing to the accounts posted before, even with another
+    `chunk_size`."""
+
+    started = time.perf_counter()
+
+    with unit_of_work as uow:
+        last_id = uow.accounts.last_id()
+        finished = uow.batch_jobs.finished(job)
+
+    chunks = pending_chunks(last_id, chunk_size, finished)
+    LOGGER.info(
+        "Job %s: %d chunks to post, %d done before", job, len(chunks), len(finished)
+    )
+
+    if executor is None:
+        results = (post_chunk(unit_of_work, job, posting, *chunk) for chunk in chunks)
+    else:
+        results = (
+            future.result()
+            for future in as_completed(
+                [
+                    executor.submit(_post_chunk_in_worker, job, posting, *chunk)
+                    for chunk in chunks
+                ]
+            )
+        )
+
+    accounts = 0
+
+    for done, posted in enumerate(results, start=1):
+        accounts += posted
+        LOGGER.info(
+            "Job %s: %d/%d chunks posted, %d accounts in %.1fs",
+            job,
+            done,
+            len(chunks),
+            accounts,
+            time.perf_counter() - started,
+        )
+
+    return BatchJobReport(
+        job=job,
+        chunks=len(chunks),
+        accounts=accounts,
+        seconds=time.perf_counter() - started,
+    )
+
+
+def posting_workers(
+    database_url: str,
+    workers: int = None,
+    money_column_type: str = "numeric",
+    partitioned: bool = False,
+    cache_channel: str = "local",
+    event_sourced: bool = False,
+    publish_events: bool = False,
+) -> ProcessPoolExecutor:
+    """Creates the process pool used by `run_postings`, `workers` processes
+    or one per CPU.
+
+    Every process opens its own engine to the database. When the API
+    caches the accounts with the "postgresql" `cache_channel`, the workers
+    publish the accounts they post so the API workers drop them. With
+    `publish_events` the postings are written to the outbox."""
+
+    return ProcessPoolExecutor(
+        max_workers=workers or os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_start_worker,
+        initargs=(
+            database_url,
+            money_column_type,
+            partitioned,
+            cache_channel,
+            event_sourced,
+            publish_events,
+        ),
+    )
+
+
+def _start_worker(
+    database_url: str,
+    money_column_type: str,
+    partitioned: bool,
+    cache_channel: str,
+    event_sourced: bool,
+    publish_events: bool,
+) -> None:
+    from sqlalchemy import create_engine
+
+    from banking.adapters import (
+        MONEY_TYPES,
+        SqlSessionFactory,
+        SqlUnitOfWork,
+        sqlalchemy_schema,
+        start_mappers,
+    )
+    from banking.cache import AccountCache, PostgresInvalidationChannel
+
+    global _worker_unit_of_work
+
+    logging.basicConfig(level=logging.INFO)
+    engine = create_engine(database_url)
+    start_mappers(
+        **sqlalchemy_schema(
+            Money=MONEY_TYPES[money_column_type],
+            partitioned=partitioned,
+            event_sourced=event_sourced,
+        )
+    )
+
+    # Only the invalidations are published, nothing is read from the cache
+    cache = None
+
+    if cache_channel == "postgresql":
+        cache = AccountCache(max_size=0, channel=PostgresInvalidationChannel(engine))
+
+    _worker_unit_of_work = SqlUnitOfWork(
+        SqlSessionFactory(engine), cache=cache, publish_events=publish_events
+    )
+
+
+def _post_chunk_in_worker(
+    job: str, posting: Posting, first_id: int, last_id: int
+) -> int:
+    return post_chunk(_worker_unit_of_work, job, posting, first_id, last_id)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m banking.jobs", description="Runs the maintenance jobs"
+    )
+    jobs = parser.add_subparsers(dest="job", required=True)
+
+    backfill = jobs.add_parser(
+        "backfill-checkpoints", help="Recomputes the accounts balance checkpoints"
+    )
+    backfill.add_argument("--batch-size", type=int, default=500)
+
+    purge = jobs.add_parser(
+        "purge-idempotency-keys", help="Deletes the expired idempotency keys"
+    )
+    purge.add_argument("--batch-size", type=int, default=1000)
+
+    compact = jobs.add_parser(
+        "compact-snapshots", help="Snapshots the balance of the event-sourced accounts"
+    )
+    compact.add_argument(
+        "--every",
+        type=int,
+        default=None,
+        help="the transactions after the last snapshot which take a new one",
+    )
+    compact.add_argument("--chunk-size", type=int, default=1000)
+
+    dispatch = jobs.add_parser(
+        "dispatch-outbox", help="Delivers the outbox events to the outbox file"
+    )
+    dispatch.add_argument("--batch-size", type=int, default=None)
+
+    for name, description in (
+        ("maintenance-fee", "Charges a maintenance fee from every account"),
+        ("interest", "Pays interest over the balance of every account"),
+    ):
+        posting = jobs.add_parser(name, help=description)
+        posting.add_argument(
+            "amount",
+            type=Decimal,
+            help="the fee, e.g. 12.90, or the interest rate, e.g. 0.005",
+        )
+        posting.add_argument(
+            "--run",
+            required=True,
+            help="names the run, a run which stopped resumes with the same name",
+        )
+        posting.add_argument("--chunk-size", type=int, default=1000)
+        posting.add_argument(
+            "--workers", type=int, default=None, help="one per CPU by default"
+        )
+
+    arguments = parser.parse_args(argv)
+
+    # The application settings and engine are only needed by the CLI
+    from banking.adapters import (
+        MONEY_TYPES,
+        SqlSessionFactory,
+        SqlUnitOfWork,
+        metadata,
+        sqlalchemy_schema,
+        start_mappers,
+    )
+    from banking.api import engine, settings
+
+    logging.basicConfig(level=logging.INFO)
+    start_mappers(
+        **sqlalchemy_schema(
+            Money=MONEY_TYPES[settings.money_column_type],
+            partitioned=settings.transactions_partitioned,
+            event_sourced=settings.event_sourced_accounts,
+        )
+    )
+    metadata.create_all(engine)
+
+    unit_of_work = SqlUnitOfWork(
+        SqlSessionFactory(engine), publish_events=settings.outbox_enabled
+    )
+
+    if arguments.job == "backfill-checkpoints":
+        written = backfill_balance_checkpoints(unit_of_work, arguments.batch_size)
+        LOGGER.info("%d balance checkpoints written", written)
+    elif arguments.job == "purge-idempotency-keys":
+        deleted = purge_idempotency_keys(
+            unit_of_work,
+            timedelta(seconds=settings.idempotency_key_ttl),
+            arguments.batch_size,
+        )
+        LOGGER.info("%d idempotency keys deleted", deleted)
+    elif arguments.job == "compact-snapshots":
+        written = compact_account_snapshots(
+            unit_of_work,
+            arguments.every or settings.account_snapshot_every,
+            arguments.chunk_size,
+        )
+        LOGGER.info("%d account snapshots written", written)
+    elif arguments.job == "dispatch-outbox":
+        dispatcher = OutboxDispatcher(
+            SqlUnitOfWork(SqlSessionFactory(engine)),
+            FileSink(settings.outbox_file),
+            batch_size=arguments.batch_size or settings.outbox_batch_size,
+        )
+        LOGGER.info("%d outbox events delivered", dispatcher.drain())
+    else:
+        if arguments.job == "maintenance-fee":
+            posting = domain.MaintenanceFee(domain.Money.parse(arguments.amount))
+        else:
+            posting = domain.Interest(arguments.amount)
+
+        executor = posting_workers(
+            settings.sqlalchemy_database_url,
+            arguments.workers,
+            settings.money_column_type,
+            settings.transactions_partitioned,
+            settings.account_cache_channel,
+            settings.event_sourced_accounts,
+            settings.outbox_enabled,
+        )
+
+        with executor:
+            report = run_postings(
+                unit_of_work, arguments.run, posting, arguments.chunk_size, executor
+            )
+
+        LOGGER.info(
+            "Job %s: %d accounts posted in %d chunks, %.1fs, %.0f accounts/s",
+            report.job,
+            report.accounts,
+            report.chunks,
+            report.seconds,
+            report.accounts_per_second,
+        )
+
+
+if __name__ == "__main__":
+    main()
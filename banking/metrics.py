@@ -0,0 +1,302 @@
+import bisect
+import collections
+import contextvars
+import threading
+import time
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+# The upper bounds, in seconds, of the latency buckets
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# The latency buckets with finer bounds below a millisecond, where most of
+# the phases of a request fall
+PHASE_BUCKETS = (0.0001, 0.00025, 0.0005) + LATENCY_BUCKETS
+
+# The phases a request wall time is split in, see `RequestTiming`
+REQUEST_PHASES = ("parse", "app", "db_checkout", "db_sql", "serialize")
+
+
+class Histogram:
+    """Counts the observed values in buckets, like a Prometheus histogram.
+
+    A value is counted in the first bucket whose upper bound is greater
+    than or equal to it, or in the overflow bucket. The quantiles are
+    estimated from the buckets, so their error is the bucket width."""
+
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.count = 0
+        self.sum = 0.0
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """Returns the `(upper bound, count of values up to it)` pairs, the
+        last one is the infinity bound counting all the values"""
+
+        with self._lock:
+            counts = list(self._counts)
+
+        pairs = []
+        total = 0
+
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            pairs.append((bound, total))
+
+        return pairs
+
+    def quantile(self, q: float) -> float:
+        """Estimates the `q` quantile by linear interpolation inside the
+        bucket where it falls. Values in the overflow bucket are estimated
+        as the greatest bucket bound."""
+
+        cumulative = self.cumulative()
+        count = cumulative[-1][1]
+
+        if count == 0:
+            return 0.0
+
+        rank = q * count
+        lower, below = 0.0, 0
+
+        for bound, total in cumulative:
+            if total >= rank:
+                if bound == float("inf"):
+                    return lower
+
+                return lower + (bound - lower) * (rank - below) / (total - below)
+
+            lower, below = bound, total
+
+        return lower
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class HistogramFamily:
+    """Keeps one Histogram per label, e.g. per command"""
+
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, label: str) -> Histogram:
+        """Returns the histogram of the label, created on the first use"""
+
+        histogram = self._histograms.get(label)
+
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(label, Histogram(self.buckets))
+
+        return histogram
+
+    def items(self) -> List[Tuple[str, Histogram]]:
+        with self._lock:
+            return sorted(self._histograms.items())
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {label: histogram.snapshot() for label, histogram in self.items()}
+
+
+class Meter:
+    """Counts events and estimates their rate over the last `window`
+    seconds, e.g. the events delivered per second"""
+
+    def __init__(self, window: float = 60.0, clock=time.monotonic):
+        self.window = window
+        self.count = 0
+        self._clock = clock
+        self._started = clock()
+        self._marks: Deque[Tuple[float, int]] = collections.deque()
+        self._lock = threading.Lock()
+
+    def mark(self, count: int = 1) -> None:
+        now = self._clock()
+
+        with self._lock:
+            self.count += count
+            self._marks.append((now, count))
+            self._trim(now)
+
+    def rate(self) -> float:
+        """Returns the events per second in the window, or since the meter
+        was created when it is younger than the window"""
+
+        now = self._clock()
+
+        with self._lock:
+            self._trim(now)
+            count = sum(count for _, count in self._marks)
+
+        elapsed = min(now - self._started, self.window)
+        return count / elapsed if elapsed > 0 else 0.0
+
+    def _trim(self, now: float) -> None:
+        while self._marks and self._marks[0][0] <= now - self.window:
+            self._marks.popleft()
+
+
+class RequestTiming:
+    """Splits the wall time of a request in phases.
+
+    The `parse` phase reads the request and solves the dependencies, `app`
+    runs the endpoint, `db_checkout` and `db_sql` wait for connections and
+    run the statements, and `serialize` validates and renders the response.
+    The database phases are added by the hooks of the engine from the
+    threads running the database work, which get a copy of the context,
+    and are not counted in the `app` phase."""
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.route = None
+        self.phases = dict.fromkeys(REQUEST_PHASES, 0.0)
+        self._mark = self.started
+        self._database = 0.0
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] += seconds
+
+    def database(self) -> float:
+        return self.phases["db_checkout"] + self.phases["db_sql"]
+
+    def elapsed(self) -> float:
+        return self.clock() - self.started
+
+    def start_handler(self, route: str) -> None:
+        self.route = route
+        self._mark = self.clock()
+
+    def start_endpoint(self) -> None:
+        now = self.clock()
+        self.add("parse", now - self._mark)
+        self._mark = now
+        self._database = self.database()
+
+    def finish_endpoint(self) -> None:
+        now = self.clock()
+        self.add("app", now - self._mark - (self.database() - self._database))
+        self._mark = now
+
+    def finish_handler(self) -> None:
+        self.add("serialize", self.clock() - self._mark)
+
+    def server_timing(self) -> str:
+        """Formats the phases and the elapsed time in milliseconds as the
+        value of a Server-Timing header"""
+
+        metrics = [
+            "%s;dur=%.3f" % (phase, seconds * 1000)
+            for phase, seconds in self.phases.items()
+        ]
+        metrics.append("total;dur=%.3f" % (self.elapsed() * 1000))
+        return ", ".join(metrics)
+
+
+# The timing of the request being served in the current context
+current_request_timing: "contextvars.ContextVar[Optional[RequestTiming]]" = (
+    contextvars.ContextVar("current_request_timing", default=None)
+)
+
+
+def record_request_phase(phase: str, seconds: float) -> None:
+    """Adds the time to the phase of the request being served, the time
+    spent outside of a request is not recorded"""
+
+    timing = current_request_timing.get()
+
+    if timing is not None:
+        timing.add(phase, seconds)
+
+
+def prometheus_metric(
+    name: str, help: str, type: str, samples: Iterable[Tuple[Dict[str, str], float]]
+) -> List[str]:
+    """Renders the samples of a counter or a gauge in the Prometheus text
+    format, one `(labels, value)` pair per sample"""
+
+    lines = ["# HELP %s %s" % (name, help), "# TYPE %s %s" % (name, type)]
+
+    for labels, value in samples:
+        lines.append("%s%s %s" % (name, _prometheus_labels(labels), _number(value)))
+
+    return lines
+
+
+def prometheus_histogram(
+    name: str, help: str, histograms: Iterable[Tuple[Dict[str, str], Histogram]]
+) -> List[str]:
+    """Renders the histograms in the Prometheus text format, one
+    `(labels, histogram)` pair per labeled histogram"""
+
+    lines = ["# HELP %s %s" % (name, help), "# TYPE %s histogram" % name]
+
+    for labels, histogram in histograms:
+        cumulative = histogram.cumulative()
+
+        for bound, count in cumulative:
+            bucket_labels = dict(labels, le=_number(bound))
+            lines.append(
+                "%s_bucket%s %d" % (name, _prometheus_labels(bucket_labels), count)
+            )
+
+        lines.append(
+            "%s_sum%s %s" % (name, _prometheus_labels(labels), _number(histogram.sum))
+        )
+        lines.append(
+            "%s_count%s %d" % (name, _prometheus_labels(labels), cumulative[-1][1])
+        )
+
+    return lines
+
+
+def _prometheus_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, _escape(value)) for name, value in labels.items()
+    )
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(value)
@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime
+from typing import List
+
+from banking import domain
+from banking.interfaces import AbstractUnitOfWork
+from banking.metrics import Histogram, Meter
+
+LOGGER = logging.getLogger(__name__)
+
+# The upper bounds, in seconds, of the delivery lag buckets
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def event_to_dict(event: domain.OutboxEvent) -> dict:
+    return {
+        "id": event.id,
+        "type": event.type.value,
+        "account_id": event.account_id,
+        "value": None if event.value is None else str(event.value),
+        "created_at": event.created_at.isoformat(),
+    }
+
+
+class FileSink:
+    """Appends the events to a file, one JSON object per line.
+
+    The file is synced before the events are deleted from the outbox, so an
+    event is not lost by a crash, at worst it is written twice."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def publish(self, events: List[domain.OutboxEvent]) -> None:
+        lines = "".join(json.dumps(event_to_dict(event)) + "\n" for event in events)
+
+        with open(self.path, "a") as file:
+            file.write(lines)
+            file.flush()
+            os.fsync(file.fileno())
+
+
+class QueueSink:
+    """Puts the events in a queue read by other threads of this process.
+
+    With a `maxsize` a full queue blocks the dispatcher, the events then
+    wait in the outbox until the readers catch up."""
+
+    def __init__(self, maxsize: int = 0):
+        self.queue = queue.Queue(maxsize)
+
+    def publish(self, events: List[domain.OutboxEvent]) -> None:
+        for event in events:
+            self.queue.put(event)
+
+
+class OutboxDispatcher:
+    """Delivers the events of the outbox to a sink in the background.
+
+    A batch of at most `batch_size` events is claimed, published to the
+    sink and deleted in one database transaction. The events are claimed
+    with SKIP LOCKED on PostgreSQL, so several dispatchers drain the same
+    outbox without publishing an event twice. An event is delivered at
+    least once: when the sink or the commit fails the batch is claimed
+    again later. The dispatcher waits `interval` seconds whenever the
+    outbox has less than a batch of events."""
+
+    def __init__(
+        self,
+        UnitOfWork: AbstractUnitOfWork,
+        sink,
+        batch_size: int = 500,
+        interval: float = 0.5,
+    ):
+        self.UnitOfWork = UnitOfWork
+        self.sink = sink
+        self.batch_size = batch_size
+        self.interval = interval
+        self.batches = 0
+        self.failures = 0
+        self.lag = 0.0
+        self.delivery_lag = Histogram(LAG_BUCKETS)
+        self.throughput = Meter()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="outbox-dispatcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the thread after the batch being delivered, the events left
+        stay in the outbox"""
+
+        self._stopping.set()
+        self._thread.join()
+
+    def dispatch(self) -> int:
+        """Delivers one batch of events and returns its size"""
+
+        with self.UnitOfWork as uow:
+            events = uow.outbox.claim(self.batch_size)
+
+            if not events:
+                self.lag = 0.0
+                return 0
+
+            self.sink.publish(events)
+            uow.outbox.remove([event.id for event in events])
+            uow.commit()
+
+        now = datetime.utcnow()
+        lags = [(now - event.created_at).total_seconds() for event in events]
+
+        for lag in lags:
+            self.delivery_lag.observe(lag)
+
+        # The events are claimed oldest first
+        self.lag = lags[0]
+        self.batches += 1
+        self.throughput.mark(len(events))
+
+        return len(events)
+
+    def drain(self) -> int:
+        """Delivers the events until the outbox has less than a batch of
+        them and returns how many"""
+
+        delivered = 0
+
+        while True:
+            count = self.dispatch()
+            delivered += count
+
+            if count < self.batch_size:
+                return delivered
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                self.drain()
+            except Exception:
+                self.failures += 1
+                LOGGER.exception("Could not deliver a batch of the outbox events")
+
+            self._stopping.wait(self.interval)
+
+    def snapshot(self) -> dict:
+        return {
+            "delivered": self.throughput.count,
+            "batches": self.batches,
+            "failures": self.failures,
+            "lag_seconds": self.lag,
+            "throughput": self.throughput.rate(),
+            "delivery_lag_p50": self.delivery_lag.quantile(0.5),
+            "delivery_lag_p95": self.delivery_lag.quantile(0.95),
+            "delivery_lag_p99": self.delivery_lag.quantile(0.99),
+        }
@@ -1,8 +1,37 @@
-from datetime import datetime
-from typing import List
+import warnings
+from datetime import date, datetime, time, timedelta
+from fractions import Fraction
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import (
+    BigInteger,
+    Integer,
+    Table,
+    and_,
+    case,
+    cast,
+    func,
+    literal,
+    select,
+    true,
+    tuple_,
+    type_coerce,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import SAWarning
+from sqlalchemy.orm import class_mapper
 
 from banking import domain, exceptions, interfaces
 
+# SQLAlchemy 1.3 renders the ON CONFLICT DO UPDATE columns by their key
+# while our database names differ, so the upserts name the columns by
+# their database name, which is right but warned as an unknown column
+warnings.filterwarnings(
+    "ignore",
+    message="Additional column names not matching any column keys",
+    category=SAWarning,
+)
+
 
 class BaseRepository(interfaces.AbstractRepository):
     """Defines the basic operations to all entity repositories.
@@ -10,6 +39,10 @@ class BaseRepository(interfaces.AbstractRepository):
     It does not implements the DomainClass which must be defined by
     all class that extends this base."""
 
+    # The ids looked up by each IN query of `fetch_many`, few enough to
+    # stay under the bound parameters limit of every database
+    fetch_chunk_size = 500
+
     def __init__(self, session):
         self._session = session
 
@@ -21,6 +54,36 @@ class BaseRepository(interfaces.AbstractRepository):
 
         return entity
 
+    def fetch_many(self, ids: Iterable[int]) -> Tuple[List, List[int]]:
+        """Retrieves the entities of many ids with one IN query per
+        `fetch_chunk_size` ids.
+
+        Returns the entities found, in the order of the ids, and the ids
+        which do not exist."""
+
+        ids = list(ids)
+        found = self._fetch_found(list(dict.fromkeys(ids)))
+
+        return (
+            [found[id] for id in ids if id in found],
+            [id for id in ids if id not in found],
+        )
+
+    def _fetch_found(self, ids: List[int]) -> dict:
+        """Maps the ids which exist to their entities"""
+
+        mapper = class_mapper(self.DomainClass)
+        (column,) = mapper.primary_key
+        key = mapper.get_property_by_column(column).key
+        found = {}
+
+        for start in range(0, len(ids), self.fetch_chunk_size):
+            chunk = ids[start : start + self.fetch_chunk_size]
+            query = self._session.query(self.DomainClass).filter(column.in_(chunk))
+            found.update((getattr(entity, key), entity) for entity in query)
+
+        return found
+
     def add(self, entity) -> None:
         self._session.add(entity)
 
@@ -32,13 +95,572 @@ class PersonRepository(BaseRepository):
 class AccountRepository(BaseRepository):
     DomainClass = domain.Account
 
+    # The balances are kept in the accounts rows, see LedgerAccountRepository
+    event_sourced = False
+
+    def _balance(self):
+        """Returns the SQL expression of the balance of the accounts row"""
+
+        return class_mapper(domain.Account).local_table.c.balance
+
+    def apply_deposit(self, id: int, value: domain.Money) -> domain.Money:
+        """Adds the value to the account balance with a single conditional
+        UPDATE and posts the deposit transaction.
+
+        The value must be validated by `domain.Account.deposit_amount`.
+        Returns the new account balance."""
+
+        accounts = class_mapper(domain.Account).local_table
+
+        return self._apply_transaction(
+            id=id,
+            value=value,
+            type=domain.TransactionTypeEnum.deposit,
+            balance=accounts.c.balance + value,
+        )
+
+    def apply_withdraw(
+        self, id: int, value: domain.Money, day: date = None
+    ) -> domain.Money:
+        """Subtracts the value from the account balance with a single
+        conditional UPDATE and posts the withdraw transaction.
+
+        The UPDATE only matches when the balance covers the value and the
+        amount withdrawn in the `day`, a `domain.WithdrawalCalendar` day,
+        stays in the daily withdrawal limit. So two concurrent withdraws can
+        not both spend the same money or the same limit. The value must be
+        validated by `domain.Account.withdraw_amount`. Returns the new
+        account balance."""
+
+        accounts = class_mapper(domain.Account).local_table
+        day = domain.WithdrawalCalendar().day() if day is None else day
+
+        # The running counter starts from zero when the day changes
+        withdrawn = case(
+            [(accounts.c.withdrawal_day == day, accounts.c.withdrawn_today)],
+            else_=0,
+        )
+
+        return self._apply_transaction(
+            id=id,
+            value=value,
+            type=domain.TransactionTypeEnum.withdraw,
+            balance=accounts.c.balance - value,
+            conditions=[
+                accounts.c.balance >= value,
+                withdrawn + value <= accounts.c.daily_withdrawal_limit,
+            ],
+            withdrawn_today=withdrawn + value,
+            withdrawal_day=day,
+        )
+
+    def apply_transfer(
+        self, source_id: int, target_id: int, value: domain.Money, day: date = None
+    ) -> domain.Money:
+        """Moves the value from the source to the target account, posting a
+        withdraw on the source and a deposit on the target.
+
+        Both accounts are locked first in ascending id order, so concurrent
+        transfers in opposite directions wait for each other instead of
+        deadlocking. The withdraw follows the rules of `apply_withdraw`, the
+        daily withdrawal limit included. A rejected transfer raises before
+        the commit, so the unit of work rolls both sides back. Returns the
+        new balance of the source account."""
+
+        self.lock([source_id, target_id])
+        balance = self.apply_withdraw(source_id, value, day)
+        self.apply_deposit(target_id, value)
+
+        return balance
+
+    def lock(self, ids: Iterable[int], key_share: bool = False) -> None:
+        """Locks the accounts until the end of the transaction, in ascending
+        id order. Only PostgreSQL has row locks, the other databases
+        serialize the writing transactions by themselves.
+
+        With `key_share` the rows are locked FOR NO KEY UPDATE, the lock of
+        an UPDATE of the balance, which does not block the inserts of
+        transactions referencing the accounts."""
+
+        if self._session.get_bind().dialect.name != "postgresql":
+            return
+
+        accounts = class_mapper(domain.Account).local_table
+
+        self._session.execute(
+            select([accounts.c.id])
+            .where(accounts.c.id.in_(sorted(set(ids))))
+            .order_by(accounts.c.id)
+            .with_for_update(key_share=key_share)
+        ).fetchall()
+
+    def ids_after(self, after: int = 0, limit: int = 500) -> List[int]:
+        """Retrieves at most `limit` account ids greater than `after`, in
+        order. It is used to walk through all the accounts in batches."""
+
+        accounts = class_mapper(domain.Account).local_table
+
+        return [
+            id
+            for id, in self._session.execute(
+                select([accounts.c.id])
+                .where(accounts.c.id > after)
+                .order_by(accounts.c.id)
+                .limit(limit)
+            )
+        ]
+
+    def last_id(self) -> int:
+        """Retrieves the greatest account id, zero when there is none"""
+
+        accounts = class_mapper(domain.Account).local_table
+
+        return self._session.execute(
+            select([func.coalesce(func.max(accounts.c.id), 0)])
+        ).scalar()
+
+    def apply_posting(self, posting, first_id: int, last_id: int) -> int:
+        """Posts a `domain.MaintenanceFee` or `domain.Interest` to the active
+        accounts with ids from `first_id` to `last_id`.
+
+        The database computes the amount of every account from its balance
+        and the accounts with nothing to post are skipped. The transactions
+        and the checkpoints are inserted from a SELECT and the balances are
+        changed by one UPDATE, so the cost does not grow with round trips
+        per account. On PostgreSQL the accounts are locked first, so all
+        the statements see the same balances. Returns the number of
+        accounts posted."""
+
+        accounts = class_mapper(domain.Account).local_table
+        transactions = class_mapper(domain.Transaction).local_table
+        checkpoints = class_mapper(domain.BalanceCheckpoint).local_table
+        postgres = self._session.get_bind().dialect.name == "postgresql"
+        created_at = datetime.utcnow()
+
+        money = accounts.c.balance.type
+        current = self._balance()
+        cents = _posting_cents(posting, money.as_cents(current))
+        amount = money.from_cents(cents)
+
+        if posting.type == domain.TransactionTypeEnum.deposit:
+            balance = current + amount
+        else:
+            balance = current - amount
+
+        posted = and_(
+            accounts.c.id.between(first_id, last_id),
+            accounts.c.active == true(),
+            cents > 0,
+        )
+        query = select([accounts.c.id]).where(posted)
+        ids = [
+            id
+            for id, in self._session.execute(
+                query.with_for_update() if postgres else query
+            )
+        ]
+
+        if not ids:
+            return 0
+
+        # The amounts are computed from the balances before the UPDATE
+        self._session.execute(
+            transactions.insert().from_select(
+                [
+                    transactions.c.account_id,
+                    transactions.c.value,
+                    transactions.c.type,
+                    transactions.c.created_at,
+                ],
+                select(
+                    [
+                        accounts.c.id,
+                        amount,
+                        cast(
+                            literal(posting.type, transactions.c.type.type),
+                            transactions.c.type.type,
+                        ),
+                        literal(created_at, transactions.c.created_at.type),
+                    ]
+                ).where(posted),
+            )
+        )
+
+        self._session.info.setdefault("changed_accounts", set()).update(ids)
+        OutboxRepository(self._session).record_posted(
+            posting.type, accounts.c.id, amount, created_at, posted
+        )
+
+        if self.event_sourced:
+            return len(ids)
+
+        day = literal(created_at.date(), checkpoints.c.day.type)
+        balances = select([accounts.c.id, day, balance]).where(posted)
+
+        if postgres:
+            self._session.execute(BalanceCheckpointRepository.upsert(balances))
+        else:
+            self._session.execute(
+                checkpoints.delete().where(
+                    and_(
+                        checkpoints.c.day == created_at.date(),
+                        checkpoints.c.account_id.in_(query),
+                    )
+                )
+            )
+            self._session.execute(
+                checkpoints.insert().from_select(
+                    [
+                        checkpoints.c.account_id,
+                        checkpoints.c.day,
+                        checkpoints.c.balance,
+                    ],
+                    balances,
+                )
+            )
+
+        self._session.execute(
+            accounts.update()
+            .where(posted)
+            .values(balance=balance, version=accounts.c.version + 1)
+        )
+
+        return len(ids)
+
+    def _apply_transaction(self, id, value, type, balance, conditions=(), **values):
+        accounts = class_mapper(domain.Account).local_table
+        transactions = class_mapper(domain.Transaction).local_table
+        checkpoints = class_mapper(domain.BalanceCheckpoint).local_table
+
+        update = (
+            accounts.update()
+            .where(and_(accounts.c.id == id, accounts.c.active == true(), *conditions))
+            .values(balance=balance, version=accounts.c.version + 1, **values)
+        )
+
+        if self._session.get_bind().dialect.name == "postgresql":
+            # Everything goes in one round trip: the UPDATE returns the
+            # new balance, the transaction and the checkpoint are only
+            # written if the UPDATE matched. The time is read from the
+            # database clock by the RETURNING, once the account row is
+            # locked, so a transaction which waited for the lock across
+            # midnight does not checkpoint the day before
+            now = func.timezone(
+                "UTC", func.clock_timestamp(), type_=transactions.c.created_at.type
+            )
+            updated = update.returning(
+                accounts.c.id, accounts.c.balance, now.label("created_at")
+            ).cte("updated")
+            inserted = (
+                transactions.insert()
+                .from_select(
+                    [
+                        transactions.c.account_id,
+                        transactions.c.value,
+                        transactions.c.type,
+                        transactions.c.created_at,
+                    ],
+                    select(
+                        [
+                            updated.c.id,
+                            cast(
+                                literal(value, transactions.c.value.type),
+                                transactions.c.value.type,
+                            ),
+                            cast(
+                                literal(type, transactions.c.type.type),
+                                transactions.c.type.type,
+                            ),
+                            updated.c.created_at,
+                        ]
+                    ),
+                )
+                .returning(transactions.c.id)
+                .cte("inserted")
+            )
+            checkpointed = (
+                BalanceCheckpointRepository.upsert(
+                    select(
+                        [
+                            updated.c.id,
+                            cast(updated.c.created_at, checkpoints.c.day.type),
+                            updated.c.balance,
+                        ]
+                    )
+                )
+                .returning(checkpoints.c.account_id)
+                .cte("checkpointed")
+            )
+            row = self._session.execute(
+                select([updated.c.balance, updated.c.created_at]).select_from(
+                    updated.join(inserted, true()).join(checkpointed, true())
+                )
+            ).first()
+
+            if row is None:
+                self._raise_rejected_transaction(id, value, type)
+
+            self._session.info.setdefault("changed_accounts", set()).add(id)
+            OutboxRepository(self._session).record(type, id, value, row.created_at)
+
+            return row.balance
+
+        if self._session.execute(update).rowcount == 0:
+            self._raise_rejected_transaction(id, value, type)
+
+        # The time is read once the UPDATE holds the write lock
+        created_at = datetime.utcnow()
+        self._session.info.setdefault("changed_accounts", set()).add(id)
+
+        self._session.execute(
+            transactions.insert().values(
+                account_id=id, value=value, type=type, created_at=created_at
+            )
+        )
+        OutboxRepository(self._session).record(type, id, value, created_at)
+
+        new_balance = self._session.execute(
+            select([accounts.c.balance]).where(accounts.c.id == id)
+        ).scalar()
+        BalanceCheckpointRepository(self._session).record(
+            id, created_at.date(), new_balance
+        )
+
+        return new_balance
+
+    def _raise_rejected_transaction(self, id, value, type):
+        """Finds out why the conditional UPDATE did not match the account"""
+
+        accounts = class_mapper(domain.Account).local_table
+        account = self._session.execute(
+            select([accounts.c.active, self._balance().label("balance")]).where(
+                accounts.c.id == id
+            )
+        ).first()
+
+        if account is None:
+            raise exceptions.DoesNotExist("Does not exist")
+        elif not account.active:
+            raise ValueError(
+                "Could not %s the value '%s' because the account is blocked"
+                % (type.value, value)
+            )
+        elif account.balance < value:
+            raise ValueError(
+                "The account balance is insufficient to withdraw the '%s' ammount"
+                % value
+            )
+
+        raise ValueError(
+            "The daily withdrawal limit of the account does not allow to "
+            "withdraw the '%s' ammount" % value
+        )
+
+
+class CachedAccountRepository(AccountRepository):
+    """Reads the accounts through an AccountCache.
+
+    It is used by the read-only unit of works. The accounts are cached as
+    detached copies, which are shared by the readers and must not be
+    changed."""
+
+    def __init__(self, session, cache):
+        super().__init__(session)
+        self._cache = cache
+
+    def fetch(self, id: int) -> domain.Account:
+        account = self._cache.get(id)
+
+        if account is not None:
+            return account
+
+        generation = self._cache.generation
+        account = super().fetch(id)
+        self._cache.put(id, self._detached(account), generation)
+        return account
+
+    def _fetch_found(self, ids: List[int]) -> dict:
+        found = {}
+        missed = []
+
+        for id in ids:
+            account = self._cache.get(id)
+
+            if account is None:
+                missed.append(id)
+            else:
+                found[id] = account
+
+        generation = self._cache.generation
+
+        for id, account in super()._fetch_found(missed).items():
+            self._cache.put(id, self._detached(account), generation)
+            found[id] = account
+
+        return found
+
+    @staticmethod
+    def _detached(account: domain.Account) -> domain.Account:
+        copy = domain.Account(
+            id=account.id,
+            balance=account.balance,
+            daily_withdrawal_limit=account.daily_withdrawal_limit,
+            active=account.active,
+            type=account.type,
+            person_id=account.person_id,
+            withdrawn_today=account.withdrawn_today,
+            withdrawal_day=account.withdrawal_day,
+        )
+        copy.created_at = account.created_at
+        return copy
+
+
+class LedgerAccountRepository(AccountRepository):
+    """Keeps the balance of the accounts as the ledger of their transactions.
+
+    The transactions are the events of the account and they are only ever
+    inserted. The balance is the latest AccountSnapshot plus the
+    transactions made after it, summed by the database whenever an account
+    is loaded, see `adapters.start_mappers`, while the balance column of the
+    accounts rows is left as it was.
+    The compactor, see `AccountSnapshotRepository.compact`, takes a new
+    snapshot every few transactions, so a read never sums more than the
+    transactions since the last one.
+
+    A deposit is a single INSERT and does not lock the account. A withdraw
+    still locks the account row, because the balance and the daily limit
+    must not be spent twice, and changes only the daily withdrawal counter.
+    The balance checkpoints are not written, neither by these methods nor
+    by the commands which load the account, see
+    LedgerBalanceCheckpointRepository, run the `backfill-checkpoints` job to
+    update them."""
+
+    event_sourced = True
+
+    def _balance(self):
+        return _ledger_balance()
+
+    def balance(self, id: int) -> domain.Money:
+        """Retrieves the balance of the account from its ledger"""
+
+        accounts = class_mapper(domain.Account).local_table
+
+        balance = self._session.execute(
+            select([self._balance()]).where(accounts.c.id == id)
+        ).scalar()
+
+        if balance is None:
+            raise exceptions.DoesNotExist("Does not exist")
+
+        return balance
+
+    def apply_deposit(self, id: int, value: domain.Money) -> domain.Money:
+        """Posts the deposit transaction, if the account exists and is
+        active, and returns the new account balance"""
+
+        accounts = class_mapper(domain.Account).local_table
+        self._post(
+            id, value, domain.TransactionTypeEnum.deposit, accounts.c.active == true()
+        )
+
+        return self.balance(id)
+
+    def apply_withdraw(
+        self, id: int, value: domain.Money, day: date = None
+    ) -> domain.Money:
+        """Posts the withdraw transaction and returns the new balance.
+
+        The account row is locked first, so the withdraws of an account run
+        one at a time. The lock is FOR NO KEY UPDATE, which does not block
+        the deposits inserting transactions of the account, only the FOR
+        UPDATE of `AccountSnapshotRepository.compact`. The balance is read
+        by the next statement, on PostgreSQL it then sees the withdraws
+        committed by the transactions which held the lock before, a balance
+        read by the locking statement itself would miss them. A rejected
+        withdraw writes nothing."""
+
+        accounts = class_mapper(domain.Account).local_table
+        day = domain.WithdrawalCalendar().day() if day is None else day
+        withdrawn = case(
+            [(accounts.c.withdrawal_day == day, accounts.c.withdrawn_today)],
+            else_=0,
+        )
+
+        self.lock([id], key_share=True)
+        balance = self.balance(id)
+
+        if balance < value:
+            self._raise_rejected_transaction(
+                id, value, domain.TransactionTypeEnum.withdraw
+            )
+
+        updated = self._session.execute(
+            accounts.update()
+            .where(
+                and_(
+                    accounts.c.id == id,
+                    accounts.c.active == true(),
+                    withdrawn + value <= accounts.c.daily_withdrawal_limit,
+                )
+            )
+            .values(
+                version=accounts.c.version + 1,
+                withdrawn_today=withdrawn + value,
+                withdrawal_day=day,
+            )
+        )
+
+        if updated.rowcount == 0:
+            self._raise_rejected_transaction(
+                id, value, domain.TransactionTypeEnum.withdraw
+            )
+
+        self._post(id, value, domain.TransactionTypeEnum.withdraw)
+
+        return balance - value
+
+    def _post(self, id, value, type, *conditions) -> None:
+        """Inserts the transaction of the account if it matches the
+        conditions, otherwise raises why it was rejected"""
+
+        accounts = class_mapper(domain.Account).local_table
+        transactions = class_mapper(domain.Transaction).local_table
+
+        inserted = self._session.execute(
+            transactions.insert().from_select(
+                [
+                    transactions.c.account_id,
+                    transactions.c.value,
+                    transactions.c.type,
+                    transactions.c.created_at,
+                ],
+                select(
+                    [
+                        accounts.c.id,
+                        literal(value, transactions.c.value.type),
+                        cast(
+                            literal(type, transactions.c.type.type),
+                            transactions.c.type.type,
+                        ),
+                        literal(datetime.utcnow(), transactions.c.created_at.type),
+                    ]
+                ).where(and_(accounts.c.id == id, *conditions)),
+            )
+        )
+
+        if inserted.rowcount == 0:
+            self._raise_rejected_transaction(id, value, type)
+
+        self._session.info.setdefault("changed_accounts", set()).add(id)
+        OutboxRepository(self._session).record(type, id, value)
+
 
 class TransactionRepository(BaseRepository):
     DomainClass = domain.Transaction
 
     def filter_by_interval(
         self, account_id: int, since: datetime, until: datetime = None
-    ) -> List[domain.Transaction]:
+    ) -> List[domain.TransactionRow]:
         """Retrieves  a list of transactions based in account id and in
         the date interval.
 
@@ -46,6 +668,51 @@ class TransactionRepository(BaseRepository):
         means that result will return all transactions since a start
         date if the until is not passed"""
 
+        return self._rows(self._interval(account_id, since, until))
+
+    def page_by_interval(
+        self,
+        account_id: int,
+        since: datetime,
+        until: datetime = None,
+        limit: int = 100,
+        after: Tuple[datetime, int] = None,
+    ) -> List[domain.TransactionRow]:
+        """Retrieves at most `limit` transactions of the account in the date
+        interval, ordered by creation date and id.
+
+        The pages are read with keyset pagination: `after` is the
+        `(created_at, id)` of the last transaction of the previous page and
+        only the transactions after it are returned. It costs the same to
+        read any page, no matter how many transactions came before."""
+
+        transactions = class_mapper(domain.Transaction).local_table
+        query = self._interval(account_id, since, until)
+
+        if after is not None:
+            query = query.where(
+                tuple_(transactions.c.created_at, transactions.c.id) > tuple_(*after)
+            )
+
+        return self._rows(
+            query.order_by(transactions.c.created_at, transactions.c.id).limit(limit)
+        )
+
+    def stream_by_interval(
+        self,
+        account_id: int,
+        since: datetime,
+        until: datetime = None,
+        batch_size: int = 1000,
+    ) -> Iterable[Tuple[int, datetime, domain.TransactionTypeEnum, domain.Money]]:
+        """Retrieves the `(id, created_at, type, value)` rows of the account
+        transactions in the date interval, ordered by creation date and id.
+
+        The rows are read lazily through a server-side cursor, `batch_size`
+        rows at a time, so the memory used does not depend on how many
+        transactions the account has. The session must stay open while
+        the rows are iterated."""
+
         if self._session.query(domain.Account).get(account_id) is None:
             raise exceptions.DoesNotExist("Account does not exist")
 
@@ -57,4 +724,729 @@ class TransactionRepository(BaseRepository):
         if until is not None:
             filters.append(domain.Transaction.created_at <= until)
 
-        return self._session.query(domain.Transaction).filter(*filters).all()
+        return (
+            self._session.query(
+                domain.Transaction.id,
+                domain.Transaction.created_at,
+                domain.Transaction.type,
+                domain.Transaction.value,
+            )
+            .filter(*filters)
+            .order_by(domain.Transaction.created_at, domain.Transaction.id)
+            .execution_options(stream_results=True)
+            .yield_per(batch_size)
+        )
+
+    def flows_by_interval(
+        self, account_id: int, since: datetime, until: datetime = None
+    ) -> List[Tuple[int, int, int]]:
+        """Retrieves the `(created_at, withdraw, value)` rows of the account
+        transactions in the date interval, in no particular order.
+
+        The creation date is in microseconds since the epoch, `withdraw` is
+        1 for the withdraws and 0 for the deposits and the value is in
+        cents. The database computes these plain integers, so the rows are
+        fetched straight from the cursor, with no result processing."""
+
+        transactions = class_mapper(domain.Transaction).local_table
+        created_at = func.extract("epoch", transactions.c.created_at) * 1000000
+        withdraw = transactions.c.type == domain.TransactionTypeEnum.withdraw
+        value = transactions.c.value
+        columns = [
+            cast(created_at, BigInteger),
+            cast(withdraw, Integer),
+            value.type.as_cents(value),
+        ]
+
+        query = self._interval(account_id, since, until, columns)
+        return self._session.execute(query).cursor.fetchall()
+
+    def _interval(
+        self, account_id: int, since: datetime, until: datetime = None, columns=None
+    ):
+        """Selects the `columns` of the account transactions in the date
+        interval, by default the `TransactionRow` columns"""
+
+        if self._session.query(domain.Account).get(account_id) is None:
+            raise exceptions.DoesNotExist("Account does not exist")
+
+        transactions = class_mapper(domain.Transaction).local_table
+        filters = [
+            transactions.c.account_id == account_id,
+            transactions.c.created_at >= since,
+        ]
+
+        if until is not None:
+            filters.append(transactions.c.created_at <= until)
+
+        if columns is None:
+            columns = [transactions.c[name] for name in domain.TransactionRow._fields]
+
+        return select(columns).where(and_(*filters))
+
+    def _rows(self, query) -> List[domain.TransactionRow]:
+        """Reads the rows without the ORM, so no identity map, instance
+        state or attribute events are involved"""
+
+        return list(map(domain.TransactionRow._make, self._session.execute(query)))
+
+
+def _posting_cents(posting, balance):
+    """Returns the SQL expression of the amount in cents posted to an
+    account with the `balance` in cents, as `posting.amount` computes it"""
+
+    if isinstance(posting, domain.MaintenanceFee):
+        return case([(balance < posting.fee.cents, balance)], else_=posting.fee.cents)
+    elif isinstance(posting, domain.Interest):
+        # Both are integers, so the database rounds the division down
+        rate = Fraction(posting.rate)
+        return balance * rate.numerator / rate.denominator
+
+    raise ValueError("Unknown posting %r" % (posting,))
+
+
+def _insert_ignoring_conflicts(session, table, values: dict) -> bool:
+    """Inserts the row unless its primary key exists. Returns whether it
+    was inserted, a concurrent insert of the key is waited for."""
+
+    if session.get_bind().dialect.name == "postgresql":
+        insert = (
+            postgresql.insert(table)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=list(table.primary_key))
+        )
+    else:
+        insert = table.insert().values(**values).prefix_with("OR IGNORE")
+
+    return session.execute(insert).rowcount == 1
+
+
+def _transactions_delta(transactions: Table = None):
+    """Sums the transactions values, deposits add and withdraws subtract"""
+
+    if transactions is None:
+        transactions = class_mapper(domain.Transaction).local_table
+
+    return func.coalesce(
+        func.sum(
+            case(
+                [
+                    (
+                        transactions.c.type == domain.TransactionTypeEnum.deposit,
+                        transactions.c.value,
+                    )
+                ],
+                else_=-transactions.c.value,
+            )
+        ),
+        0,
+    )
+
+
+def ledger_balance(accounts: Table, transactions: Table, snapshots: Table):
+    """Returns the SQL expression of the balance of the event-sourced account
+    of the accounts row: the balance of its snapshot plus the transactions
+    made after it, or the sum of all its transactions without a snapshot"""
+
+    snapshot = snapshots.c.account_id == accounts.c.id
+    snapshot_balance = select([snapshots.c.balance]).where(snapshot).as_scalar()
+    # Nested in the tail query, it would not be correlated to the accounts
+    snapshot_id = (
+        select([snapshots.c.transaction_id])
+        .where(snapshot)
+        .correlate(accounts)
+        .as_scalar()
+    )
+    tail = select([_transactions_delta(transactions)]).where(
+        and_(
+            transactions.c.account_id == accounts.c.id,
+            transactions.c.id > func.coalesce(snapshot_id, 0),
+        )
+    )
+
+    return type_coerce(
+        func.coalesce(snapshot_balance, 0) + tail.as_scalar(),
+        accounts.c.balance.type,
+    )
+
+
+def _ledger_balance():
+    return ledger_balance(
+        class_mapper(domain.Account).local_table,
+        class_mapper(domain.Transaction).local_table,
+        class_mapper(domain.AccountSnapshot).local_table,
+    )
+
+
+class BalanceCheckpointRepository(BaseRepository):
+    """Keeps the balance of the accounts at the end of each day with
+    transactions. A past balance is computed from the nearest checkpoint
+    and the transactions between it and the requested moment."""
+
+    DomainClass = domain.BalanceCheckpoint
+
+    def _balance(self):
+        """Returns the SQL expression of the current balance of the accounts
+        row, the balance the past balances are computed back from"""
+
+        return class_mapper(domain.Account).local_table.c.balance
+
+    @staticmethod
+    def upsert(rows) -> postgresql.Insert:
+        """Returns the PostgreSQL INSERT of the `(account_id, day, balance)`
+        rows selected by `rows` which replaces the existing checkpoints"""
+
+        checkpoints = class_mapper(domain.BalanceCheckpoint).local_table
+        insert = postgresql.insert(checkpoints).from_select(
+            [checkpoints.c.account_id, checkpoints.c.day, checkpoints.c.balance],
+            rows,
+        )
+
+        return insert.on_conflict_do_update(
+            index_elements=[checkpoints.c.account_id, checkpoints.c.day],
+            set_={checkpoints.c.balance.name: insert.excluded.balance},
+        )
+
+    def record(self, account_id: int, day: date, balance: domain.Money) -> None:
+        """Saves the balance of the account at the end of the day, replacing
+        the checkpoint recorded before in the same day"""
+
+        checkpoints = class_mapper(domain.BalanceCheckpoint).local_table
+
+        if self._session.get_bind().dialect.name == "postgresql":
+            row = select(
+                [
+                    literal(account_id, checkpoints.c.account_id.type),
+                    literal(day, checkpoints.c.day.type),
+                    literal(balance, checkpoints.c.balance.type),
+                ]
+            )
+            self._session.execute(self.upsert(row))
+            return
+
+        updated = self._session.execute(
+            checkpoints.update()
+            .where(
+                and_(checkpoints.c.account_id == account_id, checkpoints.c.day == day)
+            )
+            .values(balance=balance)
+        )
+
+        if updated.rowcount == 0:
+            self._session.execute(
+                checkpoints.insert().values(
+                    account_id=account_id, day=day, balance=balance
+                )
+            )
+
+    def balance_at(self, account_id: int, as_of: datetime) -> domain.Money:
+        """Computes the balance of the account at the `as_of` moment.
+
+        It starts from the last checkpoint before the `as_of` day and adds
+        the transactions made since. Without one it starts from the first
+        checkpoint from that day on, or from the current balance, and takes
+        back the transactions made after `as_of`. Only the transactions of
+        a few days are summed, no matter how old the account is."""
+
+        accounts = class_mapper(domain.Account).local_table
+        transactions = class_mapper(domain.Transaction).local_table
+        checkpoints = class_mapper(domain.BalanceCheckpoint).local_table
+
+        balance = self._session.execute(
+            select([self._balance()]).where(accounts.c.id == account_id)
+        ).scalar()
+
+        if balance is None:
+            raise exceptions.DoesNotExist("Account does not exist")
+
+        def delta(*conditions):
+            return self._session.execute(
+                select([_transactions_delta()]).where(
+                    and_(transactions.c.account_id == account_id, *conditions)
+                )
+            ).scalar()
+
+        def checkpoint(condition, order):
+            return self._session.execute(
+                select([checkpoints.c.day, checkpoints.c.balance])
+                .where(and_(checkpoints.c.account_id == account_id, condition))
+                .order_by(order)
+                .limit(1)
+            ).first()
+
+        before = checkpoint(checkpoints.c.day < as_of.date(), checkpoints.c.day.desc())
+
+        if before is not None:
+            since = datetime.combine(before.day + timedelta(days=1), time())
+            return before.balance + delta(
+                transactions.c.created_at >= since,
+                transactions.c.created_at <= as_of,
+            )
+
+        after = checkpoint(checkpoints.c.day >= as_of.date(), checkpoints.c.day)
+        conditions = [transactions.c.created_at > as_of]
+
+        if after is not None:
+            balance = after.balance
+            until = datetime.combine(after.day + timedelta(days=1), time())
+            conditions.append(transactions.c.created_at < until)
+
+        return balance - delta(*conditions)
+
+    def backfill(self, account_ids: List[int], until: date) -> int:
+        """Recomputes the checkpoints of the accounts for every day with
+        transactions before `until` with a single INSERT ... SELECT.
+
+        The balance at the end of a day is the current balance minus the
+        transactions made after that day. Returns the number of checkpoints
+        written."""
+
+        accounts = class_mapper(domain.Account).local_table
+        transactions = class_mapper(domain.Transaction).local_table
+        checkpoints = class_mapper(domain.BalanceCheckpoint).local_table
+
+        day = func.date(transactions.c.created_at)
+        days = (
+            select(
+                [
+                    transactions.c.account_id,
+                    day.label("day"),
+                    _transactions_delta().label("delta"),
+                ]
+            )
+            .where(transactions.c.account_id.in_(account_ids))
+            .group_by(transactions.c.account_id, day)
+            .alias("days")
+        )
+        later = func.sum(days.c.delta).over(
+            partition_by=days.c.account_id,
+            order_by=days.c.day.desc(),
+            rows=(None, -1),
+        )
+        balances = (
+            select(
+                [
+                    days.c.account_id,
+                    days.c.day,
+                    (self._balance() - func.coalesce(later, 0)).label("balance"),
+                ]
+            )
+            .select_from(days.join(accounts, accounts.c.id == days.c.account_id))
+            .alias("balances")
+        )
+        rows = select(
+            [balances.c.account_id, balances.c.day, balances.c.balance]
+        ).where(balances.c.day < literal(until, checkpoints.c.day.type))
+
+        self._session.execute(
+            checkpoints.delete().where(
+                and_(
+                    checkpoints.c.account_id.in_(account_ids),
+                    checkpoints.c.day < until,
+                )
+            )
+        )
+
+        return self._session.execute(
+            checkpoints.insert().from_select(
+                [checkpoints.c.account_id, checkpoints.c.day, checkpoints.c.balance],
+                rows,
+            )
+        ).rowcount
+
+
+class LedgerBalanceCheckpointRepository(BalanceCheckpointRepository):
+    """Computes the past balances of the event-sourced accounts back from
+    their ledger balance, see LedgerAccountRepository.
+
+    The checkpoints are only written by the `backfill-checkpoints` job. A
+    checkpoint missing for the last days is not wrong, the past balances
+    are then computed from an earlier one and the transactions after it."""
+
+    def _balance(self):
+        return _ledger_balance()
+
+    def record(self, account_id: int, day: date, balance: domain.Money) -> None:
+        """Does nothing, the balance of an account loaded by a command may
+        already miss the transactions committed since it was loaded"""
+
+
+class AccountSnapshotRepository(BaseRepository):
+    """Keeps the latest snapshot of the balance of the event-sourced
+    accounts, so their balance is read from the snapshot and the few
+    transactions made after it instead of the whole account history."""
+
+    DomainClass = domain.AccountSnapshot
+
+    def compact(self, first_id: int, last_id: int, every: int) -> int:
+        """Snapshots the accounts with ids from `first_id` to `last_id` which
+        have at least `every` transactions after their snapshot.
+
+        A transaction takes its id when it is inserted but it is only seen
+        after its commit, so a snapshot must not be taken while the account
+        has transactions running: one with a smaller id would be skipped
+        for good. On PostgreSQL the inserted transactions hold a key share
+        lock on their account row until they commit, the accounts are then
+        locked with SKIP LOCKED and the ones with transactions running are
+        left for the next run. Returns the number of snapshots written."""
+
+        accounts = class_mapper(domain.Account).local_table
+        transactions = class_mapper(domain.Transaction).local_table
+        snapshots = class_mapper(domain.AccountSnapshot).local_table
+        created_at = datetime.utcnow()
+
+        def tails(account_ids):
+            return self._session.execute(
+                select(
+                    [
+                        transactions.c.account_id,
+                        func.max(transactions.c.id),
+                        type_coerce(
+                            func.coalesce(func.max(snapshots.c.balance), 0)
+                            + _transactions_delta(),
+                            snapshots.c.balance.type,
+                        ),
+                    ]
+                )
+                .select_from(
+                    transactions.outerjoin(
+                        snapshots,
+                        snapshots.c.account_id == transactions.c.account_id,
+                    )
+                )
+                .where(
+                    and_(
+                        account_ids,
+                        transactions.c.id
+                        > func.coalesce(snapshots.c.transaction_id, 0),
+                    )
+                )
+                .group_by(transactions.c.account_id)
+                .having(func.count(transactions.c.id) >= every)
+            ).fetchall()
+
+        found = tails(transactions.c.account_id.between(first_id, last_id))
+        postgres = self._session.get_bind().dialect.name == "postgresql"
+
+        if found and postgres:
+            locked = [
+                id
+                for id, in self._session.execute(
+                    select([accounts.c.id])
+                    .where(accounts.c.id.in_(sorted(row[0] for row in found)))
+                    .order_by(accounts.c.id)
+                    .with_for_update(skip_locked=True)
+                )
+            ]
+            # Read again after the locks, by a statement which sees the
+            # transactions committed while they were taken
+            found = tails(transactions.c.account_id.in_(locked)) if locked else []
+
+        if not found:
+            return 0
+
+        rows = [
+            {
+                "account_id": account_id,
+                "transaction_id": transaction_id,
+                "balance": balance,
+                "created_at": created_at,
+            }
+            for account_id, transaction_id, balance in found
+        ]
+
+        if self._session.get_bind().dialect.name == "postgresql":
+            insert = postgresql.insert(snapshots)
+            self._session.execute(
+                insert.on_conflict_do_update(
+                    index_elements=[snapshots.c.account_id],
+                    set_={
+                        column.name: insert.excluded[column.key]
+                        for column in snapshots.columns
+                        if not column.primary_key
+                    },
+                ),
+                rows,
+            )
+        else:
+            self._session.execute(
+                snapshots.delete().where(
+                    snapshots.c.account_id.in_([row["account_id"] for row in rows])
+                )
+            )
+            self._session.execute(snapshots.insert(), rows)
+
+        return len(rows)
+
+
+class OutboxRepository(BaseRepository):
+    """Keeps the events of the accounts until they are delivered.
+
+    The events are collected in the session while the unit of work runs
+    and written by one INSERT right before its commit, see `SqlUnitOfWork`,
+    so an event is committed if and only if the change it tells about is.
+    Nothing is collected by the sessions which do not publish events."""
+
+    DomainClass = domain.OutboxEvent
+
+    def record(
+        self, type, account_id: int, value: domain.Money = None, created_at=None
+    ) -> None:
+        """Collects the event of the account, `type` is one of the
+        AccountEventTypeEnum or TransactionTypeEnum values"""
+
+        events = self._session.info.get("outbox")
+
+        if events is not None:
+            events.append(
+                {
+                    "type": domain.AccountEventTypeEnum(type.value),
+                    "account_id": account_id,
+                    "value": value,
+                    "created_at": created_at or datetime.utcnow(),
+                }
+            )
+
+    def record_posted(self, type, account_id, value, created_at, *conditions):
+        """Writes the events of the transactions inserted from a SELECT over
+        the accounts, with the same `account_id` and `value` expressions
+        and `conditions`"""
+
+        if self._session.info.get("outbox") is None:
+            return
+
+        outbox = class_mapper(domain.OutboxEvent).local_table
+        accounts = class_mapper(domain.Account).local_table
+
+        self._session.execute(
+            outbox.insert().from_select(
+                [
+                    outbox.c.type,
+                    outbox.c.account_id,
+                    outbox.c.value,
+                    outbox.c.created_at,
+                ],
+                select(
+                    [
+                        cast(
+                            literal(
+                                domain.AccountEventTypeEnum(type.value),
+                                outbox.c.type.type,
+                            ),
+                            outbox.c.type.type,
+                        ),
+                        account_id,
+                        value,
+                        literal(created_at, outbox.c.created_at.type),
+                    ]
+                )
+                .select_from(accounts)
+                .where(and_(*conditions)),
+            )
+        )
+
+    def write_pending(self) -> int:
+        """Writes the events collected so far and returns how many"""
+
+        events = self._session.info.get("outbox")
+
+        if not events:
+            return 0
+
+        outbox = class_mapper(domain.OutboxEvent).local_table
+        self._session.execute(outbox.insert().values(events))
+        count = len(events)
+        del events[:]
+
+        return count
+
+    def claim(self, limit: int) -> List[domain.OutboxEvent]:
+        """Retrieves the `limit` oldest events and locks them until the end
+        of the transaction. The events locked by other transactions are
+        skipped, so concurrent dispatchers claim different events.
+
+        The events are not tracked by the session, they are still readable
+        once delivered and deleted."""
+
+        outbox = class_mapper(domain.OutboxEvent).local_table
+        rows = self._session.execute(
+            select([outbox])
+            .order_by(outbox.c.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+
+        return [
+            domain.OutboxEvent(**{column.key: row[column] for column in outbox.c})
+            for row in rows
+        ]
+
+    def remove(self, ids: List[int]) -> int:
+        """Deletes the delivered events"""
+
+        outbox = class_mapper(domain.OutboxEvent).local_table
+
+        return self._session.execute(
+            outbox.delete().where(outbox.c.id.in_(ids))
+        ).rowcount
+
+
+class IdempotencyKeyRepository(BaseRepository):
+    """Records the requests sent with an Idempotency-Key and their results.
+
+    The keys committed are also kept in the `cache`, an `LRUCache`, so the
+    replays of recent requests are answered without reaching the database."""
+
+    DomainClass = domain.IdempotencyKey
+
+    def __init__(self, session, cache=None):
+        super().__init__(session)
+        self._cache = cache
+
+    def claim(self, key: str, request: str) -> domain.IdempotencyKey:
+        """Reserves the key to the request in the current transaction.
+
+        Returns None when the key was never used, otherwise the key recorded
+        by the first request, which is waited for when still in progress.
+        Raises ValueError when the key was used by a different request."""
+
+        stored = self._cache.get(key) if self._cache is not None else None
+
+        if stored is None:
+            stored = self._insert(key, request)
+
+        if stored is not None and stored.request != request:
+            raise ValueError(
+                "The Idempotency-Key '%s' was used by another request" % key
+            )
+
+        return stored
+
+    def _insert(self, key: str, request: str) -> domain.IdempotencyKey:
+        keys = class_mapper(domain.IdempotencyKey).local_table
+        values = {"key": key, "request": request, "created_at": datetime.utcnow()}
+
+        if _insert_ignoring_conflicts(self._session, keys, values):
+            return None
+
+        row = self._session.execute(
+            select(
+                [keys.c.key, keys.c.request, keys.c.balance, keys.c.created_at]
+            ).where(keys.c.key == key)
+        ).first()
+
+        return domain.IdempotencyKey(*row)
+
+    def complete(self, key: str, request: str, balance: domain.Money) -> None:
+        """Saves the balance answered to the request of the key"""
+
+        keys = class_mapper(domain.IdempotencyKey).local_table
+
+        self._session.execute(
+            keys.update().where(keys.c.key == key).values(balance=balance)
+        )
+        self._session.info.setdefault("idempotency_keys", []).append(
+            domain.IdempotencyKey(key=key, request=request, balance=balance)
+        )
+
+    def purge(self, before: datetime, limit: int = 1000) -> int:
+        """Deletes up to `limit` keys created before the moment.
+
+        Returns the number of keys deleted."""
+
+        keys = class_mapper(domain.IdempotencyKey).local_table
+        expired = select([keys.c.key]).where(keys.c.created_at < before).limit(limit)
+
+        return self._session.execute(
+            keys.delete().where(keys.c.key.in_(expired))
+        ).rowcount
+
+
+class BatchJobRepository(BaseRepository):
+    """Records the chunks of accounts done by the batch job runs, so a run
+    which stopped is resumed from the chunks left undone"""
+
+    DomainClass = domain.BatchJobChunk
+
+    def finished(self, job: str) -> List[Tuple[int, int]]:
+        """Retrieves the first and the last account id of the chunks done by
+        the run, ordered by the first id"""
+
+        chunks = class_mapper(domain.BatchJobChunk).local_table
+
+        return [
+            (first_id, last_id)
+            for first_id, last_id in self._session.execute(
+                select([chunks.c.first_id, chunks.c.last_id])
+                .where(chunks.c.job == job)
+                .order_by(chunks.c.first_id)
+            )
+        ]
+
+    def posted(self, job: str, first_id: int) -> Optional[int]:
+        """Retrieves how many accounts the chunk of the run posted, None
+        when it was not done"""
+
+        chunks = class_mapper(domain.BatchJobChunk).local_table
+
+        return self._session.execute(
+            select([chunks.c.accounts]).where(
+                and_(chunks.c.job == job, chunks.c.first_id == first_id)
+            )
+        ).scalar()
+
+    def claim(self, job: str, first_id: int, last_id: int) -> bool:
+        """Records the chunk as done by the run in the current transaction.
+
+        Returns False when it was done already. A concurrent claim of the
+        chunk is waited for, so a chunk is only done once."""
+
+        chunks = class_mapper(domain.BatchJobChunk).local_table
+
+        return _insert_ignoring_conflicts(
+            self._session,
+            chunks,
+            {
+                "job": job,
+                "first_id": first_id,
+                "last_id": last_id,
+                "accounts": 0,
+                "finished_at": datetime.utcnow(),
+            },
+        )
+
+    def complete(self, job: str, first_id: int, accounts: int) -> None:
+        """Saves how many accounts of the chunk were processed"""
+
+        chunks = class_mapper(domain.BatchJobChunk).local_table
+
+        self._session.execute(
+            chunks.update()
+            .where(and_(chunks.c.job == job, chunks.c.first_id == first_id))
+            .values(accounts=accounts)
+        )
+
+
+class AsyncRepository(interfaces.AbstractRepository):
+    """Exposes a repository to asyncio code.
+
+    Every method of the wrapped repository becomes a coroutine which is
+    executed by the `run` callable of the AsyncSqlUnitOfWork."""
+
+    def __init__(self, repository: BaseRepository, run):
+        self._repository = repository
+        self._run = run
+
+    async def fetch(self, id: int):
+        return await self._run(self._repository.fetch, id)
+
+    async def add(self, entity) -> None:
+        self._repository.add(entity)
+
+    def __getattr__(self, name):
+        method = getattr(self._repository, name)
+
+        async def call(*args, **kwargs):
+            return await self._run(method, *args, **kwargs)
+
+        return call
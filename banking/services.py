@@ -1,17 +1,129 @@
-from datetime import datetime
-from decimal import Decimal
+import asyncio
+import base64
+import csv
+import functools
+import io
+import itertools
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Tuple
 
-from banking import domain
+import numpy as np
+
+from banking import domain, exceptions, metrics
 from banking.repositories import AccountRepository
 from banking.interfaces import AbstractUnitOfWork
 
+LOGGER = logging.getLogger(__name__)
+
+
+class RetryPolicy:
+    """Retries an operation which failed with a recoverable exception.
+
+    The operation is tried at most `attempts` times. The delay between the
+    attempts grows exponentially up to `max_delay` and is randomized (full
+    jitter) so concurrent retries do not collide again."""
+
+    def __init__(
+        self,
+        attempts: int = 3,
+        delay: float = 0.01,
+        max_delay: float = 0.2,
+        retry_on=(exceptions.ConcurrentModification,),
+    ):
+        self.attempts = attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+
+    def delays(self):
+        """Yields the time to sleep before each retry"""
+
+        for attempt in range(self.attempts - 1):
+            yield random.uniform(0, min(self.max_delay, self.delay * 2 ** attempt))
+
+    def __call__(self, function, *args, **kwargs):
+        for delay in self.delays():
+            try:
+                return function(*args, **kwargs)
+            except self.retry_on as exc:
+                LOGGER.info("Retrying %r in %.3fs after: %s", function, delay, exc)
+                time.sleep(delay)
+
+        return function(*args, **kwargs)
+
+    async def call_async(self, function, *args, **kwargs):
+        for delay in self.delays():
+            try:
+                return await function(*args, **kwargs)
+            except self.retry_on as exc:
+                LOGGER.info("Retrying %r in %.3fs after: %s", function, delay, exc)
+                await asyncio.sleep(delay)
+
+        return await function(*args, **kwargs)
+
+
+def retryable(method):
+    """Marks the command as safe to be retried by the command retry policy.
+
+    A command is only retried if it opts-in with this decorator and a
+    RetryPolicy was given to it."""
+
+    if asyncio.iscoroutinefunction(method):
+
+        @functools.wraps(method)
+        async def async_wrapper(self, *args, **kwargs):
+            if self.retry_policy is None:
+                return await method(self, *args, **kwargs)
+
+            return await self.retry_policy.call_async(method, self, *args, **kwargs)
+
+        async_wrapper.retryable = True
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.retry_policy is None:
+            return method(self, *args, **kwargs)
+
+        return self.retry_policy(method, self, *args, **kwargs)
+
+    wrapper.retryable = True
+    return wrapper
+
 
 class Command:
     """Implements the basic command class that should be
-    extended by Commands Services"""
+    extended by Commands Services.
+
+    Commands which only read data declare `read_only = True` and use the
+    `unit_of_work` property, which may be routed to a read replica."""
 
-    def __init__(self, UnitOfWork):
+    read_only = False
+
+    def __init__(
+        self,
+        UnitOfWork,
+        retry_policy: RetryPolicy = None,
+        calendar: domain.WithdrawalCalendar = None,
+    ):
         self.UnitOfWork = UnitOfWork
+        self.retry_policy = retry_policy
+        self.calendar = calendar or domain.WithdrawalCalendar()
+
+    @property
+    def unit_of_work(self) -> AbstractUnitOfWork:
+        if self.read_only:
+            return self.UnitOfWork.for_reading()
+
+        return self.UnitOfWork
 
 
 class PersonRegisterCommand(Command):
@@ -47,15 +159,21 @@ class AccountDepositValueCommand(Command):
     """Obtain an account using the account id then deposit
     a value to the account"""
 
-    def __call__(self, id: int, value: Decimal):
+    @retryable
+    def __call__(self, id: int, value: domain.Money):
         with self.UnitOfWork as uow:
             account = uow.accounts.fetch(id)
             account.deposit(value)
-            account.add_transaction(
-                domain.Transaction.new(
-                    value=value,
-                    type=domain.TransactionTypeEnum.deposit,
-                )
+            transaction = domain.Transaction.new(
+                account_id=account.id,
+                value=value,
+                type=domain.TransactionTypeEnum.deposit,
+                created_at=datetime.utcnow(),
+            )
+            account.add_transaction(transaction)
+            uow.transactions.add(transaction)
+            uow.checkpoints.record(
+                account.id, transaction.created_at.date(), account.balance
             )
 
         return account
@@ -64,34 +182,307 @@ class AccountDepositValueCommand(Command):
 class AccountFetchCommand(Command):
     """Obtain an account using the account id"""
 
+    read_only = True
+
     def __call__(self, id: int):
-        with self.UnitOfWork as uow:
+        with self.unit_of_work as uow:
             account = uow.accounts.fetch(id)
 
         return account
 
 
+class AccountFetchManyCommand(Command):
+    """Obtain many accounts using their ids. Returns the accounts found, in
+    the order of the ids, and the ids which do not exist"""
+
+    read_only = True
+
+    def __call__(self, ids: List[int]) -> Tuple[List[domain.Account], List[int]]:
+        with self.unit_of_work as uow:
+            accounts, missing = uow.accounts.fetch_many(ids)
+
+        return accounts, missing
+
+
 class AccountWithddrawValueCommand(Command):
     """Obtain an account using the account id then withdraw
     a value from the account"""
 
-    def __call__(self, id: int, value: Decimal):
+    @retryable
+    def __call__(self, id: int, value: domain.Money):
         with self.UnitOfWork as uow:
             account = uow.accounts.fetch(id)
-            account.withdraw(value)
-            account.add_transaction(
-                domain.Transaction.new(
-                    value=value,
-                    type=domain.TransactionTypeEnum.withdraw,
-                )
+            account.withdraw(value, self.calendar.day())
+            transaction = domain.Transaction.new(
+                account_id=account.id,
+                value=value,
+                type=domain.TransactionTypeEnum.withdraw,
+                created_at=datetime.utcnow(),
+            )
+            account.add_transaction(transaction)
+            uow.transactions.add(transaction)
+            uow.checkpoints.record(
+                account.id, transaction.created_at.date(), account.balance
             )
 
         return account
 
 
+def _idempotent_request(operation: str, id: int, amount: domain.Money) -> str:
+    """Describes the request guarded by an Idempotency-Key, so a key reused
+    with another account or amount is told apart from a replay"""
+
+    return "%s:%s:%s" % (operation, id, amount)
+
+
+class AccountAtomicDepositCommand(Command):
+    """Deposit a value to the account without loading it.
+
+    The balance is changed by a single conditional UPDATE and the
+    transaction is posted in the same round trip. Returns the new
+    account balance.
+
+    With an `idempotency_key` the key is recorded in the same transaction
+    and a replay returns the balance answered the first time without
+    touching the account."""
+
+    def __call__(
+        self, id: int, value: domain.Money, idempotency_key: str = None
+    ) -> domain.Money:
+        amount = domain.Account.deposit_amount(value)
+        request = _idempotent_request("deposit", id, amount)
+
+        with self.UnitOfWork as uow:
+            if idempotency_key is not None:
+                stored = uow.idempotency_keys.claim(idempotency_key, request)
+
+                if stored is not None:
+                    return stored.balance
+
+            balance = uow.accounts.apply_deposit(id, amount)
+
+            if idempotency_key is not None:
+                uow.idempotency_keys.complete(idempotency_key, request, balance)
+
+        return balance
+
+
+class AccountAtomicWithdrawCommand(Command):
+    """Withdraw a value from the account without loading it.
+
+    The balance is changed by a single conditional UPDATE and the
+    transaction is posted in the same round trip. Returns the new
+    account balance.
+
+    With an `idempotency_key` a replay returns the balance answered the
+    first time without withdrawing again."""
+
+    def __call__(
+        self, id: int, value: domain.Money, idempotency_key: str = None
+    ) -> domain.Money:
+        amount = domain.Account.withdraw_amount(value)
+        request = _idempotent_request("withdraw", id, amount)
+
+        with self.UnitOfWork as uow:
+            if idempotency_key is not None:
+                stored = uow.idempotency_keys.claim(idempotency_key, request)
+
+                if stored is not None:
+                    return stored.balance
+
+            balance = uow.accounts.apply_withdraw(id, amount, self.calendar.day())
+
+            if idempotency_key is not None:
+                uow.idempotency_keys.complete(idempotency_key, request, balance)
+
+        return balance
+
+
+class AccountTransferCommand(Command):
+    """Transfer a value from the source to the target account in one
+    transaction, see `AccountRepository.apply_transfer`. Returns the new
+    balance of the source account.
+
+    With an `idempotency_key` a replay returns the balance answered the
+    first time without transferring again."""
+
+    def __call__(
+        self,
+        source_id: int,
+        target_id: int,
+        value: domain.Money,
+        idempotency_key: str = None,
+    ) -> domain.Money:
+        amount = _transfer_amount(source_id, target_id, value)
+        request = _idempotent_request(
+            "transfer", "%s:%s" % (source_id, target_id), amount
+        )
+
+        with self.UnitOfWork as uow:
+            if idempotency_key is not None:
+                stored = uow.idempotency_keys.claim(idempotency_key, request)
+
+                if stored is not None:
+                    return stored.balance
+
+            balance = uow.accounts.apply_transfer(
+                source_id, target_id, amount, self.calendar.day()
+            )
+
+            if idempotency_key is not None:
+                uow.idempotency_keys.complete(idempotency_key, request, balance)
+
+        return balance
+
+
+def _transfer_amount(source_id: int, target_id: int, value) -> domain.Money:
+    """Validates a transfer as a withdraw between two distinct accounts"""
+
+    amount = domain.Account.withdraw_amount(value)
+
+    if source_id == target_id:
+        raise ValueError(
+            "Could not transfer the value '%s' to the same account" % value
+        )
+
+    return amount
+
+
+class WriteCoalescer:
+    """Group commit stage for deposits and withdraws.
+
+    The operations submitted within `max_delay` seconds, up to
+    `max_batch_size`, are applied by a background thread in a single
+    database transaction, so they share one COMMIT. Each operation is
+    applied with the atomic repository methods, a rejected operation does
+    not write anything and does not affect the others in the batch.
+
+    The accounts of a batch are locked in ascending id order before its
+    operations are applied, the order of `AccountRepository.apply_transfer`,
+    so concurrent batches and transfers do not deadlock each other.
+
+    `deposit` and `withdraw` return a Future completed with the new balance
+    or with the ValueError/DoesNotExist of that operation. If the batch
+    can not be committed all its futures fail with the same exception."""
+
+    _stop = object()
+
+    def __init__(
+        self,
+        UnitOfWork,
+        max_batch_size: int = 64,
+        max_delay: float = 0.002,
+        calendar: domain.WithdrawalCalendar = None,
+    ):
+        self.UnitOfWork = UnitOfWork
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.calendar = calendar or domain.WithdrawalCalendar()
+        self.batches = 0
+        self.operations = 0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="group-commit", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Applies the operations already submitted and stops the thread"""
+
+        self._queue.put(self._stop)
+        self._thread.join()
+
+    def deposit(self, id: int, value: domain.Money) -> Future:
+        return self._submit("apply_deposit", domain.Account.deposit_amount, id, value)
+
+    def withdraw(self, id: int, value: domain.Money) -> Future:
+        return self._submit(
+            "apply_withdraw",
+            domain.Account.withdraw_amount,
+            id,
+            value,
+            self.calendar.day(),
+        )
+
+    def _submit(self, operation, validate, id, value, *arguments) -> Future:
+        future = Future()
+
+        try:
+            amount = validate(value)
+        except ValueError as exc:
+            future.set_exception(exc)
+        else:
+            self._queue.put((future, operation, id, (amount, *arguments)))
+
+        return future
+
+    def _run(self) -> None:
+        stopping = False
+
+        while not stopping:
+            item = self._queue.get()
+
+            if item is self._stop:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+
+                if item is self._stop:
+                    stopping = True
+                    break
+
+                batch.append(item)
+
+            self._apply(batch)
+
+    def _apply(self, batch) -> None:
+        results = []
+
+        try:
+            with self.UnitOfWork as uow:
+                uow.accounts.lock(sorted({id for _, _, id, _ in batch}), key_share=True)
+
+                for future, operation, id, arguments in batch:
+                    try:
+                        balance = getattr(uow.accounts, operation)(id, *arguments)
+                    except (ValueError, exceptions.DoesNotExist) as exc:
+                        results.append((future, None, exc))
+                    else:
+                        results.append((future, balance, None))
+
+                uow.commit()
+        except Exception as exc:
+            LOGGER.exception("Could not commit a batch of %d operations", len(batch))
+
+            for future, *_ in batch:
+                future.set_exception(exc)
+
+            return
+
+        self.batches += 1
+        self.operations += len(batch)
+
+        for future, balance, exc in results:
+            if exc is None:
+                future.set_result(balance)
+            else:
+                future.set_exception(exc)
+
+
 class AccountBlockCommand(Command):
     """Fetch an account and sets it as blocked"""
 
+    @retryable
     def __call__(self, id: int):
         with self.UnitOfWork as uow:
             account = uow.accounts.fetch(id)
@@ -104,8 +495,10 @@ class AccountBlockCommand(Command):
 class AccountTransactionsDetailCommand(Command):
     """Retrieves the account transaction details by date interval"""
 
+    read_only = True
+
     def __call__(self, account_id: int, since: datetime, until: datetime):
-        with self.UnitOfWork as uow:
+        with self.unit_of_work as uow:
             transactions = uow.transactions.filter_by_interval(
                 account_id=account_id, since=since, until=until
             )
@@ -113,13 +506,774 @@ class AccountTransactionsDetailCommand(Command):
         return transactions
 
 
-def get_commands(uow: AbstractUnitOfWork) -> dict:
+class AccountBalanceAtCommand(Command):
+    """Retrieves the balance an account had at a past moment"""
+
+    read_only = True
+
+    def __call__(self, id: int, as_of: datetime) -> domain.Money:
+        with self.unit_of_work as uow:
+            balance = uow.checkpoints.balance_at(id, _as_utc(as_of))
+
+        return balance
+
+
+class AccountTransactionsSummaryCommand(Command):
+    """Sums up the account transactions by date interval"""
+
+    read_only = True
+
+    def __call__(
+        self, account_id: int, since: datetime, until: datetime = None
+    ) -> domain.TransactionsSummary:
+        with self.unit_of_work as uow:
+            rows = uow.transactions.flows_by_interval(
+                account_id=account_id, since=since, until=until
+            )
+            opening_balance = uow.checkpoints.balance_at(
+                account_id, since - timedelta(microseconds=1)
+            )
+
+        return summarize_transactions(rows, opening_balance)
+
+
+def summarize_transactions(
+    rows: List[Tuple[int, int, int]], opening_balance: domain.Money
+) -> domain.TransactionsSummary:
+    """Sums up the `(created_at, withdraw, value)` integer transaction rows
+    read by `TransactionRepository.flows_by_interval`, starting from the
+    `opening_balance`.
+
+    The rows are loaded once into NumPy columns, the creation dates as
+    datetime64 microseconds, the withdraw flags and the values in cents,
+    and everything else is computed by vectorized operations."""
+
+    columns = np.array(rows, dtype=np.int64).reshape(-1, 3)
+    withdraws = columns[:, 1].astype(bool)
+    cents = columns[:, 2]
+    flows = np.where(withdraws, -cents, cents)
+
+    days, day_of_row = np.unique(
+        columns[:, 0].view("datetime64[us]").astype("datetime64[D]"),
+        return_inverse=True,
+    )
+    daily_flows = np.zeros(days.size, dtype=np.int64)
+    np.add.at(daily_flows, day_of_row, flows)
+    balances = opening_balance.cents + np.cumsum(daily_flows)
+    net_flow = domain.Money(int(flows.sum()))
+
+    return domain.TransactionsSummary(
+        opening_balance=opening_balance,
+        closing_balance=opening_balance + net_flow,
+        net_flow=net_flow,
+        deposits=_transactions_total(cents[~withdraws]),
+        withdraws=_transactions_total(cents[withdraws]),
+        days=[
+            domain.DailyBalance(day, domain.Money(flow), domain.Money(balance))
+            for day, flow, balance in zip(
+                days.tolist(), daily_flows.tolist(), balances.tolist()
+            )
+        ],
+    )
+
+
+def _transactions_total(cents: np.ndarray) -> domain.TransactionsTotal:
+    if not cents.size:
+        return domain.TransactionsTotal(count=0, total=domain.Money(0))
+
+    return domain.TransactionsTotal(
+        count=int(cents.size),
+        total=domain.Money(int(cents.sum())),
+        min=domain.Money(int(cents.min())),
+        max=domain.Money(int(cents.max())),
+        mean=domain.Money(int(np.rint(cents.mean()))),
+    )
+
+
+def _as_utc(moment: datetime) -> datetime:
+    """Converts an aware datetime to the naive UTC used by the database"""
+
+    if moment.tzinfo is None:
+        return moment
+
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def encode_cursor(transaction: domain.Transaction) -> str:
+    """Encodes the position of a transaction as an opaque page cursor"""
+
+    position = [transaction.created_at.isoformat(), transaction.id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Decodes a page cursor to the `(created_at, id)` position it holds"""
+
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(id)
+    except (ValueError, TypeError):
+        raise ValueError("The cursor '%s' is not valid" % cursor) from None
+
+
+class AccountTransactionsPageCommand(Command):
+    """Retrieves a page of the account transactions by date interval.
+
+    Returns the transactions and the cursor of the next page, which is
+    None in the last page"""
+
+    read_only = True
+
+    def __call__(
+        self,
+        account_id: int,
+        since: datetime,
+        until: datetime = None,
+        limit: int = 100,
+        cursor: str = None,
+    ) -> Tuple[List[domain.Transaction], Optional[str]]:
+        after = decode_cursor(cursor) if cursor is not None else None
+
+        with self.unit_of_work as uow:
+            transactions = uow.transactions.page_by_interval(
+                account_id=account_id,
+                since=since,
+                until=until,
+                limit=limit + 1,
+                after=after,
+            )
+
+        if len(transactions) <= limit:
+            return transactions, None
+
+        return transactions[:limit], encode_cursor(transactions[limit - 1])
+
+
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _ndjson_lines(rows: Iterable[tuple]) -> Iterator[str]:
+    for id, created_at, type, value in rows:
+        transaction = {
+            "id": id,
+            "type": type.value,
+            "value": str(value),
+            "created_at": created_at.isoformat(),
+        }
+        yield json.dumps(transaction) + "\n"
+
+
+def _csv_lines(rows: Iterable[tuple]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(("id", "type", "value", "created_at"))
+
+    for id, created_at, type, value in rows:
+        writer.writerow((id, type.value, value, created_at.isoformat()))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def export_chunks(
+    rows: Iterable[tuple],
+    format: str = "ndjson",
+    compress: bool = False,
+    rows_per_chunk: int = 1000,
+) -> Iterator[bytes]:
+    """Serializes the `(id, created_at, type, value)` transaction rows as
+    NDJSON or CSV, `rows_per_chunk` rows per chunk.
+
+    With `compress` the chunks are a gzip stream. Every chunk is flushed
+    by the compressor, so the client can decode them as they arrive."""
+
+    if format not in EXPORT_MEDIA_TYPES:
+        raise ValueError("The export format '%s' is not supported" % format)
+
+    lines = _csv_lines(rows) if format == "csv" else _ndjson_lines(rows)
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+
+    while True:
+        chunk = "".join(itertools.islice(lines, rows_per_chunk)).encode()
+
+        if not chunk:
+            break
+        elif compressor is not None:
+            chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        yield chunk
+
+    if compressor is not None:
+        yield compressor.flush()
+
+
+class AccountTransactionsExportCommand(Command):
+    """Exports the account transactions by date interval as a stream of
+    NDJSON or CSV chunks.
+
+    The account is looked up before returning, so a missing account is
+    raised by the call. The stream opens its own unit of work when it is
+    first iterated and reads the transactions while it is consumed, so a
+    stream which is never iterated holds no connection"""
+
+    read_only = True
+
+    def __call__(
+        self,
+        account_id: int,
+        since: datetime,
+        until: datetime = None,
+        format: str = "ndjson",
+        compress: bool = False,
+    ) -> Iterator[bytes]:
+        if format not in EXPORT_MEDIA_TYPES:
+            raise ValueError("The export format '%s' is not supported" % format)
+
+        with self.unit_of_work as uow:
+            uow.accounts.fetch(account_id)
+
+        return self._stream(account_id, since, until, format, compress)
+
+    def _stream(self, account_id, since, until, format, compress) -> Iterator[bytes]:
+        with self.unit_of_work as uow:
+            rows = uow.transactions.stream_by_interval(
+                account_id=account_id, since=since, until=until
+            )
+            yield from export_chunks(rows, format, compress)
+
+
+# The synchronous commands by the name used by `get_commands`
+COMMANDS = {
+    "person_register": PersonRegisterCommand,
+    "account_register": AccountRegisterCommand,
+    "account_deposit": AccountDepositValueCommand,
+    "account_fetch": AccountFetchCommand,
+    "accounts_fetch_many": AccountFetchManyCommand,
+    "account_withdraw": AccountWithddrawValueCommand,
+    "account_atomic_deposit": AccountAtomicDepositCommand,
+    "account_atomic_withdraw": AccountAtomicWithdrawCommand,
+    "account_transfer": AccountTransferCommand,
+    "account_block": AccountBlockCommand,
+    "account_transactions": AccountTransactionsDetailCommand,
+    "account_transactions_page": AccountTransactionsPageCommand,
+    "account_transactions_export": AccountTransactionsExportCommand,
+    "account_balance_at": AccountBalanceAtCommand,
+    "account_transactions_summary": AccountTransactionsSummaryCommand,
+}
+
+
+def get_commands(
+    uow: AbstractUnitOfWork,
+    retry_policy: RetryPolicy = None,
+    calendar: domain.WithdrawalCalendar = None,
+) -> dict:
+    return {
+        name: command(uow, retry_policy, calendar) for name, command in COMMANDS.items()
+    }
+
+
+class AsyncPersonRegisterCommand(Command):
+    """Register a person using an AsyncSqlUnitOfWork"""
+
+    async def __call__(self, name, cpf, born_at):
+        async with self.UnitOfWork as uow:
+            person = domain.Person.new(
+                name=name,
+                cpf=cpf,
+                born_at=born_at,
+            )
+            await uow.people.add(person)
+
+        return person
+
+
+class AsyncAccountRegisterCommand(Command):
+    """Register an user using an AsyncSqlUnitOfWork"""
+
+    async def __call__(self, person_id, type_id):
+        async with self.UnitOfWork as uow:
+            await uow.people.fetch(person_id)
+            account = domain.Account.new()
+            account.type = type_id
+            account.person_id = person_id
+            await uow.accounts.add(account)
+
+        return account
+
+
+class AsyncAccountDepositValueCommand(Command):
+    """Obtain an account using the account id then deposit
+    a value to the account using an AsyncSqlUnitOfWork"""
+
+    @retryable
+    async def __call__(self, id: int, value: domain.Money):
+        async with self.UnitOfWork as uow:
+            account = await uow.accounts.fetch(id)
+            account.deposit(value)
+            transaction = domain.Transaction.new(
+                account_id=account.id,
+                value=value,
+                type=domain.TransactionTypeEnum.deposit,
+                created_at=datetime.utcnow(),
+            )
+            account.add_transaction(transaction)
+            await uow.transactions.add(transaction)
+            await uow.checkpoints.record(
+                account.id, transaction.created_at.date(), account.balance
+            )
+
+        return account
+
+
+class AsyncAccountFetchCommand(Command):
+    """Obtain an account using the account id and an AsyncSqlUnitOfWork"""
+
+    read_only = True
+
+    async def __call__(self, id: int):
+        async with self.unit_of_work as uow:
+            account = await uow.accounts.fetch(id)
+
+        return account
+
+
+class AsyncAccountFetchManyCommand(Command):
+    """Obtain many accounts using their ids and an AsyncSqlUnitOfWork"""
+
+    read_only = True
+
+    async def __call__(self, ids: List[int]) -> Tuple[List[domain.Account], List[int]]:
+        async with self.unit_of_work as uow:
+            accounts, missing = await uow.accounts.fetch_many(ids)
+
+        return accounts, missing
+
+
+class AsyncAccountWithddrawValueCommand(Command):
+    """Obtain an account using the account id then withdraw
+    a value from the account using an AsyncSqlUnitOfWork"""
+
+    @retryable
+    async def __call__(self, id: int, value: domain.Money):
+        async with self.UnitOfWork as uow:
+            account = await uow.accounts.fetch(id)
+            account.withdraw(value, self.calendar.day())
+            transaction = domain.Transaction.new(
+                account_id=account.id,
+                value=value,
+                type=domain.TransactionTypeEnum.withdraw,
+                created_at=datetime.utcnow(),
+            )
+            account.add_transaction(transaction)
+            await uow.transactions.add(transaction)
+            await uow.checkpoints.record(
+                account.id, transaction.created_at.date(), account.balance
+            )
+
+        return account
+
+
+class AsyncAccountAtomicDepositCommand(Command):
+    """Deposit a value to the account without loading it using an
+    AsyncSqlUnitOfWork. Returns the new account balance, or the balance
+    answered to the first request sent with the `idempotency_key`"""
+
+    async def __call__(
+        self, id: int, value: domain.Money, idempotency_key: str = None
+    ) -> domain.Money:
+        amount = domain.Account.deposit_amount(value)
+        request = _idempotent_request("deposit", id, amount)
+
+        async with self.UnitOfWork as uow:
+            if idempotency_key is not None:
+                stored = await uow.idempotency_keys.claim(idempotency_key, request)
+
+                if stored is not None:
+                    return stored.balance
+
+            balance = await uow.accounts.apply_deposit(id, amount)
+
+            if idempotency_key is not None:
+                await uow.idempotency_keys.complete(idempotency_key, request, balance)
+
+        return balance
+
+
+class AsyncAccountAtomicWithdrawCommand(Command):
+    """Withdraw a value from the account without loading it using an
+    AsyncSqlUnitOfWork. Returns the new account balance, or the balance
+    answered to the first request sent with the `idempotency_key`"""
+
+    async def __call__(
+        self, id: int, value: domain.Money, idempotency_key: str = None
+    ) -> domain.Money:
+        amount = domain.Account.withdraw_amount(value)
+        request = _idempotent_request("withdraw", id, amount)
+
+        async with self.UnitOfWork as uow:
+            if idempotency_key is not None:
+                stored = await uow.idempotency_keys.claim(idempotency_key, request)
+
+                if stored is not None:
+                    return stored.balance
+
+            balance = await uow.accounts.apply_withdraw(id, amount, self.calendar.day())
+
+            if idempotency_key is not None:
+                await uow.idempotency_keys.complete(idempotency_key, request, balance)
+
+        return balance
+
+
+class AsyncAccountTransferCommand(Command):
+    """Transfer a value between two accounts using an AsyncSqlUnitOfWork.
+    Returns the new balance of the source account, or the balance answered
+    to the first request sent with the `idempotency_key`"""
+
+    async def __call__(
+        self,
+        source_id: int,
+        target_id: int,
+        value: domain.Money,
+        idempotency_key: str = None,
+    ) -> domain.Money:
+        amount = _transfer_amount(source_id, target_id, value)
+        request = _idempotent_request(
+            "transfer", "%s:%s" % (source_id, target_id), amount
+        )
+
+        async with self.UnitOfWork as uow:
+            if idempotency_key is not None:
+                stored = await uow.idempotency_keys.claim(idempotency_key, request)
+
+                if stored is not None:
+                    return stored.balance
+
+            balance = await uow.accounts.apply_transfer(
+                source_id, target_id, amount, self.calendar.day()
+            )
+
+            if idempotency_key is not None:
+                await uow.idempotency_keys.complete(idempotency_key, request, balance)
+
+        return balance
+
+
+class AsyncAccountBlockCommand(Command):
+    """Fetch an account and sets it as blocked using an AsyncSqlUnitOfWork"""
+
+    @retryable
+    async def __call__(self, id: int):
+        async with self.UnitOfWork as uow:
+            account = await uow.accounts.fetch(id)
+            account.block()
+            await uow.accounts.add(account)
+
+        return account
+
+
+class AsyncAccountTransactionsDetailCommand(Command):
+    """Retrieves the account transaction details by date interval
+    using an AsyncSqlUnitOfWork"""
+
+    read_only = True
+
+    async def __call__(self, account_id: int, since: datetime, until: datetime):
+        async with self.unit_of_work as uow:
+            transactions = await uow.transactions.filter_by_interval(
+                account_id=account_id, since=since, until=until
+            )
+
+        return transactions
+
+
+class AsyncAccountBalanceAtCommand(Command):
+    """Retrieves the balance an account had at a past moment using an
+    AsyncSqlUnitOfWork"""
+
+    read_only = True
+
+    async def __call__(self, id: int, as_of: datetime) -> domain.Money:
+        async with self.unit_of_work as uow:
+            balance = await uow.checkpoints.balance_at(id, _as_utc(as_of))
+
+        return balance
+
+
+class AsyncAccountTransactionsSummaryCommand(Command):
+    """Sums up the account transactions by date interval using an
+    AsyncSqlUnitOfWork. The rows are summed up by its executor"""
+
+    read_only = True
+
+    async def __call__(
+        self, account_id: int, since: datetime, until: datetime = None
+    ) -> domain.TransactionsSummary:
+        async with self.unit_of_work as uow:
+            rows = await uow.transactions.flows_by_interval(
+                account_id=account_id, since=since, until=until
+            )
+            opening_balance = await uow.checkpoints.balance_at(
+                account_id, since - timedelta(microseconds=1)
+            )
+
+        return await uow.run(summarize_transactions, rows, opening_balance)
+
+
+class AsyncAccountTransactionsPageCommand(Command):
+    """Retrieves a page of the account transactions by date interval
+    using an AsyncSqlUnitOfWork.
+
+    Returns the transactions and the cursor of the next page, which is
+    None in the last page"""
+
+    read_only = True
+
+    async def __call__(
+        self,
+        account_id: int,
+        since: datetime,
+        until: datetime = None,
+        limit: int = 100,
+        cursor: str = None,
+    ) -> Tuple[List[domain.Transaction], Optional[str]]:
+        after = decode_cursor(cursor) if cursor is not None else None
+
+        async with self.unit_of_work as uow:
+            transactions = await uow.transactions.page_by_interval(
+                account_id=account_id,
+                since=since,
+                until=until,
+                limit=limit + 1,
+                after=after,
+            )
+
+        if len(transactions) <= limit:
+            return transactions, None
+
+        return transactions[:limit], encode_cursor(transactions[limit - 1])
+
+
+class AsyncAccountTransactionsExportCommand(Command):
+    """Exports the account transactions by date interval as a stream of
+    NDJSON or CSV chunks using an AsyncSqlUnitOfWork.
+
+    Reading and serializing every chunk runs in the unit of work executor,
+    so the event loop is free while the rows are fetched. As with the
+    synchronous command, the stream opens its unit of work when it is
+    first iterated"""
+
+    read_only = True
+
+    async def __call__(
+        self,
+        account_id: int,
+        since: datetime,
+        until: datetime = None,
+        format: str = "ndjson",
+        compress: bool = False,
+    ) -> AsyncIterator[bytes]:
+        if format not in EXPORT_MEDIA_TYPES:
+            raise ValueError("The export format '%s' is not supported" % format)
+
+        async with self.unit_of_work as uow:
+            await uow.accounts.fetch(account_id)
+
+        return self._stream(account_id, since, until, format, compress)
+
+    async def _stream(
+        self, account_id, since, until, format, compress
+    ) -> AsyncIterator[bytes]:
+        async with self.unit_of_work as uow:
+            rows = await uow.transactions.stream_by_interval(
+                account_id=account_id, since=since, until=until
+            )
+            chunks = export_chunks(rows, format, compress)
+
+            while True:
+                chunk = await uow.run(next, chunks, None)
+
+                if chunk is None:
+                    break
+
+                yield chunk
+
+
+# The asyncio commands by the name used by `get_async_commands`
+ASYNC_COMMANDS = {
+    "person_register": AsyncPersonRegisterCommand,
+    "account_register": AsyncAccountRegisterCommand,
+    "account_deposit": AsyncAccountDepositValueCommand,
+    "account_fetch": AsyncAccountFetchCommand,
+    "accounts_fetch_many": AsyncAccountFetchManyCommand,
+    "account_withdraw": AsyncAccountWithddrawValueCommand,
+    "account_atomic_deposit": AsyncAccountAtomicDepositCommand,
+    "account_atomic_withdraw": AsyncAccountAtomicWithdrawCommand,
+    "account_transfer": AsyncAccountTransferCommand,
+    "account_block": AsyncAccountBlockCommand,
+    "account_transactions": AsyncAccountTransactionsDetailCommand,
+    "account_transactions_page": AsyncAccountTransactionsPageCommand,
+    "account_transactions_export": AsyncAccountTransactionsExportCommand,
+    "account_balance_at": AsyncAccountBalanceAtCommand,
+    "account_transactions_summary": AsyncAccountTransactionsSummaryCommand,
+}
+
+
+def get_async_commands(
+    uow: AbstractUnitOfWork,
+    retry_policy: RetryPolicy = None,
+    calendar: domain.WithdrawalCalendar = None,
+) -> dict:
     return {
-        "person_register": PersonRegisterCommand(uow),
-        "account_register": AccountRegisterCommand(uow),
-        "account_deposit": AccountDepositValueCommand(uow),
-        "account_fetch": AccountFetchCommand(uow),
-        "account_withdraw": AccountWithddrawValueCommand(uow),
-        "account_block": AccountBlockCommand(uow),
-        "account_transactions": AccountTransactionsDetailCommand(uow),
+        name: command(uow, retry_policy, calendar)
+        for name, command in ASYNC_COMMANDS.items()
     }
+
+
+class CommandBus:
+    """Dispatches the commands by their class through a middleware chain.
+
+    The commands are registered once, usually at startup, and the chain of
+    each command is built at its registration, so a dispatch only looks up
+    the command class and creates the command over the unit of work of the
+    caller. The `middlewares` are given from the outermost to the innermost,
+    see `TimingMiddleware`, `RetryMiddleware` and `LoggingMiddleware`."""
+
+    def __init__(
+        self,
+        commands: Iterable[type] = (),
+        middlewares: Iterable = (),
+        calendar: domain.WithdrawalCalendar = None,
+    ):
+        self.middlewares = list(middlewares)
+        self.calendar = calendar or domain.WithdrawalCalendar()
+        self._handlers = {}
+
+        for command in commands:
+            self.register(command)
+
+    def register(self, command: type) -> None:
+        calendar = self.calendar
+
+        def handler(uow, *args, **kwargs):
+            return command(uow, calendar=calendar)(*args, **kwargs)
+
+        for middleware in reversed(self.middlewares):
+            handler = middleware.wrap(command, handler)
+
+        self._handlers[command] = handler
+
+    def dispatch(self, command: type, uow: AbstractUnitOfWork, *args, **kwargs):
+        """Runs the command over the unit of work with the arguments.
+
+        Returns the result of the command, which is awaited when it is an
+        asyncio command. Raises LookupError for unregistered commands."""
+
+        try:
+            handler = self._handlers[command]
+        except KeyError:
+            raise LookupError(
+                "The command %s is not registered" % command.__name__
+            ) from None
+
+        return handler(uow, *args, **kwargs)
+
+
+def _is_async(command: type) -> bool:
+    return asyncio.iscoroutinefunction(command.__call__)
+
+
+class TimingMiddleware:
+    """Observes the duration of the commands, failed ones included, in the
+    histogram labeled by the command class name"""
+
+    def __init__(self, histograms: metrics.HistogramFamily):
+        self.histograms = histograms
+
+    def wrap(self, command: type, handler):
+        histogram = self.histograms.labels(command.__name__)
+        clock = time.perf_counter
+
+        if _is_async(command):
+
+            async def timed_async(uow, *args, **kwargs):
+                started = clock()
+
+                try:
+                    return await handler(uow, *args, **kwargs)
+                finally:
+                    histogram.observe(clock() - started)
+
+            return timed_async
+
+        def timed(uow, *args, **kwargs):
+            started = clock()
+
+            try:
+                return handler(uow, *args, **kwargs)
+            finally:
+                histogram.observe(clock() - started)
+
+        return timed
+
+
+class RetryMiddleware:
+    """Retries the commands marked as `retryable` with the policy. The
+    other commands are dispatched as they are."""
+
+    def __init__(self, retry_policy: RetryPolicy):
+        self.retry_policy = retry_policy
+
+    def wrap(self, command: type, handler):
+        if not getattr(command.__call__, "retryable", False):
+            return handler
+        elif _is_async(command):
+            return functools.partial(self.retry_policy.call_async, handler)
+
+        return functools.partial(self.retry_policy, handler)
+
+
+class LoggingMiddleware:
+    """Logs the commands dispatched, their duration and their failures"""
+
+    def __init__(self, logger: logging.Logger = LOGGER, level: int = logging.DEBUG):
+        self.logger = logger
+        self.level = level
+
+    def wrap(self, command: type, handler):
+        name = command.__name__
+        logger, level = self.logger, self.level
+
+        if _is_async(command):
+
+            async def logged_async(uow, *args, **kwargs):
+                started = time.perf_counter()
+
+                try:
+                    result = await handler(uow, *args, **kwargs)
+                except Exception as exc:
+                    logger.log(level, "Command %s failed: %r", name, exc)
+                    raise
+
+                logger.log(
+                    level, "Command %s took %.6fs", name, time.perf_counter() - started
+                )
+                return result
+
+            return logged_async
+
+        def logged(uow, *args, **kwargs):
+            started = time.perf_counter()
+
+            try:
+                result = handler(uow, *args, **kwargs)
+            except Exception as exc:
+                logger.log(level, "Command %s failed: %r", name, exc)
+                raise
+
+            logger.log(
+                level, "Command %s took %.6fs", name, time.perf_counter() - started
+            )
+            return result
+
+        return logged
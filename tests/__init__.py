@@ -1,35 +1,11 @@
 from datetime import date
-from decimal import Decimal
 from random import randint
 
-from banking.adapters import metadata, sqlalchemy_schema, start_mappers
+from banking.adapters import MoneyCents, metadata, sqlalchemy_schema, start_mappers
 from banking.domain import Account, Person, Transaction, TransactionTypeEnum
-from sqlalchemy import TypeDecorator, Integer, create_engine
+from sqlalchemy import create_engine
 from sqlalchemy.orm import clear_mappers, sessionmaker
-
-
-class SQLiteNumeric(TypeDecorator):
-    """Helper class to handle the decimal number in the SQLite database.
-
-    It will translate the decimal to an Integer notation and translate back
-    to Decimal type in Python."""
-
-    impl = Integer
-
-    def __init__(self, base, scale):
-        TypeDecorator.__init__(self)
-        self.scale = scale
-        self.multiplier_int = base ** self.scale
-
-    def process_bind_param(self, value, dialect):
-        if value is not None:
-            value = int(Decimal(value) * self.multiplier_int)
-        return value
-
-    def process_result_value(self, value, dialect):
-        if value is not None:
-            value = Decimal(value) / self.multiplier_int
-        return value
+from sqlalchemy.pool import StaticPool
 
 
 class DatabaseInMemoryMixin:
@@ -38,12 +14,16 @@ class DatabaseInMemoryMixin:
     purged after another test starts.
 
     Its necessary to call the super().setUp() if you override the setUp
-    method."""
+    method. Set `event_sourced` to map the accounts as event-sourced."""
+
+    event_sourced = False
 
     def setUp(self):
         metadata.clear()
         clear_mappers()
-        self.schema = sqlalchemy_schema(Numeric=SQLiteNumeric)
+        self.schema = sqlalchemy_schema(
+            Money=MoneyCents, event_sourced=self.event_sourced
+        )
         self.engine = create_in_memory_engine()
         start_mappers(**self.schema)
         self.session_factory = sessionmaker(bind=self.engine)
@@ -51,9 +31,16 @@ class DatabaseInMemoryMixin:
 
 
 def create_in_memory_engine():
-    """Creates an in memory database using sqlite"""
+    """Creates an in memory database using sqlite.
 
-    engine = create_engine("sqlite:///")
+    The same connection is shared by all threads, so the database work
+    done by the executor of AsyncSqlUnitOfWork sees the same data."""
+
+    engine = create_engine(
+        "sqlite:///",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
     metadata.create_all(engine)
     return engine
 
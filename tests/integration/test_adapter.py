@@ -1,8 +1,28 @@
+import asyncio
+import threading
 import unittest
+from datetime import date
+from decimal import Decimal
+
+from sqlalchemy import create_engine
 
 from banking import exceptions, interfaces
-from banking.adapters import SqlUnitOfWork, metadata
-from tests import DatabaseInMemoryMixin, create_account
+from banking.cache import AccountCache
+from banking.adapters import (
+    AsyncSqlUnitOfWork,
+    InstrumentedQueuePool,
+    PoolMetrics,
+    QueryTimer,
+    ReplicaRouter,
+    SqlSessionFactory,
+    SqlUnitOfWork,
+    create_transactions_partitions,
+    metadata,
+    monthly_partitions,
+)
+from banking.metrics import RequestTiming, current_request_timing
+from banking.services import get_commands
+from tests import DatabaseInMemoryMixin, create_account, create_in_memory_engine
 
 
 class TestSqlAlchemyTableDeclaration(DatabaseInMemoryMixin, unittest.TestCase):
@@ -15,6 +35,32 @@ class TestSqlAlchemyTableDeclaration(DatabaseInMemoryMixin, unittest.TestCase):
     def test_should_creates_the_accounts_table(self):
         self.assertTrue("accounts" in metadata.tables.keys())
 
+    def test_should_index_the_transactions_by_account_and_creation_date(self):
+        indexes = {
+            index.name: [column.key for column in index.columns]
+            for index in metadata.tables["transactions"].indexes
+        }
+        self.assertEqual(
+            ["account_id", "created_at"],
+            indexes["ix_transactions_account_id_created_at"],
+        )
+
+
+class TestTransactionsPartitions(unittest.TestCase):
+    def test_should_return_one_partition_per_month(self):
+        self.assertEqual(
+            [
+                ("transactions_y2020m11", date(2020, 11, 1), date(2020, 12, 1)),
+                ("transactions_y2020m12", date(2020, 12, 1), date(2021, 1, 1)),
+                ("transactions_y2021m01", date(2021, 1, 1), date(2021, 2, 1)),
+            ],
+            monthly_partitions(date(2020, 11, 17), 3),
+        )
+
+    def test_should_do_nothing_if_the_database_is_not_a_postgresql(self):
+        engine = create_engine("sqlite://")
+        self.assertEqual([], create_transactions_partitions(engine))
+
 
 class TestUnitOfWorkUsingSQLSession(DatabaseInMemoryMixin, unittest.TestCase):
     def test_should_be_possivel_add_an_account_and_retrive_it(self):
@@ -42,3 +88,241 @@ class TestUnitOfWorkUsingSQLSession(DatabaseInMemoryMixin, unittest.TestCase):
         with self.assertRaisesRegex(exceptions.DoesNotExist, "Does not exist"):
             with SqlUnitOfWork(self.session_factory) as uow:
                 uow.accounts.fetch(1)
+
+
+class TestOptimisticConcurrencyControl(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        with SqlUnitOfWork(self.session_factory) as uow:
+            uow.accounts.add(create_account(1))
+
+    def test_the_account_version_should_be_incremented_by_each_update(self):
+        with SqlUnitOfWork(self.session_factory) as uow:
+            self.assertEqual(1, uow.accounts.fetch(1).version)
+            uow.accounts.fetch(1).deposit("10")
+
+        with SqlUnitOfWork(self.session_factory) as uow:
+            uow.accounts.apply_deposit(1, Decimal("10"))
+
+        with SqlUnitOfWork(self.session_factory) as uow:
+            self.assertEqual(3, uow.accounts.fetch(1).version)
+
+    def test_should_raise_an_exception_when_the_account_was_changed_by_other_uow(
+        self,
+    ):
+        with self.assertRaises(exceptions.ConcurrentModification):
+            with SqlUnitOfWork(self.session_factory) as first:
+                first.accounts.fetch(1).deposit("10")
+
+                with SqlUnitOfWork(self.session_factory) as second:
+                    second.accounts.fetch(1).deposit("20")
+
+        with SqlUnitOfWork(self.session_factory) as uow:
+            self.assertEqual(Decimal("20"), uow.accounts.fetch(1).balance)
+
+
+class TestPoolMetrics(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine(
+            "sqlite://", poolclass=InstrumentedQueuePool, pool_size=2
+        )
+        self.metrics = PoolMetrics(self.engine)
+
+    def test_should_count_the_connections_in_use_and_idle(self):
+        connection = self.engine.connect()
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(1, snapshot["checkouts"])
+        self.assertEqual(1, snapshot["in_use"])
+        self.assertEqual(0, snapshot["idle"])
+
+        connection.close()
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(1, snapshot["checkins"])
+        self.assertEqual(0, snapshot["in_use"])
+        self.assertEqual(1, snapshot["idle"])
+        self.assertEqual(2, snapshot["size"])
+
+    def test_should_record_the_time_waited_for_a_connection(self):
+        self.engine.connect().close()
+        self.engine.connect().close()
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(2, snapshot["checkouts"])
+        self.assertEqual(1, snapshot["connects"])
+        self.assertGreater(snapshot["wait_seconds_total"], 0)
+        self.assertGreaterEqual(
+            snapshot["wait_seconds_max"], snapshot["wait_seconds_avg"]
+        )
+
+    def test_should_keep_the_metrics_when_the_pool_is_recreated(self):
+        self.engine.connect().close()
+        self.engine.dispose()
+        self.engine.connect().close()
+        self.assertIs(self.metrics, self.engine.pool.metrics)
+        self.assertEqual(2, self.metrics.snapshot()["checkouts"])
+
+
+class TestQueryTimer(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", poolclass=InstrumentedQueuePool)
+        QueryTimer(self.engine)
+        self.timing = RequestTiming()
+
+    def test_should_add_the_database_time_to_the_current_request(self):
+        token = current_request_timing.set(self.timing)
+
+        try:
+            with self.engine.connect() as connection:
+                connection.execute("SELECT 1")
+        finally:
+            current_request_timing.reset(token)
+
+        self.assertGreater(self.timing.phases["db_checkout"], 0)
+        self.assertGreater(self.timing.phases["db_sql"], 0)
+
+    def test_should_not_time_the_statements_outside_of_a_request(self):
+        with self.engine.connect() as connection:
+            connection.execute("SELECT 1")
+
+        self.assertEqual(0, self.timing.database())
+
+
+class TestReplicaRouter(unittest.TestCase):
+    def setUp(self):
+        self.replicas = [create_engine("sqlite://"), create_engine("sqlite://")]
+
+    def test_should_rotate_over_the_replicas(self):
+        router = ReplicaRouter(self.replicas)
+        picked = [router.pick() for _ in range(4)]
+        self.assertEqual(self.replicas * 2, picked)
+
+    def test_should_pick_the_replica_with_less_connections_in_use(self):
+        replicas = [
+            create_engine("sqlite://", poolclass=InstrumentedQueuePool),
+            create_engine("sqlite://", poolclass=InstrumentedQueuePool),
+        ]
+        router = ReplicaRouter(replicas, strategy="least_loaded")
+        connection = replicas[0].connect()
+        self.assertIs(replicas[1], router.pick())
+        connection.close()
+
+    def test_should_skip_the_replicas_behind_the_max_lag(self):
+        lags = {self.replicas[0]: 10.0, self.replicas[1]: 0.5}
+        router = ReplicaRouter(self.replicas, max_lag=1.0, lag_probe=lags.get)
+        self.assertEqual([self.replicas[1]] * 2, [router.pick(), router.pick()])
+
+    def test_should_return_none_if_no_replica_could_be_probed(self):
+        def probe(engine):
+            raise ConnectionError
+
+        router = ReplicaRouter(self.replicas, max_lag=1.0, lag_probe=probe)
+        self.assertIsNone(router.pick())
+
+    def test_should_not_accept_an_unknown_strategy(self):
+        with self.assertRaisesRegex(ValueError, "Unknown replica routing strategy"):
+            ReplicaRouter(self.replicas, strategy="random")
+
+
+class TestReadReplicaRouting(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.replica = create_in_memory_engine()
+        self.factory = SqlSessionFactory(
+            self.engine, replicas=ReplicaRouter([self.replica])
+        )
+
+        replica_account = create_account(1)
+        replica_account.active = False
+
+        with SqlUnitOfWork(self.factory) as uow:
+            uow.accounts.add(create_account(1))
+
+        with SqlUnitOfWork(SqlSessionFactory(self.replica)) as uow:
+            uow.accounts.add(replica_account)
+
+    def test_read_only_commands_should_read_from_the_replica(self):
+        commands = get_commands(SqlUnitOfWork(self.factory))
+        self.assertFalse(commands["account_fetch"](1).active)
+
+    def test_write_commands_should_use_the_primary(self):
+        commands = get_commands(SqlUnitOfWork(self.factory))
+        account = commands["account_deposit"](1, "10.00")
+        self.assertTrue(account.active)
+
+    def test_should_read_from_the_primary_when_no_replica_is_available(self):
+        self.factory.replicas.max_lag = 1.0
+        self.factory.replicas.lag_probe = lambda engine: 5.0
+        commands = get_commands(SqlUnitOfWork(self.factory))
+        self.assertTrue(commands["account_fetch"](1).active)
+
+    def test_should_not_probe_the_replicas_in_the_event_loop_thread(self):
+        threads = []
+
+        def probe(engine):
+            threads.append(threading.current_thread())
+            return 0.0
+
+        self.factory.replicas.max_lag = 1.0
+        self.factory.replicas.lag_probe = probe
+        unit_of_work = AsyncSqlUnitOfWork(self.factory).for_reading()
+
+        async def scenario():
+            async with unit_of_work as uow:
+                return await uow.accounts.fetch(1)
+
+        self.assertFalse(asyncio.run(scenario()).active)
+        self.assertEqual(1, len(threads))
+        self.assertIsNot(threading.main_thread(), threads[0])
+
+
+class TestAccountCacheUnitOfWork(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = AccountCache()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory, cache=self.cache)
+        self.commands = get_commands(self.unit_of_work)
+
+        with self.unit_of_work as uow:
+            account = create_account(account_id=1)
+            account.balance = Decimal("100")
+            uow.accounts.add(account)
+
+    def test_the_read_only_commands_should_read_through_the_cache(self):
+        self.commands["account_fetch"](1)
+        account = self.commands["account_fetch"](1)
+
+        self.assertEqual(Decimal("100"), account.balance)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_fetch_many_should_read_through_the_cache(self):
+        self.commands["account_fetch"](1)
+        accounts, missing = self.commands["accounts_fetch_many"]([1, 2])
+
+        self.assertEqual(Decimal("100"), accounts[0].balance)
+        self.assertEqual([2], missing)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(2, self.cache.misses)
+
+    def test_the_writes_should_invalidate_the_cached_account(self):
+        for command, value, balance in (
+            ("account_deposit", "10", Decimal("110")),
+            ("account_withdraw", "10", Decimal("100")),
+            ("account_atomic_deposit", "5", Decimal("105")),
+            ("account_atomic_withdraw", "5", Decimal("100")),
+        ):
+            self.commands["account_fetch"](1)
+            self.commands[command](1, value)
+            self.assertEqual(balance, self.commands["account_fetch"](1).balance)
+
+        self.commands["account_block"](1)
+        self.assertFalse(self.commands["account_fetch"](1).active)
+        self.assertEqual(5, self.cache.invalidations)
+
+    def test_a_rolled_back_write_should_not_invalidate_the_cached_account(self):
+        self.commands["account_fetch"](1)
+
+        with self.assertRaises(ValueError):
+            self.commands["account_atomic_withdraw"](1, "1000")
+
+        self.assertEqual(0, self.cache.invalidations)
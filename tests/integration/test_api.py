@@ -0,0 +1,129 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.orm import clear_mappers
+
+from banking.adapters import metadata
+from banking.domain import Money
+
+# The StreamingResponse of the pinned starlette hands coroutines to
+# asyncio.wait, which Python 3.11 refuses
+streaming = unittest.skipIf(
+    sys.version_info >= (3, 11), "starlette 0.13 can not stream on Python 3.11"
+)
+
+
+# The application reads its settings and builds its engine when it is
+# imported and its executor does not outlive its shutdown, so it is run
+# once, with the SQLite file of a temporary directory
+directory = None
+loop = None
+api = None
+client = None
+account_id = None
+
+
+def setUpModule():
+    global directory, loop, api, client, account_id
+
+    directory = tempfile.TemporaryDirectory()
+    os.environ.setdefault(
+        "SQLALCHEMY_DATABASE_URL",
+        "sqlite:///%s?check_same_thread=false"
+        % os.path.join(directory.name, "banking.db"),
+    )
+
+    from starlette.testclient import TestClient
+
+    from banking import api
+
+    # The test client of starlette 0.13 runs the application in the event
+    # loop of the thread, which asyncio.run of other tests unset
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    metadata.clear()
+    clear_mappers()
+    client = TestClient(api.app)
+    client.__enter__()
+
+    person = client.post(
+        "/people",
+        json={"name": "a", "cpf": "123.456.789-10", "born_at": "2000-01-01T00:00:00"},
+    ).json()
+    account_id = client.post(
+        "/accounts", json={"person_id": person["id"], "type_id": 1}
+    ).json()["id"]
+
+    for value in ("1.00", "2.50"):
+        client.patch(
+            "/accounts/%d/deposit" % account_id, json={"value": value}
+        ).raise_for_status()
+
+
+def tearDownModule():
+    client.__exit__(None, None, None)
+    asyncio.set_event_loop(None)
+    loop.close()
+    metadata.clear()
+    clear_mappers()
+    directory.cleanup()
+
+
+class TestMoneyEncoding(unittest.TestCase):
+    def test_should_answer_the_amounts_with_two_decimal_places(self):
+        response = client.get("/accounts/%d/balance" % account_id)
+        self.assertEqual("3.50", response.json()["balance"])
+
+    def test_should_encode_the_amounts_beyond_the_float_precision_exactly(self):
+        balance = api.AccountBalanceSchema(balance=Money(2 ** 53 + 1))
+        self.assertEqual("90071992547409.93", jsonable_encoder(balance)["balance"])
+
+
+class TestAccountTransactionsExportEndpoint(unittest.TestCase):
+    def export(self, **params):
+        params.setdefault(
+            "since", (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+        )
+        return client.get(
+            "/accounts/%d/transactions/export" % account_id, params=params
+        )
+
+    @streaming
+    def test_should_stream_the_transactions_as_ndjson(self):
+        response = self.export()
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(
+            response.headers["content-type"].startswith("application/x-ndjson")
+        )
+        self.assertEqual(
+            ["1.00", "2.50"],
+            [json.loads(line)["value"] for line in response.text.splitlines()],
+        )
+
+    @streaming
+    def test_should_stream_the_transactions_as_csv(self):
+        response = self.export(format="csv")
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+
+        self.assertEqual(200, response.status_code)
+        self.assertIn(
+            'filename="transactions-%d.csv"' % account_id,
+            response.headers["content-disposition"],
+        )
+        self.assertEqual(["deposit", "deposit"], [row["type"] for row in rows])
+
+    def test_should_answer_not_found_for_a_missing_account(self):
+        response = client.get("/accounts/999/transactions/export")
+        self.assertEqual(404, response.status_code)
+
+    def test_should_not_accept_an_unknown_format(self):
+        self.assertEqual(422, self.export(format="xml").status_code)
@@ -0,0 +1,287 @@
+import os
+import tempfile
+import unittest
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from banking.adapters import SqlSessionFactory, SqlUnitOfWork, metadata
+from banking.domain import (
+    Account,
+    AccountSnapshot,
+    BalanceCheckpoint,
+    BatchJobChunk,
+    IdempotencyKey,
+    Interest,
+    MaintenanceFee,
+    Money,
+    Transaction,
+    TransactionTypeEnum,
+)
+from banking.jobs import (
+    backfill_balance_checkpoints,
+    compact_account_snapshots,
+    posting_workers,
+    purge_idempotency_keys,
+    run_postings,
+)
+from tests import DatabaseInMemoryMixin, create_account, create_transaction
+
+
+class TestBackfillBalanceCheckpoints(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        yesterday = datetime.utcnow() - timedelta(days=1)
+
+        for id in range(1, 6):
+            account = create_account(account_id=id)
+            account.balance = Decimal("10")
+            self.session.add(account)
+            self.session.add(
+                create_transaction(
+                    id=None,
+                    account_id=id,
+                    value=id,
+                    type=TransactionTypeEnum.deposit,
+                    created_at=yesterday,
+                )
+            )
+
+        self.session.commit()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory)
+
+    def test_should_write_the_checkpoints_of_all_the_accounts_in_batches(self):
+        written = backfill_balance_checkpoints(self.unit_of_work, batch_size=2)
+        checkpoints = self.session.query(BalanceCheckpoint).all()
+
+        self.assertEqual(5, written)
+        self.assertEqual(
+            {id: Decimal("10") for id in range(1, 6)},
+            {checkpoint.account_id: checkpoint.balance for checkpoint in checkpoints},
+        )
+
+    def test_should_not_write_the_checkpoints_from_until_on(self):
+        written = backfill_balance_checkpoints(
+            self.unit_of_work, until=date.today() - timedelta(days=2)
+        )
+        self.assertEqual(0, written)
+
+
+class TestPurgeIdempotencyKeys(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        now = datetime.utcnow()
+
+        for number in range(5):
+            self.session.add(
+                IdempotencyKey(
+                    key="old-%d" % number,
+                    request="deposit:1:1",
+                    created_at=now - timedelta(days=2),
+                )
+            )
+
+        self.session.add(
+            IdempotencyKey(key="new", request="deposit:1:1", created_at=now)
+        )
+        self.session.commit()
+
+    def test_should_delete_the_expired_keys_in_batches(self):
+        deleted = purge_idempotency_keys(
+            SqlUnitOfWork(self.session_factory), timedelta(days=1), batch_size=2
+        )
+
+        self.assertEqual(5, deleted)
+        self.assertEqual(
+            ["new"], [key.key for key in self.session.query(IdempotencyKey).all()]
+        )
+
+
+class TestRunPostings(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_accounts(self.session)
+        self.unit_of_work = SqlUnitOfWork(self.session_factory)
+
+    @staticmethod
+    def add_accounts(session):
+        for id in range(1, 8):
+            account = create_account(account_id=id, person_id=id)
+            account.balance = Money(1000 * id)
+            session.add(account)
+
+        session.commit()
+
+    def balances(self):
+        self.session.expire_all()
+        return [account.balance for account in self.session.query(Account)]
+
+    def test_should_post_to_every_account_in_chunks(self):
+        report = run_postings(
+            self.unit_of_work, "fee-2021-01", MaintenanceFee(Money(1500)), 3
+        )
+
+        self.assertEqual((3, 7), (report.chunks, report.accounts))
+        self.assertEqual(
+            [Money(0)] + [Money(1000 * id - 1500) for id in range(2, 8)],
+            self.balances(),
+        )
+        self.assertEqual(
+            [(1, 3, 3), (4, 6, 3), (7, 9, 1)],
+            sorted(
+                (chunk.first_id, chunk.last_id, chunk.accounts)
+                for chunk in self.session.query(BatchJobChunk)
+            ),
+        )
+
+    def test_should_resume_from_the_chunks_left_undone(self):
+        self.session.add(BatchJobChunk(job="interest", first_id=1, last_id=3))
+        self.session.commit()
+
+        report = run_postings(
+            self.unit_of_work, "interest", Interest(Decimal("0.01")), 3
+        )
+
+        self.assertEqual((2, 4), (report.chunks, report.accounts))
+        self.assertEqual(
+            [Money(1000 * id) for id in range(1, 4)]
+            + [Money(1010 * id) for id in range(4, 8)],
+            self.balances(),
+        )
+
+        report = run_postings(
+            self.unit_of_work, "interest", Interest(Decimal("0.01")), 3
+        )
+
+        self.assertEqual((0, 0), (report.chunks, report.accounts))
+        self.assertEqual(4, self.session.query(Transaction).count())
+
+    def test_should_not_count_a_chunk_whose_commit_failed(self):
+        commit = SqlUnitOfWork.commit
+
+        def fail_the_second_chunk(uow):
+            if uow.session.query(BatchJobChunk).count() == 2:
+                raise OperationalError("COMMIT", {}, Exception("connection lost"))
+
+            commit(uow)
+
+        with mock.patch.object(
+            SqlUnitOfWork, "commit", autospec=True, side_effect=fail_the_second_chunk
+        ):
+            with self.assertRaisesRegex(RuntimeError, "the chunk 4-6 was not"):
+                run_postings(self.unit_of_work, "fee", MaintenanceFee(Money(100)), 3)
+
+        self.assertEqual(
+            [(1, 3, 3)],
+            [
+                (chunk.first_id, chunk.last_id, chunk.accounts)
+                for chunk in self.session.query(BatchJobChunk)
+            ],
+        )
+
+    def test_should_resume_with_another_chunk_size(self):
+        self.session.add(BatchJobChunk(job="interest", first_id=1, last_id=2))
+        self.session.add(BatchJobChunk(job="interest", first_id=5, last_id=6))
+        self.session.commit()
+
+        report = run_postings(
+            self.unit_of_work, "interest", Interest(Decimal("0.01")), 4
+        )
+
+        self.assertEqual((2, 3), (report.chunks, report.accounts))
+        self.assertEqual(
+            [(1, 2), (3, 4), (5, 6), (7, 10)],
+            sorted(
+                (chunk.first_id, chunk.last_id)
+                for chunk in self.session.query(BatchJobChunk)
+            ),
+        )
+        self.assertEqual(
+            [Money(1000), Money(2000), Money(3030), Money(4040)]
+            + [Money(5000), Money(6000), Money(7070)],
+            self.balances(),
+        )
+
+
+class TestEventSourcedJobs(DatabaseInMemoryMixin, unittest.TestCase):
+    event_sourced = True
+
+    def setUp(self):
+        super().setUp()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory)
+
+        with self.unit_of_work as uow:
+            for id in range(1, 6):
+                uow.accounts.add(create_account(account_id=id, person_id=id))
+
+        with self.unit_of_work as uow:
+            for id in range(1, 6):
+                for _ in range(id):
+                    uow.accounts.apply_deposit(id, Money(1000))
+
+    def balances(self):
+        with self.unit_of_work as uow:
+            return [
+                account.balance for account in uow.accounts.fetch_many(range(1, 6))[0]
+            ]
+
+    def test_should_snapshot_the_accounts_in_chunks(self):
+        written = compact_account_snapshots(self.unit_of_work, every=3, chunk_size=2)
+
+        self.assertEqual(3, written)
+        self.assertEqual(
+            [(3, Money(3000)), (4, Money(4000)), (5, Money(5000))],
+            [
+                (snapshot.account_id, snapshot.balance)
+                for snapshot in self.session.query(AccountSnapshot).order_by(
+                    AccountSnapshot.account_id
+                )
+            ],
+        )
+        self.assertEqual([Money(1000 * id) for id in range(1, 6)], self.balances())
+
+    def test_should_post_over_the_ledger_balances(self):
+        compact_account_snapshots(self.unit_of_work, every=1)
+        report = run_postings(self.unit_of_work, "fee", MaintenanceFee(Money(1500)))
+
+        self.assertEqual(5, report.accounts)
+        self.assertEqual(
+            [Money(0)] + [Money(1000 * id - 1500) for id in range(2, 6)],
+            self.balances(),
+        )
+
+
+class TestRunPostingsInWorkers(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+
+        # The worker processes need a database in a file
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.url = "sqlite:///%s" % os.path.join(directory.name, "banking.db")
+        self.engine = create_engine(self.url)
+        self.addCleanup(self.engine.dispose)
+        metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.addCleanup(self.session.close)
+        TestRunPostings.add_accounts(self.session)
+
+    def test_should_post_the_chunks_in_the_worker_processes(self):
+        with posting_workers(self.url, workers=2, money_column_type="cents") as pool:
+            report = run_postings(
+                SqlUnitOfWork(SqlSessionFactory(self.engine)),
+                "fee",
+                MaintenanceFee(Money(100)),
+                2,
+                pool,
+            )
+
+        self.assertEqual((4, 7), (report.chunks, report.accounts))
+        self.assertEqual(
+            [Money(1000 * id - 100) for id in range(1, 8)],
+            [account.balance for account in self.session.query(Account)],
+        )
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from banking.adapters import AsyncSqlUnitOfWork, SqlUnitOfWork
+from banking.domain import AccountEventTypeEnum, MaintenanceFee, Money, OutboxEvent
+from banking.jobs import run_postings
+from banking.outbox import FileSink, OutboxDispatcher, QueueSink
+from banking.services import WriteCoalescer, get_async_commands, get_commands
+from tests import DatabaseInMemoryMixin, create_account
+
+
+class FailingSink:
+    def publish(self, events):
+        raise ConnectionError("The sink is down")
+
+
+class TestPublishEvents(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory, publish_events=True)
+
+        with self.unit_of_work as uow:
+            for id in (1, 2):
+                uow.accounts.add(create_account(account_id=id, person_id=id))
+
+        self.commands = get_commands(self.unit_of_work)
+
+    def events(self):
+        return [
+            (event.type, event.account_id, event.value)
+            for event in self.session.query(OutboxEvent).order_by(OutboxEvent.id)
+        ]
+
+    def test_should_write_the_events_with_the_changes(self):
+        self.commands["account_atomic_deposit"](1, "10")
+        self.commands["account_atomic_withdraw"](1, "4")
+        self.commands["account_deposit"](2, Money(300))
+        self.commands["account_transfer"](1, 2, "1.50")
+        self.commands["account_block"](2)
+
+        self.assertEqual(
+            [
+                (AccountEventTypeEnum.deposit, 1, Money(1000)),
+                (AccountEventTypeEnum.withdraw, 1, Money(400)),
+                (AccountEventTypeEnum.deposit, 2, Money(300)),
+                (AccountEventTypeEnum.withdraw, 1, Money(150)),
+                (AccountEventTypeEnum.deposit, 2, Money(150)),
+                (AccountEventTypeEnum.block, 2, None),
+            ],
+            self.events(),
+        )
+
+    def test_should_write_the_events_of_the_async_commands(self):
+        unit_of_work = AsyncSqlUnitOfWork(self.session_factory, publish_events=True)
+        deposit = get_async_commands(unit_of_work)["account_atomic_deposit"]
+        asyncio.run(deposit(1, "10"))
+
+        self.assertEqual(
+            [(AccountEventTypeEnum.deposit, 1, Money(1000))], self.events()
+        )
+
+    def test_should_not_write_the_events_of_rejected_operations(self):
+        with self.assertRaises(ValueError):
+            self.commands["account_atomic_withdraw"](1, "4")
+
+        with self.unit_of_work as uow:
+            uow.accounts.apply_deposit(1, Money(100))
+            uow.rollback()
+
+        self.assertEqual([], self.events())
+
+    def test_should_write_the_events_of_a_group_commit_batch(self):
+        coalescer = WriteCoalescer(self.unit_of_work, max_delay=0.05)
+        coalescer.start()
+
+        try:
+            deposit = coalescer.deposit(1, "5")
+            withdraw = coalescer.withdraw(2, "5")
+            deposit.result(timeout=5)
+
+            with self.assertRaises(ValueError):
+                withdraw.result(timeout=5)
+        finally:
+            coalescer.stop()
+
+        self.assertEqual([(AccountEventTypeEnum.deposit, 1, Money(500))], self.events())
+
+    def test_should_write_the_events_of_the_postings(self):
+        self.commands["account_atomic_deposit"](1, "10")
+        run_postings(self.unit_of_work, "fee", MaintenanceFee(Money(300)))
+
+        self.assertEqual(
+            [
+                (AccountEventTypeEnum.deposit, 1, Money(1000)),
+                (AccountEventTypeEnum.withdraw, 1, Money(300)),
+            ],
+            self.events(),
+        )
+
+    def test_should_not_write_events_by_default(self):
+        get_commands(SqlUnitOfWork(self.session_factory))["account_atomic_deposit"](
+            1, "10"
+        )
+
+        self.assertEqual([], self.events())
+
+
+class TestOutboxDispatcher(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory, publish_events=True)
+
+        with self.unit_of_work as uow:
+            uow.accounts.add(create_account(account_id=1))
+
+        for _ in range(5):
+            get_commands(self.unit_of_work)["account_atomic_deposit"](1, "1")
+
+        self.sink = QueueSink()
+        self.dispatcher = OutboxDispatcher(
+            SqlUnitOfWork(self.session_factory), self.sink, batch_size=2
+        )
+
+    def test_should_deliver_the_events_in_batches(self):
+        self.assertEqual(2, self.dispatcher.dispatch())
+        self.assertEqual(3, self.dispatcher.drain())
+
+        delivered = [self.sink.queue.get_nowait() for _ in range(5)]
+        self.assertEqual([1, 2, 3, 4, 5], [event.id for event in delivered])
+        self.assertEqual(Money(100), delivered[0].value)
+        self.assertEqual(0, self.session.query(OutboxEvent).count())
+
+        metrics = self.dispatcher.snapshot()
+        self.assertEqual((5, 3), (metrics["delivered"], metrics["batches"]))
+        self.assertGreater(metrics["lag_seconds"], 0)
+
+        self.assertEqual(0, self.dispatcher.dispatch())
+        self.assertEqual(0, self.dispatcher.snapshot()["lag_seconds"])
+
+    def test_should_keep_the_events_when_the_sink_fails(self):
+        self.dispatcher.sink = FailingSink()
+
+        with self.assertRaises(ConnectionError):
+            self.dispatcher.dispatch()
+
+        self.assertEqual(5, self.session.query(OutboxEvent).count())
+        self.assertEqual(0, self.dispatcher.snapshot()["delivered"])
+
+    def test_should_append_the_events_to_a_file(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "outbox.jsonl")
+        self.dispatcher.sink = FileSink(path)
+
+        self.dispatcher.drain()
+
+        with open(path) as file:
+            events = [json.loads(line) for line in file]
+
+        self.assertEqual([1, 2, 3, 4, 5], [event["id"] for event in events])
+        self.assertEqual(
+            {"type": "deposit", "account_id": 1, "value": "1.00"},
+            {key: events[0][key] for key in ("type", "account_id", "value")},
+        )
+
+    def test_should_deliver_in_background_until_stopped(self):
+        self.dispatcher.interval = 0.01
+        self.dispatcher.start()
+
+        try:
+            events = [self.sink.queue.get(timeout=5) for _ in range(5)]
+        finally:
+            self.dispatcher.stop()
+
+        self.assertEqual(5, len(events))
@@ -1,11 +1,28 @@
 import unittest
-from datetime import datetime, timedelta
+from dataclasses import asdict
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
 from random import randint
 
 from banking import exceptions
-from banking.domain import Account, Person
+from banking.domain import (
+    Account,
+    AccountSnapshot,
+    BalanceCheckpoint,
+    Interest,
+    MaintenanceFee,
+    Money,
+    Person,
+    Transaction,
+    TransactionRow,
+    TransactionTypeEnum,
+)
 from banking.repositories import (
     AccountRepository,
+    AccountSnapshotRepository,
+    BalanceCheckpointRepository,
+    IdempotencyKeyRepository,
+    LedgerAccountRepository,
     PersonRepository,
     TransactionRepository,
 )
@@ -64,6 +81,245 @@ class TestAccountRepository(DatabaseInMemoryMixin, unittest.TestCase):
         with self.assertRaisesRegex(exceptions.DoesNotExist, "Does not exist"):
             repository.fetch(2)
 
+    def test_fetch_many_should_return_the_accounts_in_the_order_of_the_ids(self):
+        repository = AccountRepository(self.session)
+        repository.fetch_chunk_size = 2
+
+        for id in range(1, 6):
+            repository.add(create_account(account_id=id))
+
+        self.session.commit()
+
+        accounts, missing = repository.fetch_many([5, 9, 1, 3, 5, 7])
+        self.assertEqual([5, 1, 3, 5], [account.id for account in accounts])
+        self.assertEqual([9, 7], missing)
+
+    def test_apply_deposit_should_change_the_balance_and_post_a_transaction(self):
+        repository = AccountRepository(self.session)
+        repository.add(create_account(account_id=1))
+        self.session.commit()
+
+        balance = repository.apply_deposit(1, Decimal("10.50"))
+        self.assertEqual(Decimal("10.50"), balance)
+        self.assertEqual(Decimal("10.50"), repository.fetch(1).balance)
+
+        transactions = TransactionRepository(self.session).filter_by_interval(
+            1, since=datetime.utcnow() - timedelta(minutes=1)
+        )
+        self.assertEqual(1, len(transactions))
+        self.assertEqual(Decimal("10.50"), transactions[0].value)
+        self.assertEqual("deposit", transactions[0].type)
+
+    def test_apply_withdraw_should_not_spend_more_than_the_balance(self):
+        repository = AccountRepository(self.session)
+        account = create_account(account_id=1)
+        account.balance = Decimal("10.00")
+        repository.add(account)
+        self.session.commit()
+
+        self.assertEqual(Decimal("4.00"), repository.apply_withdraw(1, Decimal("6")))
+
+        with self.assertRaisesRegex(ValueError, "^The account balance is insufficient"):
+            repository.apply_withdraw(1, Decimal("6"))
+
+        transactions = TransactionRepository(self.session).filter_by_interval(
+            1, since=datetime.utcnow() - timedelta(minutes=1)
+        )
+        self.assertEqual(1, len(transactions))
+
+    def test_apply_withdraw_should_not_spend_more_than_the_daily_limit(self):
+        repository = AccountRepository(self.session)
+        account = create_account(account_id=1)
+        account.balance = Decimal("5000.00")
+        repository.add(account)
+        self.session.commit()
+
+        repository.apply_withdraw(1, Decimal("600"), day=date(2021, 1, 1))
+
+        with self.assertRaisesRegex(ValueError, "^The daily withdrawal limit"):
+            repository.apply_withdraw(1, Decimal("500"), day=date(2021, 1, 1))
+
+        self.assertEqual(
+            Decimal("3900.00"),
+            repository.apply_withdraw(1, Decimal("500"), day=date(2021, 1, 2)),
+        )
+
+        self.session.expire_all()
+        account = repository.fetch(1)
+        self.assertEqual(Decimal("500"), account.withdrawn_today)
+        self.assertEqual(date(2021, 1, 2), account.withdrawal_day)
+
+    def test_apply_deposit_should_reject_blocked_accounts(self):
+        repository = AccountRepository(self.session)
+        account = create_account(account_id=1)
+        account.block()
+        repository.add(account)
+        self.session.commit()
+
+        with self.assertRaisesRegex(ValueError, "because the account is blocked$"):
+            repository.apply_deposit(1, Decimal("6"))
+
+    def test_apply_withdraw_should_raise_an_exception_if_the_account_does_not_exist(
+        self,
+    ):
+        repository = AccountRepository(self.session)
+
+        with self.assertRaisesRegex(exceptions.DoesNotExist, "Does not exist"):
+            repository.apply_withdraw(2, Decimal("6"))
+
+    def test_apply_posting_should_post_the_amounts_computed_by_the_domain(self):
+        repository = AccountRepository(self.session)
+        balances = ["0.00", "0.79", "3.33", "10.00", "1234.57"]
+
+        for id, balance in enumerate(balances, start=1):
+            account = create_account(account_id=id)
+            account.balance = Money.parse(balance)
+            repository.add(account)
+
+        self.session.commit()
+
+        for posting in (MaintenanceFee(Money(500)), Interest(Decimal("0.0125"))):
+            with self.subTest(posting=posting):
+                before = [repository.fetch(id).balance for id in range(1, 6)]
+                amounts = [posting.amount(balance) for balance in before]
+
+                if posting.type == TransactionTypeEnum.withdraw:
+                    amounts = [-amount for amount in amounts]
+
+                posted = repository.apply_posting(posting, 1, 5)
+                self.session.expire_all()
+
+                self.assertEqual(len([amount for amount in amounts if amount]), posted)
+                self.assertEqual(
+                    [balance + amount for balance, amount in zip(before, amounts)],
+                    [repository.fetch(id).balance for id in range(1, 6)],
+                )
+
+    def test_apply_posting_should_post_the_transactions_of_the_active_accounts(
+        self,
+    ):
+        repository = AccountRepository(self.session)
+
+        for id in range(1, 5):
+            account = create_account(account_id=id)
+            account.balance = Money(1000)
+            repository.add(account)
+
+        repository.fetch(2).block()
+        self.session.commit()
+
+        self.assertEqual(2, repository.apply_posting(MaintenanceFee(Money(300)), 1, 3))
+        self.session.commit()
+
+        statements = TransactionRepository(self.session)
+        since = datetime.utcnow() - timedelta(minutes=1)
+        transactions = [
+            [(row.value, row.type) for row in statements.filter_by_interval(id, since)]
+            for id in range(1, 5)
+        ]
+        withdraw = (Money(300), TransactionTypeEnum.withdraw)
+        self.assertEqual([[withdraw], [], [withdraw], []], transactions)
+        self.assertEqual(
+            [Money(700), Money(1000), Money(700), Money(1000)],
+            [repository.fetch(id).balance for id in range(1, 5)],
+        )
+        self.assertEqual(
+            Money(700),
+            self.session.query(BalanceCheckpoint).filter_by(account_id=3).one().balance,
+        )
+
+
+def as_row(transaction: Transaction) -> TransactionRow:
+    return TransactionRow(**asdict(transaction))
+
+
+class TestLedgerAccountRepository(DatabaseInMemoryMixin, unittest.TestCase):
+    event_sourced = True
+
+    def setUp(self):
+        super().setUp()
+        self.repository = LedgerAccountRepository(self.session)
+        self.repository.add(create_account(account_id=1))
+        self.session.commit()
+
+    def stored_balance(self):
+        accounts = self.schema["accounts"]
+        return self.session.execute(
+            accounts.select().where(accounts.c.id == 1)
+        ).first()[accounts.c.balance]
+
+    def test_apply_deposit_should_only_post_a_transaction(self):
+        self.assertEqual(Money(1050), self.repository.apply_deposit(1, Money(1050)))
+        self.assertEqual(Money(2050), self.repository.apply_deposit(1, Money(1000)))
+        self.assertEqual(Money(0), self.stored_balance())
+        self.assertEqual(Money(2050), self.repository.fetch(1).balance)
+
+    def test_apply_withdraw_should_not_write_anything_when_rejected(self):
+        self.repository.apply_deposit(1, Money(1000))
+        self.assertEqual(Money(400), self.repository.apply_withdraw(1, Money(600)))
+
+        with self.assertRaisesRegex(ValueError, "^The account balance is insufficient"):
+            self.repository.apply_withdraw(1, Money(600))
+
+        account = self.repository.fetch(1)
+        self.assertEqual(
+            (Money(400), Money(600)), (account.balance, account.withdrawn_today)
+        )
+
+    def test_apply_withdraw_should_not_spend_more_than_the_daily_limit(self):
+        self.repository.apply_deposit(1, Money(200000))
+        self.repository.apply_withdraw(1, Money(60000), day=date(2021, 1, 1))
+
+        with self.assertRaisesRegex(ValueError, "^The daily withdrawal limit"):
+            self.repository.apply_withdraw(1, Money(50000), day=date(2021, 1, 1))
+
+        self.assertEqual(
+            Money(90000),
+            self.repository.apply_withdraw(1, Money(50000), day=date(2021, 1, 2)),
+        )
+
+    def test_apply_deposit_should_reject_blocked_accounts(self):
+        self.repository.fetch(1).block()
+        self.session.commit()
+
+        with self.assertRaisesRegex(ValueError, "because the account is blocked"):
+            self.repository.apply_deposit(1, Money(100))
+
+        with self.assertRaises(exceptions.DoesNotExist):
+            self.repository.apply_deposit(2, Money(100))
+
+    def test_fetch_should_replay_the_transactions_after_the_snapshot(self):
+        self.repository.apply_deposit(1, Money(100))
+        self.session.add(
+            AccountSnapshot(account_id=1, transaction_id=1, balance=Money(5000))
+        )
+        self.repository.apply_deposit(1, Money(300))
+        self.session.commit()
+
+        self.assertEqual(Money(5300), self.repository.fetch(1).balance)
+        self.assertEqual(
+            [Money(5300)], [a.balance for a in self.repository.fetch_many([1])[0]]
+        )
+
+    def test_compact_should_snapshot_the_accounts_with_enough_transactions(self):
+        for cents in (100, 200, 300):
+            self.repository.apply_deposit(1, Money(cents))
+
+        snapshots = AccountSnapshotRepository(self.session)
+
+        self.assertEqual(0, snapshots.compact(1, 10, 4))
+        self.assertEqual(1, snapshots.compact(1, 10, 3))
+        self.assertEqual(0, snapshots.compact(1, 10, 1))
+
+        snapshot = snapshots.fetch(1)
+        self.assertEqual((3, Money(600)), (snapshot.transaction_id, snapshot.balance))
+
+        self.repository.apply_withdraw(1, Money(50))
+        self.assertEqual(1, snapshots.compact(1, 10, 1))
+        self.session.expire_all()
+        self.assertEqual(Money(550), snapshots.fetch(1).balance)
+        self.assertEqual(Money(550), self.repository.fetch(1).balance)
+
 
 class TestTransactionRepository(DatabaseInMemoryMixin, unittest.TestCase):
     def setUp(self):
@@ -119,11 +375,24 @@ class TestTransactionRepository(DatabaseInMemoryMixin, unittest.TestCase):
             account_id=self.account.id, since=one_day_before_today
         )
 
-        expected = [transaction_today]
+        expected = [as_row(transaction_today)]
 
         self.assertEqual(transactions, expected)
         self.assertEqual(len(transactions), 1)
 
+    def test_filter_by_interval_should_not_track_the_rows_in_the_session(self):
+        account_id = self.account.id
+        self.repository.add(create_transaction(id=None, account_id=account_id))
+        self.session.commit()
+        self.session.expunge_all()
+
+        transactions = self.repository.filter_by_interval(
+            account_id=account_id, since=datetime.now() - timedelta(days=1)
+        )
+
+        self.assertIsInstance(transactions[0], TransactionRow)
+        self.assertNotIn(Transaction, {type(entity) for entity in self.session})
+
     def test_filter_by_interval_should_limit_transactions_by_until_param(self):
         four_days_before = datetime.now() - timedelta(days=4)
 
@@ -155,7 +424,165 @@ class TestTransactionRepository(DatabaseInMemoryMixin, unittest.TestCase):
             until=four_days_before + timedelta(days=2),
         )
 
-        expected = [transaction_1, transaction_2]
+        expected = [as_row(transaction_1), as_row(transaction_2)]
 
         self.assertEqual(transactions, expected)
         self.assertEqual(len(transactions), 2)
+
+    def test_page_by_interval_should_return_the_transactions_after_the_position(
+        self,
+    ):
+        created_at = datetime.now() - timedelta(days=1)
+        transactions = [
+            create_transaction(
+                id=None,
+                account_id=self.account.id,
+                created_at=created_at + timedelta(seconds=second),
+            )
+            for second in (0, 0, 1, 2)
+        ]
+
+        for transaction in transactions:
+            self.repository.add(transaction)
+
+        self.session.commit()
+
+        first_page = self.repository.page_by_interval(
+            account_id=self.account.id, since=created_at, limit=2
+        )
+        last = first_page[-1]
+        second_page = self.repository.page_by_interval(
+            account_id=self.account.id,
+            since=created_at,
+            limit=2,
+            after=(last.created_at, last.id),
+        )
+
+        self.assertEqual(list(map(as_row, transactions[:2])), first_page)
+        self.assertEqual(list(map(as_row, transactions[2:])), second_page)
+
+
+class TestBalanceCheckpointRepository(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = BalanceCheckpointRepository(self.session)
+        self.day = date.today() - timedelta(days=3)
+
+        account = create_account(account_id=1)
+        account.balance = Decimal("135")
+        self.session.add(account)
+
+        for days, value, type in (
+            (0, 50, TransactionTypeEnum.deposit),
+            (1, 20, TransactionTypeEnum.withdraw),
+            (2, 5, TransactionTypeEnum.deposit),
+        ):
+            self.session.add(
+                create_transaction(
+                    id=None,
+                    account_id=1,
+                    value=value,
+                    type=type,
+                    created_at=self.moment(days, 10),
+                )
+            )
+
+        self.session.commit()
+
+    def moment(self, days, hour):
+        return datetime.combine(self.day + timedelta(days=days), time(hour))
+
+    def checkpoints(self):
+        return [
+            (checkpoint.day, checkpoint.balance)
+            for checkpoint in self.session.query(BalanceCheckpoint).order_by(
+                BalanceCheckpoint.day
+            )
+        ]
+
+    def test_record_should_replace_the_checkpoint_of_the_same_day(self):
+        self.repository.record(1, self.day, Decimal("10"))
+        self.repository.record(1, self.day, Decimal("20"))
+        self.assertEqual([(self.day, Decimal("20"))], self.checkpoints())
+
+    def test_backfill_should_write_the_balance_at_the_end_of_each_day(self):
+        written = self.repository.backfill([1], until=date.today())
+
+        self.assertEqual(3, written)
+        self.assertEqual(
+            [
+                (self.day, Decimal("150")),
+                (self.day + timedelta(days=1), Decimal("130")),
+                (self.day + timedelta(days=2), Decimal("135")),
+            ],
+            self.checkpoints(),
+        )
+
+    def test_backfill_should_not_write_the_days_from_until_on(self):
+        self.repository.backfill([1], until=self.day + timedelta(days=1))
+        self.assertEqual([(self.day, Decimal("150"))], self.checkpoints())
+
+    def test_balance_at_should_sum_the_transactions_without_checkpoints(self):
+        self.assertEqual(
+            Decimal("100"), self.repository.balance_at(1, self.moment(0, 0))
+        )
+        self.assertEqual(
+            Decimal("130"), self.repository.balance_at(1, self.moment(1, 12))
+        )
+        self.assertEqual(Decimal("135"), self.repository.balance_at(1, datetime.now()))
+
+    def test_balance_at_should_start_from_the_nearest_checkpoint(self):
+        self.repository.backfill([1], until=date.today())
+
+        self.assertEqual(
+            Decimal("100"), self.repository.balance_at(1, self.moment(0, 9))
+        )
+        self.assertEqual(
+            Decimal("130"), self.repository.balance_at(1, self.moment(1, 12))
+        )
+        self.assertEqual(
+            Decimal("130"), self.repository.balance_at(1, self.moment(2, 9))
+        )
+
+    def test_balance_at_should_trust_the_checkpoints(self):
+        self.repository.record(1, self.day + timedelta(days=1), Decimal("1000"))
+        self.assertEqual(
+            Decimal("1000"), self.repository.balance_at(1, self.moment(2, 9))
+        )
+
+    def test_balance_at_should_raise_an_exception_if_the_account_does_not_exist(self):
+        with self.assertRaisesRegex(exceptions.DoesNotExist, "Account does not exist"):
+            self.repository.balance_at(2, datetime.now())
+
+
+class TestIdempotencyKeyRepository(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = IdempotencyKeyRepository(self.session)
+
+    def test_claim_should_return_none_for_a_new_key(self):
+        self.assertIsNone(self.repository.claim("key", "deposit:1:10"))
+
+    def test_claim_should_return_the_completed_request_of_the_key(self):
+        self.repository.claim("key", "deposit:1:10")
+        self.repository.complete("key", "deposit:1:10", Decimal("10"))
+        self.session.commit()
+
+        stored = self.repository.claim("key", "deposit:1:10")
+        self.assertEqual(Decimal("10"), stored.balance)
+
+    def test_claim_should_raise_an_exception_if_the_key_was_used_by_another_request(
+        self,
+    ):
+        self.repository.claim("key", "deposit:1:10")
+
+        with self.assertRaisesRegex(ValueError, "'key' was used by another request"):
+            self.repository.claim("key", "withdraw:1:10")
+
+    def test_purge_should_delete_the_keys_created_before_the_moment(self):
+        self.repository.claim("key", "deposit:1:10")
+        later = datetime.utcnow() + timedelta(seconds=1)
+
+        self.assertEqual(0, self.repository.purge(datetime.utcnow() - timedelta(1)))
+        self.assertEqual(1, self.repository.purge(later))
+        self.assertIsNone(self.repository.claim("key", "withdraw:1:10"))
@@ -1,13 +1,18 @@
+import asyncio
+import gzip
+import json
 import unittest
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from random import randint
 from decimal import Decimal
 from time import sleep
+from unittest import mock
 
-from banking import exceptions
-from banking.adapters import SqlUnitOfWork
-from banking.domain import Account
-from banking.services import get_commands
+from banking import exceptions, repositories
+from banking.adapters import AsyncSqlUnitOfWork, SqlUnitOfWork
+from banking.cache import LRUCache
+from banking.domain import Account, BalanceCheckpoint
+from banking.services import WriteCoalescer, get_async_commands, get_commands
 from tests import DatabaseInMemoryMixin, create_person
 
 
@@ -84,6 +89,13 @@ class TestAccountFetchService(DatabaseInMemoryMixin, unittest.TestCase):
         with self.assertRaisesRegex(exceptions.DoesNotExist, "^Does not exist$"):
             self.command(2)
 
+    def test_should_obtain_many_accounts_and_the_ids_not_found(self):
+        command = get_commands(self.unit_of_work)["accounts_fetch_many"]
+        accounts, missing = command([2, 1])
+
+        self.assertEqual([1], [account.id for account in accounts])
+        self.assertEqual([2], missing)
+
 
 class TestAccountWithddrawValueService(DatabaseInMemoryMixin, unittest.TestCase):
     def setUp(self):
@@ -107,6 +119,18 @@ class TestAccountWithddrawValueService(DatabaseInMemoryMixin, unittest.TestCase)
         account = self.command(1, "50.00")
         self.assertEqual(len(account.transactions), 1)
 
+    def test_should_only_list_the_transaction_made_without_loading_the_history(self):
+        self.command(1, "10.00")
+        account = self.command(1, "20.00")
+
+        self.assertEqual([Decimal("20.00")], [t.value for t in account.transactions])
+
+        with self.unit_of_work as uow:
+            self.assertEqual([], uow.accounts.fetch(1).transactions)
+            self.assertEqual(
+                2, len(uow.transactions.filter_by_interval(1, datetime(2000, 1, 1)))
+            )
+
     def test_transactions_should_have_the_withdraw_type_when_their_are_made_by_this_command(
         self,
     ):
@@ -117,6 +141,286 @@ class TestAccountWithddrawValueService(DatabaseInMemoryMixin, unittest.TestCase)
             self.assertEqual(transaction.type, "withdraw")
 
 
+class TestAccountAtomicServices(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory)
+
+        with self.unit_of_work as uow:
+            account = Account.new()
+            account.id = 1
+            account.person_id = 1
+            account.balance = Decimal("100.00")
+            uow.accounts.add(account)
+
+        self.deposit = get_commands(self.unit_of_work)["account_atomic_deposit"]
+        self.withdraw = get_commands(self.unit_of_work)["account_atomic_withdraw"]
+
+    def test_should_return_the_new_balance(self):
+        self.assertEqual(Decimal("110.00"), self.deposit(1, "10.00"))
+        self.assertEqual(Decimal("98.99"), self.withdraw(1, "11.01"))
+
+    def test_should_use_the_domain_rules_to_validate_the_amount(self):
+        with self.assertRaisesRegex(
+            ValueError,
+            "Could not deposit the amount '@' because it isn't a valid value",
+        ):
+            self.deposit(1, "@")
+
+        with self.assertRaisesRegex(
+            ValueError, "Could not withdraw an amout of zero from the account"
+        ):
+            self.withdraw(1, "0")
+
+    def test_should_raise_an_exception_if_the_balance_is_insufficient(self):
+        with self.assertRaisesRegex(ValueError, "^The account balance is insufficient"):
+            self.withdraw(1, "100.01")
+
+    def test_should_raise_an_exception_if_an_account_does_not_exists(self):
+        with self.assertRaises(exceptions.DoesNotExist):
+            self.deposit(8000, "1")
+
+    def test_should_replay_a_request_with_the_same_idempotency_key(self):
+        self.assertEqual(Decimal("110.00"), self.deposit(1, "10.00", "deposit-1"))
+        self.assertEqual(Decimal("110.00"), self.deposit(1, "10", "deposit-1"))
+        self.assertEqual(Decimal("80.00"), self.withdraw(1, "30.00", "withdraw-1"))
+        self.assertEqual(Decimal("80.00"), self.withdraw(1, "30.00", "withdraw-1"))
+
+        with self.unit_of_work as uow:
+            self.assertEqual(Decimal("80.00"), uow.accounts.fetch(1).balance)
+            self.assertEqual(
+                2, len(uow.transactions.filter_by_interval(1, datetime(2000, 1, 1)))
+            )
+
+    def test_should_reject_an_idempotency_key_used_by_another_request(self):
+        self.deposit(1, "10.00", "key")
+
+        with self.assertRaisesRegex(ValueError, "'key' was used by another request"):
+            self.deposit(1, "20.00", "key")
+
+        with self.assertRaisesRegex(ValueError, "'key' was used by another request"):
+            self.withdraw(1, "10.00", "key")
+
+    def test_a_rejected_request_should_not_keep_its_idempotency_key(self):
+        with self.assertRaisesRegex(ValueError, "^The account balance is insufficient"):
+            self.withdraw(1, "100.01", "key")
+
+        self.deposit(1, "1.00")
+        self.assertEqual(Decimal("0.99"), self.withdraw(1, "100.01", "key"))
+
+    def test_should_answer_the_replays_from_the_key_cache(self):
+        cache = LRUCache()
+        deposit = get_commands(SqlUnitOfWork(self.session_factory, key_cache=cache))[
+            "account_atomic_deposit"
+        ]
+        deposit(1, "10.00", "key")
+
+        with self.unit_of_work as uow:
+            uow.session.execute("DELETE FROM idempotency_keys")
+
+        self.assertEqual(Decimal("110.00"), deposit(1, "10.00", "key"))
+        self.assertEqual(1, cache.hits)
+
+
+class TestAccountTransferService(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory)
+
+        with self.unit_of_work as uow:
+            for id, balance in ((1, "100.00"), (2, "5.00")):
+                account = Account.new()
+                account.id = id
+                account.person_id = 1
+                account.balance = Decimal(balance)
+                uow.accounts.add(account)
+
+        self.transfer = get_commands(self.unit_of_work)["account_transfer"]
+
+    def balances(self):
+        with self.unit_of_work as uow:
+            return [account.balance for account in uow.accounts.fetch_many([1, 2])[0]]
+
+    def test_should_move_the_value_and_post_both_transactions(self):
+        self.assertEqual(Decimal("70.00"), self.transfer(1, 2, "30.00"))
+        self.assertEqual([Decimal("70.00"), Decimal("35.00")], self.balances())
+
+        with self.unit_of_work as uow:
+            since = datetime(2000, 1, 1)
+            self.assertEqual(
+                ["withdraw"],
+                [t.type for t in uow.transactions.filter_by_interval(1, since)],
+            )
+            self.assertEqual(
+                ["deposit"],
+                [t.type for t in uow.transactions.filter_by_interval(2, since)],
+            )
+
+    def test_should_not_change_the_source_when_the_target_is_rejected(self):
+        with self.assertRaises(exceptions.DoesNotExist):
+            self.transfer(1, 3, "30.00")
+
+        get_commands(self.unit_of_work)["account_block"](2)
+
+        with self.assertRaisesRegex(ValueError, "because the account is blocked"):
+            self.transfer(1, 2, "30.00")
+
+        self.assertEqual([Decimal("100.00"), Decimal("5.00")], self.balances())
+
+    def test_should_raise_an_exception_if_the_balance_is_insufficient(self):
+        with self.assertRaisesRegex(ValueError, "^The account balance is insufficient"):
+            self.transfer(2, 1, "5.01")
+
+    def test_should_reject_a_transfer_to_the_same_account(self):
+        with self.assertRaisesRegex(ValueError, "to the same account"):
+            self.transfer(1, 1, "1.00")
+
+    def test_should_replay_a_request_with_the_same_idempotency_key(self):
+        self.assertEqual(Decimal("90.00"), self.transfer(1, 2, "10.00", "key"))
+        self.assertEqual(Decimal("90.00"), self.transfer(1, 2, "10.00", "key"))
+        self.assertEqual([Decimal("90.00"), Decimal("15.00")], self.balances())
+
+        with self.assertRaisesRegex(ValueError, "'key' was used by another request"):
+            self.transfer(2, 1, "10.00", "key")
+
+    def test_should_transfer_with_the_async_command(self):
+        transfer = get_async_commands(AsyncSqlUnitOfWork(self.session_factory))[
+            "account_transfer"
+        ]
+        self.assertEqual(Decimal("99.99"), asyncio.run(transfer(1, 2, "0.01")))
+        self.assertEqual([Decimal("99.99"), Decimal("5.01")], self.balances())
+
+
+class TestEventSourcedAccountServices(DatabaseInMemoryMixin, unittest.TestCase):
+    event_sourced = True
+
+    def setUp(self):
+        super().setUp()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory)
+
+        with self.unit_of_work as uow:
+            for id in (1, 2):
+                account = Account.new()
+                account.id = id
+                account.person_id = 1
+                uow.accounts.add(account)
+
+        self.commands = get_commands(self.unit_of_work)
+
+    def test_should_keep_the_balance_in_the_ledger(self):
+        self.assertEqual(
+            Decimal("100.00"), self.commands["account_atomic_deposit"](1, "100")
+        )
+        self.assertEqual(
+            Decimal("70.00"), self.commands["account_atomic_withdraw"](1, "30")
+        )
+        self.assertEqual(
+            Decimal("50.00"), self.commands["account_transfer"](1, 2, "20")
+        )
+
+        accounts, _ = self.commands["accounts_fetch_many"]([1, 2])
+        self.assertEqual(
+            [Decimal("50.00"), Decimal("20.00")], [a.balance for a in accounts]
+        )
+
+        accounts = self.schema["accounts"]
+        self.assertEqual(
+            [Decimal("0"), Decimal("0")],
+            [row.balance for row in self.session.execute(accounts.select())],
+        )
+
+    def test_the_domain_commands_should_see_the_ledger_balance(self):
+        self.commands["account_atomic_deposit"](1, "100")
+        account = self.commands["account_withdraw"](1, "40")
+
+        self.assertEqual(Decimal("60.00"), account.balance)
+        self.assertEqual(Decimal("60.00"), self.commands["account_fetch"](1).balance)
+
+    def test_the_domain_commands_should_not_write_balance_checkpoints(self):
+        self.commands["account_deposit"](1, "100")
+        self.commands["account_withdraw"](1, "40")
+
+        self.assertEqual(0, self.session.query(BalanceCheckpoint).count())
+
+    def test_should_compute_the_past_balances_from_the_ledger(self):
+        self.commands["account_atomic_deposit"](1, "100")
+        self.commands["account_atomic_withdraw"](1, "30")
+        since = datetime.utcnow() - timedelta(days=1)
+
+        self.assertEqual(Decimal("0"), self.commands["account_balance_at"](1, since))
+        summary = self.commands["account_transactions_summary"](1, since, None)
+        self.assertEqual(
+            (Decimal("0"), Decimal("70.00")),
+            (summary.opening_balance, summary.closing_balance),
+        )
+
+
+class TestWriteCoalescer(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory)
+
+        with self.unit_of_work as uow:
+            account = Account.new()
+            account.id = 1
+            account.person_id = 1
+            account.balance = Decimal("100.00")
+            uow.accounts.add(account)
+
+        self.coalescer = WriteCoalescer(
+            SqlUnitOfWork(self.session_factory), max_batch_size=10, max_delay=0.5
+        )
+
+    def test_should_apply_the_operations_submitted_together_in_one_batch(self):
+        futures = [self.coalescer.deposit(1, "10.00") for _ in range(3)]
+        futures.append(self.coalescer.withdraw(1, "30.00"))
+        self.coalescer.start()
+        self.coalescer.stop()
+
+        self.assertEqual(
+            [Decimal("110.00"), Decimal("120.00"), Decimal("130.00"), Decimal("100")],
+            [future.result() for future in futures],
+        )
+        self.assertEqual(1, self.coalescer.batches)
+        self.assertEqual(4, self.coalescer.operations)
+
+    def test_a_rejected_operation_should_not_affect_the_others_in_the_batch(self):
+        rejected = self.coalescer.withdraw(1, "500.00")
+        missing = self.coalescer.deposit(2, "1.00")
+        accepted = self.coalescer.deposit(1, "1.00")
+        self.coalescer.start()
+        self.coalescer.stop()
+
+        with self.assertRaisesRegex(ValueError, "^The account balance is insufficient"):
+            rejected.result()
+
+        with self.assertRaises(exceptions.DoesNotExist):
+            missing.result()
+
+        self.assertEqual(Decimal("101.00"), accepted.result())
+
+        with self.unit_of_work as uow:
+            self.assertEqual(Decimal("101.00"), uow.accounts.fetch(1).balance)
+
+    def test_should_complete_the_future_with_the_validation_error(self):
+        future = self.coalescer.deposit(1, "@")
+
+        with self.assertRaisesRegex(ValueError, "^Could not deposit the amount '@'"):
+            future.result(timeout=0)
+
+    def test_should_lock_the_accounts_of_the_batch_in_ascending_order(self):
+        with mock.patch.object(
+            repositories.AccountRepository, "lock", autospec=True
+        ) as lock:
+            for id in (3, 1, 2, 1):
+                self.coalescer.deposit(id, "1.00")
+
+            self.coalescer.start()
+            self.coalescer.stop()
+
+        lock.assert_called_once_with(mock.ANY, [1, 2, 3], key_share=True)
+
+
 class TestAccountBlockService(DatabaseInMemoryMixin, unittest.TestCase):
     def setUp(self):
         super().setUp()
@@ -177,6 +481,183 @@ class TestAccountTransactionsDetailService(DatabaseInMemoryMixin, unittest.TestC
         self.assertEqual(len(transctions), 0)
 
 
+class TestAccountTransactionsPageService(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory)
+
+        with self.unit_of_work as uow:
+            account = Account.new()
+            account.id = 1
+            account.balance = Decimal("500")
+            account.person_id = 1
+            uow.accounts.add(account)
+
+        withdraw = get_commands(self.unit_of_work)["account_withdraw"]
+
+        for value in ("1", "2", "3", "4", "5"):
+            withdraw(1, value)
+
+        self.command = get_commands(self.unit_of_work)["account_transactions_page"]
+        self.since = datetime.utcnow() - timedelta(minutes=1)
+
+    def test_should_read_all_the_transactions_page_by_page(self):
+        values, cursor, pages = [], None, 0
+
+        while True:
+            transactions, cursor = self.command(1, self.since, limit=2, cursor=cursor)
+            values.extend(transaction.value for transaction in transactions)
+            pages += 1
+
+            if cursor is None:
+                break
+
+        self.assertEqual(3, pages)
+        self.assertEqual([1, 2, 3, 4, 5], values)
+
+    def test_the_last_page_should_not_have_a_next_cursor(self):
+        transactions, cursor = self.command(1, self.since, limit=5)
+        self.assertEqual(5, len(transactions))
+        self.assertIsNone(cursor)
+
+    def test_should_raise_an_exception_if_the_cursor_is_not_valid(self):
+        with self.assertRaisesRegex(ValueError, "^The cursor 'abc' is not valid$"):
+            self.command(1, self.since, cursor="abc")
+
+
+class TestAccountTransactionsExportService(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory)
+
+        with self.unit_of_work as uow:
+            account = Account.new()
+            account.id = 1
+            account.balance = Decimal("500")
+            account.person_id = 1
+            uow.accounts.add(account)
+
+        deposit = get_commands(self.unit_of_work)["account_deposit"]
+
+        for value in ("1", "2.50", "3"):
+            deposit(1, value)
+
+        self.command = get_commands(self.unit_of_work)["account_transactions_export"]
+        self.since = datetime.utcnow() - timedelta(minutes=1)
+
+    def test_should_export_the_transactions_as_ndjson(self):
+        lines = b"".join(self.command(1, self.since)).decode().splitlines()
+        transactions = [json.loads(line) for line in lines]
+
+        self.assertEqual(
+            [Decimal("1"), Decimal("2.5"), Decimal("3")],
+            [Decimal(t["value"]) for t in transactions],
+        )
+        self.assertEqual({"deposit"}, {t["type"] for t in transactions})
+
+    def test_should_export_the_transactions_as_csv(self):
+        lines = b"".join(self.command(1, self.since, format="csv")).decode()
+        lines = lines.splitlines()
+
+        self.assertEqual("id,type,value,created_at", lines[0])
+        self.assertEqual(4, len(lines))
+        self.assertRegex(lines[2], r"^2,deposit,2\.50?,")
+
+    def test_should_compress_the_export_with_gzip(self):
+        chunks = self.command(1, self.since, format="csv", compress=True)
+        lines = gzip.decompress(b"".join(chunks)).decode().splitlines()
+        self.assertEqual(4, len(lines))
+
+    def test_should_raise_does_not_exist_before_streaming_the_export(self):
+        with self.assertRaises(exceptions.DoesNotExist):
+            self.command(2, self.since)
+
+    def test_should_not_read_the_transactions_before_the_stream_is_iterated(self):
+        with mock.patch.object(
+            repositories.TransactionRepository,
+            "stream_by_interval",
+            autospec=True,
+            return_value=[],
+        ) as stream_by_interval:
+            chunks = self.command(1, self.since)
+            stream_by_interval.assert_not_called()
+
+            b"".join(chunks)
+            stream_by_interval.assert_called_once()
+
+    def test_should_raise_an_exception_if_the_format_is_not_supported(self):
+        with self.assertRaisesRegex(
+            ValueError, "^The export format 'xml' is not supported$"
+        ):
+            self.command(1, self.since, format="xml")
+
+
+class TestAccountBalanceCheckpoints(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit_of_work = SqlUnitOfWork(self.session_factory)
+        self.commands = get_commands(self.unit_of_work)
+
+        with self.unit_of_work as uow:
+            account = Account.new()
+            account.id = 1
+            account.balance = Decimal("100")
+            account.person_id = 1
+            uow.accounts.add(account)
+
+    def checkpoint(self):
+        return self.session.query(BalanceCheckpoint).one()
+
+    def test_the_commands_should_record_the_balance_of_the_day(self):
+        self.commands["account_deposit"](1, "10")
+        self.commands["account_withdraw"](1, "5")
+        self.commands["account_atomic_deposit"](1, "20")
+        self.commands["account_atomic_withdraw"](1, "1")
+
+        checkpoint = self.checkpoint()
+        self.assertEqual(datetime.utcnow().date(), checkpoint.day)
+        self.assertEqual(Decimal("124"), checkpoint.balance)
+
+    def test_a_rejected_withdraw_should_not_record_the_balance(self):
+        with self.assertRaises(ValueError):
+            self.commands["account_atomic_withdraw"](1, "1000")
+
+        self.assertEqual(0, self.session.query(BalanceCheckpoint).count())
+
+    def test_should_retrieve_the_balance_at_a_past_moment(self):
+        before = datetime.utcnow()
+        self.commands["account_atomic_deposit"](1, "20")
+
+        balance_at = self.commands["account_balance_at"]
+        self.assertEqual(Decimal("100"), balance_at(1, before))
+        self.assertEqual(Decimal("120"), balance_at(1, datetime.utcnow()))
+
+    def test_should_sum_up_the_transactions_since_the_opening_balance(self):
+        self.commands["account_atomic_deposit"](1, "5")
+        since = datetime.utcnow()
+        self.commands["account_atomic_deposit"](1, "20")
+        self.commands["account_withdraw"](1, "10.50")
+
+        summary = self.commands["account_transactions_summary"](1, since)
+
+        self.assertEqual(Decimal("105"), summary.opening_balance)
+        self.assertEqual(Decimal("114.50"), summary.closing_balance)
+        self.assertEqual(1, summary.deposits.count)
+        self.assertEqual(Decimal("10.50"), summary.withdraws.total)
+        self.assertEqual([Decimal("114.50")], [day.balance for day in summary.days])
+
+    def test_summary_should_raise_an_exception_if_the_account_does_not_exist(self):
+        with self.assertRaises(exceptions.DoesNotExist):
+            self.commands["account_transactions_summary"](2, datetime.utcnow())
+
+    def test_should_convert_an_aware_moment_to_utc(self):
+        before = datetime.now(timezone(timedelta(hours=-3)))
+        self.commands["account_atomic_deposit"](1, "20")
+
+        balance_at = self.commands["account_balance_at"]
+        self.assertEqual(Decimal("100"), balance_at(1, before))
+
+
 class TestPersonRegisterService(DatabaseInMemoryMixin, unittest.TestCase):
     def setUp(self):
         super().setUp()
@@ -192,3 +673,55 @@ class TestPersonRegisterService(DatabaseInMemoryMixin, unittest.TestCase):
             people = uow.session.execute("SELECT * FROM people").fetchall()
 
         self.assertEqual(1, len(people))
+
+
+class TestAsyncAccountServices(DatabaseInMemoryMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.unit_of_work = AsyncSqlUnitOfWork(self.session_factory)
+        self.commands = get_async_commands(self.unit_of_work)
+
+        with SqlUnitOfWork(self.session_factory) as uow:
+            account = Account.new()
+            account.id = 1
+            account.person_id = 1
+            account.balance = Decimal("100.00")
+            uow.accounts.add(account)
+
+    def test_should_be_possible_to_deposit_a_value(self):
+        account = asyncio.run(self.commands["account_deposit"](1, "10.00"))
+        self.assertEqual(account.balance, Decimal("110.00"))
+
+    def test_should_be_possible_to_withdraw_a_value(self):
+        account = asyncio.run(self.commands["account_withdraw"](1, "10.00"))
+        self.assertEqual(account.balance, Decimal("90.00"))
+
+    def test_should_persist_the_transactions_of_the_account(self):
+        async def scenario():
+            await self.commands["account_withdraw"](1, "10.00")
+            await self.commands["account_deposit"](1, "5.00")
+            return await self.commands["account_transactions"](
+                1, datetime.utcnow() - timedelta(minutes=1), None
+            )
+
+        transactions = asyncio.run(scenario())
+        self.assertEqual(["withdraw", "deposit"], [t.type for t in transactions])
+
+    def test_should_raise_does_not_exist_exception_if_an_account_was_not_found(self):
+        with self.assertRaisesRegex(exceptions.DoesNotExist, "^Does not exist$"):
+            asyncio.run(self.commands["account_fetch"](2))
+
+    def test_should_set_an_account_active_status_as_false(self):
+        account = asyncio.run(self.commands["account_block"](1))
+        self.assertFalse(account.active)
+
+    def test_should_stream_the_exported_transactions(self):
+        async def scenario():
+            await self.commands["account_deposit"](1, "5.00")
+            chunks = await self.commands["account_transactions_export"](
+                1, datetime.utcnow() - timedelta(minutes=1), format="csv"
+            )
+            return b"".join([chunk async for chunk in chunks])
+
+        lines = asyncio.run(scenario()).decode().splitlines()
+        self.assertEqual(2, len(lines))
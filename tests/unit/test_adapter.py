@@ -1,9 +1,16 @@
+import asyncio
 import unittest
+from decimal import Decimal
 from unittest import mock
 
 from banking import exceptions, interfaces
-from banking.adapters import SqlUnitOfWork
-from banking.domain import Account
+from banking.adapters import (
+    AsyncSqlUnitOfWork,
+    MoneyCents,
+    MoneyNumeric,
+    SqlUnitOfWork,
+)
+from banking.domain import Account, Money
 from tests.unit import TestingSessionFactory
 
 
@@ -44,6 +51,10 @@ class TestUnitOfWork(unittest.TestCase):
         with SqlUnitOfWork(self.session_factory) as u:
             self.assertIsInstance(u.transactions, interfaces.AbstractRepository)
 
+    def test_unit_of_work_for_reading_should_be_itself_without_replicas(self):
+        unit = SqlUnitOfWork(self.session_factory)
+        self.assertIs(unit, unit.for_reading())
+
     def test_unit_of_work_should_commit_automaticaly_when_contextblock_exits(self):
         with SqlUnitOfWork(self.session_factory) as u:
             u.accounts.add(self.account_1)
@@ -85,3 +96,64 @@ class TestUnitOfWork(unittest.TestCase):
 
         uow.commit.assert_called_once_with()
         uow.rollback.assert_called_once_with()
+
+
+class TestAsyncUnitOfWork(unittest.TestCase):
+    def setUp(self):
+        self.storage = {}
+        self.session_factory = TestingSessionFactory(self.storage)
+        self.account_1 = Account.new()
+        self.account_1.id = 1
+
+    def test_async_unit_of_work_should_be_an_abstract_unit_of_work(self):
+        self.assertIsInstance(
+            AsyncSqlUnitOfWork(self.session_factory), interfaces.AbstractUnitOfWork
+        )
+
+    def test_async_unit_of_work_should_commit_automaticaly_when_contextblock_exits(
+        self,
+    ):
+        async def scenario():
+            async with AsyncSqlUnitOfWork(self.session_factory) as u:
+                await u.accounts.add(self.account_1)
+
+            async with AsyncSqlUnitOfWork(self.session_factory) as u:
+                return await u.accounts.fetch(1)
+
+        self.assertIsInstance(asyncio.run(scenario()), Account)
+
+    def test_async_unit_of_work_should_rollback_a_transaction_if_an_exception_occurs(
+        self,
+    ):
+        async def scenario():
+            with self.assertRaises(ValueError):
+                async with AsyncSqlUnitOfWork(self.session_factory) as u:
+                    await u.accounts.add(self.account_1)
+                    raise ValueError
+
+            async with AsyncSqlUnitOfWork(self.session_factory) as u:
+                await u.accounts.fetch(1)
+
+        with self.assertRaises(exceptions.DoesNotExist):
+            asyncio.run(scenario())
+
+
+class TestMoneyTypes(unittest.TestCase):
+    def test_numeric_should_store_the_amount_as_a_decimal(self):
+        column = MoneyNumeric()
+        stored = column.process_bind_param(Money(1050), None)
+
+        self.assertEqual(Decimal("10.50"), stored)
+        self.assertEqual(Money(1050), column.process_result_value(stored, None))
+        self.assertIsNone(column.process_bind_param(None, None))
+
+    def test_cents_should_store_the_amount_as_an_integer(self):
+        column = MoneyCents()
+
+        self.assertEqual(1050, column.process_bind_param(Money(1050), None))
+        self.assertEqual(1050, column.process_bind_param("10.50", None))
+        self.assertEqual(Money(1050), column.process_result_value(1050, None))
+
+    def test_should_not_store_fractions_of_a_cent(self):
+        with self.assertRaises(ValueError):
+            MoneyCents().process_bind_param(Decimal("0.001"), None)
@@ -0,0 +1,43 @@
+import unittest
+
+from banking.services import COMMANDS
+from benchmarks.suite import compare, measure, service_benchmarks
+
+
+class TestCompare(unittest.TestCase):
+    def test_should_flag_the_benchmarks_slower_than_the_tolerance(self):
+        baseline = {"a": {"median_us": 100.0}, "b": {"median_us": 100.0}}
+        results = {"a": {"median_us": 120.0}, "b": {"median_us": 130.0}}
+
+        self.assertEqual(
+            [("a", 100.0, 120.0, 0.2, False), ("b", 100.0, 130.0, 0.3, True)],
+            [
+                (name, before, after, round(change, 2), regressed)
+                for name, before, after, change, regressed in compare(
+                    baseline, results, 0.25
+                )
+            ],
+        )
+
+    def test_should_only_compare_the_benchmarks_run_in_both(self):
+        baseline = {"a": {"median_us": 100.0}, "old": {"median_us": 1.0}}
+        results = {"a": {"median_us": 50.0}, "new": {"median_us": 1.0}}
+
+        self.assertEqual(
+            [("a", 100.0, 50.0, -0.5, False)], compare(baseline, results, 0.25)
+        )
+
+
+class TestMeasure(unittest.TestCase):
+    def test_should_repeat_the_same_number_of_calls(self):
+        calls = []
+        result = measure(lambda: calls.append(1), min_time=0.001, repeat=3)
+
+        # The calibration rounds call it 1, 2, 4... `loops` times
+        self.assertEqual(2 * result["loops"] - 1 + 2 * result["loops"], len(calls))
+        self.assertGreaterEqual(result["median_us"], result["min_us"])
+
+
+class TestServiceBenchmarks(unittest.TestCase):
+    def test_should_measure_every_command(self):
+        self.assertEqual(set(COMMANDS), set(service_benchmarks({}, 1, 1, 2)))
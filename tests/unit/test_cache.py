@@ -0,0 +1,158 @@
+import unittest
+from unittest import mock
+
+from banking.cache import (
+    AccountCache,
+    LocalInvalidationChannel,
+    LRUCache,
+    PostgresInvalidationChannel,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(max_size=2, ttl=10, clock=self.clock)
+
+    def test_should_evict_the_least_recently_used_value(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.cache.get("a")
+        self.cache.put("c", 3)
+
+        self.assertEqual(1, self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(1, self.cache.evictions)
+
+    def test_should_not_return_an_expired_value(self):
+        self.cache.put("a", 1)
+        self.clock.now = 10
+
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(1, self.cache.misses)
+
+
+class TestAccountCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = AccountCache(max_size=2, ttl=5, clock=self.clock)
+
+    def test_should_return_the_stored_account(self):
+        self.cache.put(1, "account", self.cache.generation)
+        self.assertEqual("account", self.cache.get(1))
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_should_not_return_an_expired_account(self):
+        self.cache.put(1, "account", self.cache.generation)
+        self.clock.now = 5
+        self.assertIsNone(self.cache.get(1))
+
+    def test_should_evict_the_least_recently_used_account(self):
+        self.cache.put(1, "first", self.cache.generation)
+        self.cache.put(2, "second", self.cache.generation)
+        self.cache.get(1)
+        self.cache.put(3, "third", self.cache.generation)
+
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual("first", self.cache.get(1))
+        self.assertEqual(1, self.cache.evictions)
+
+    def test_should_drop_the_invalidated_accounts(self):
+        self.cache.put(1, "account", self.cache.generation)
+        self.cache.invalidate([1, 2])
+
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(1, self.cache.invalidations)
+
+    def test_should_not_store_an_account_read_before_its_invalidation(self):
+        generation = self.cache.generation
+        self.cache.invalidate([1])
+        self.cache.put(1, "old account", generation)
+        self.cache.put(2, "other account", generation)
+
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual("other account", self.cache.get(2))
+
+    def test_should_invalidate_the_caches_sharing_the_channel(self):
+        channel = LocalInvalidationChannel()
+        cache = AccountCache(channel=channel)
+        other = AccountCache(channel=channel)
+        other.put(1, "account", other.generation)
+
+        cache.invalidate([1])
+        self.assertIsNone(other.get(1))
+
+    def test_snapshot_should_report_the_counters(self):
+        self.cache.put(1, "account", self.cache.generation)
+        self.cache.get(1)
+
+        self.assertEqual(
+            {
+                "size": 1,
+                "max_size": 2,
+                "hits": 1,
+                "misses": 0,
+                "evictions": 0,
+                "invalidations": 0,
+                "listening": True,
+                "listener_failures": 0,
+            },
+            self.cache.snapshot(),
+        )
+
+    def test_should_not_publish_the_invalidation_published_in_the_transaction(self):
+        channel = LocalInvalidationChannel()
+        cache = AccountCache(channel=channel)
+        other = AccountCache(channel=channel)
+        other.put(1, "account", other.generation)
+
+        cache.invalidate([1], published=True)
+        self.assertEqual("account", other.get(1))
+
+    def test_should_bypass_the_cache_while_the_channel_does_not_listen(self):
+        channel = PostgresInvalidationChannel(engine=None)
+        cache = AccountCache(channel=channel)
+        cache.put(1, "account", cache.generation)
+
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(1, cache.misses)
+
+    def test_a_reset_should_drop_the_accounts_and_the_reads_before_it(self):
+        channel = LocalInvalidationChannel()
+        cache = AccountCache(channel=channel)
+        cache.put(1, "account", cache.generation)
+        generation = cache.generation
+        channel._reset()
+        cache.put(2, "read before the reset", generation)
+
+        self.assertIsNone(cache.get(1))
+        self.assertIsNone(cache.get(2))
+
+
+class TestPostgresInvalidationChannel(unittest.TestCase):
+    def test_should_split_the_ids_in_payloads_smaller_than_the_limit(self):
+        channel = PostgresInvalidationChannel(engine=None)
+        channel.max_payload = 10
+
+        self.assertEqual(
+            ["1000,1001", "1002,1003", "1004"],
+            list(channel._payloads(range(1000, 1005))),
+        )
+
+    def test_should_notify_in_the_transaction_of_the_connection(self):
+        connection = mock.Mock()
+        channel = PostgresInvalidationChannel(engine=None)
+        channel.max_payload = 10
+
+        self.assertTrue(channel.publish_in(connection, range(1000, 1003)))
+        self.assertEqual(2, connection.execute.call_count)
@@ -1,7 +1,16 @@
 import unittest
+from datetime import date, datetime
 from decimal import Decimal
 
-from banking.domain import Person, Transaction, Account
+from banking.domain import (
+    Account,
+    Interest,
+    MaintenanceFee,
+    Money,
+    Person,
+    Transaction,
+    WithdrawalCalendar,
+)
 
 
 class TestPersonDomaiin(unittest.TestCase):
@@ -120,3 +129,91 @@ class TestAccountDomain(unittest.TestCase):
             ValueError, "Could not withdraw an amout of zero from the account"
         ):
             self.account.withdraw("0")
+
+    def test_should_not_withdraw_more_than_the_daily_withdrawal_limit(self):
+        self.account.deposit("5000")
+        self.account.withdraw("600", day=date(2021, 1, 1))
+
+        with self.assertRaisesRegex(
+            ValueError,
+            "^The daily withdrawal limit of the account does not allow to "
+            "withdraw the '500' ammount$",
+        ):
+            self.account.withdraw("500", day=date(2021, 1, 1))
+
+        self.assertEqual(Decimal("4400"), self.account.balance)
+        self.assertEqual(Decimal("600"), self.account.withdrawn_today)
+
+    def test_the_daily_withdrawal_counter_should_restart_in_a_new_day(self):
+        self.account.deposit("5000")
+        self.account.withdraw("1000", day=date(2021, 1, 1))
+        self.account.withdraw("1000", day=date(2021, 1, 2))
+
+        self.assertEqual(Decimal("1000"), self.account.withdrawn_today)
+        self.assertEqual(date(2021, 1, 2), self.account.withdrawal_day)
+
+
+class TestWithdrawalCalendar(unittest.TestCase):
+    def test_the_day_should_be_the_utc_day_by_default(self):
+        calendar = WithdrawalCalendar()
+        self.assertEqual(date(2021, 1, 1), calendar.day(datetime(2021, 1, 1, 23, 59)))
+
+    def test_the_day_should_follow_the_utc_offset_and_the_rollover_hour(self):
+        calendar = WithdrawalCalendar(utc_offset=-180, rollover_hour=3)
+
+        # 05:59 UTC is 02:59 in UTC-03:00, still the previous day
+        self.assertEqual(date(2020, 12, 31), calendar.day(datetime(2021, 1, 1, 5, 59)))
+        self.assertEqual(date(2021, 1, 1), calendar.day(datetime(2021, 1, 1, 6, 0)))
+
+
+class TestPostings(unittest.TestCase):
+    def test_the_maintenance_fee_should_not_charge_more_than_the_balance(self):
+        fee = MaintenanceFee(Money(1290))
+
+        self.assertEqual(Money(1290), fee.amount(Money(10000)))
+        self.assertEqual(Money(500), fee.amount(Money(500)))
+        self.assertEqual(Money(0), fee.amount(Money(0)))
+
+    def test_the_interest_should_be_rounded_down_to_the_cent(self):
+        interest = Interest(Decimal("0.0125"))
+
+        self.assertEqual(Money(1543), interest.amount(Money(123457)))
+        self.assertEqual(Money(0), interest.amount(Money(79)))
+        self.assertEqual(Money(0), interest.amount(Money(-10000)))
+
+
+class TestMoney(unittest.TestCase):
+    def test_parse_should_read_the_amount_as_cents(self):
+        self.assertEqual(1050, Money.parse("10.5").cents)
+        self.assertEqual(-1001, Money.parse("-10.01").cents)
+        self.assertEqual(1000, Money.parse(10).cents)
+        self.assertEqual(1010, Money.parse(10.1).cents)
+        self.assertEqual(1010, Money.parse(Decimal("10.100")).cents)
+
+    def test_parse_should_not_accept_fractions_of_a_cent(self):
+        for value in ("0.001", 0.001, Decimal("0.001"), Decimal("NaN"), "1e2", "@"):
+            with self.subTest(value=value):
+                with self.assertRaisesRegex(ValueError, "is not valid$"):
+                    Money.parse(value)
+
+    def test_should_be_formatted_with_two_decimal_places(self):
+        self.assertEqual("10.50", str(Money(1050)))
+        self.assertEqual("-0.05", str(Money(-5)))
+        self.assertEqual(Decimal("10.50"), Money(1050).to_decimal())
+        self.assertEqual(10.5, float(Money(1050)))
+        self.assertEqual("90071992547409.93", Money(2 ** 53 + 1).format())
+
+    def test_should_do_exact_arithmetic(self):
+        total = Money.parse("0.1") + Money.parse("0.2") - Money.parse("0.3")
+
+        self.assertEqual(Money(0), total)
+        self.assertEqual(Money(350), 1 + Money(250))
+        self.assertEqual(Money(-150), 1 - Money(250))
+
+    def test_should_compare_with_ints_and_decimals(self):
+        self.assertEqual(Decimal("10.50"), Money(1050))
+        self.assertEqual(10, Money(1000))
+        self.assertLess(Money(1050), Decimal("10.501"))
+        self.assertGreater(Money(1), 0)
+        self.assertEqual(hash(Decimal("10.50")), hash(Money(1050)))
+        self.assertEqual(hash(10), hash(Money(1000)))
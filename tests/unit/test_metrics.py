@@ -0,0 +1,159 @@
+import unittest
+
+from banking.metrics import (
+    Histogram,
+    HistogramFamily,
+    Meter,
+    RequestTiming,
+    current_request_timing,
+    prometheus_histogram,
+    prometheus_metric,
+    record_request_phase,
+)
+
+
+class TestHistogram(unittest.TestCase):
+    def setUp(self):
+        self.histogram = Histogram(buckets=[1, 2, 4])
+
+    def test_should_count_the_values_in_cumulative_buckets(self):
+        for value in (0.5, 1, 1.5, 3, 10):
+            self.histogram.observe(value)
+
+        self.assertEqual(
+            [(1, 2), (2, 3), (4, 4), (float("inf"), 5)], self.histogram.cumulative()
+        )
+        self.assertEqual(5, self.histogram.count)
+        self.assertEqual(16, self.histogram.sum)
+
+    def test_should_interpolate_the_quantiles_inside_the_bucket(self):
+        for value in (1.5, 1.5, 3, 3):
+            self.histogram.observe(value)
+
+        self.assertEqual(1.5, self.histogram.quantile(0.25))
+        self.assertEqual(2, self.histogram.quantile(0.5))
+        self.assertEqual(4, self.histogram.quantile(1))
+
+    def test_should_estimate_the_overflow_as_the_greatest_bound(self):
+        self.histogram.observe(100)
+        self.assertEqual(4, self.histogram.quantile(0.99))
+
+    def test_the_quantiles_of_an_empty_histogram_should_be_zero(self):
+        self.assertEqual(0, self.histogram.quantile(0.5))
+
+
+class TestHistogramFamily(unittest.TestCase):
+    def test_should_keep_one_histogram_per_label(self):
+        family = HistogramFamily(buckets=[1])
+        family.labels("b").observe(0.5)
+        family.labels("a").observe(2)
+
+        self.assertIs(family.labels("a"), family.labels("a"))
+        self.assertEqual(["a", "b"], [label for label, _ in family.items()])
+        self.assertEqual(1, family.snapshot()["b"]["count"])
+
+
+class TestMeter(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.meter = Meter(window=10, clock=lambda: self.now)
+
+    def test_should_count_the_rate_since_it_was_created(self):
+        self.now = 2.0
+        self.meter.mark(10)
+
+        self.assertEqual(10, self.meter.count)
+        self.assertEqual(5.0, self.meter.rate())
+
+    def test_should_forget_the_events_out_of_the_window(self):
+        self.now = 1.0
+        self.meter.mark(100)
+        self.now = 15.0
+        self.meter.mark(20)
+
+        self.assertEqual(120, self.meter.count)
+        self.assertEqual(2.0, self.meter.rate())
+
+
+class TestRequestTiming(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.timing = RequestTiming(clock=lambda: self.now)
+
+    def test_should_split_the_handler_time_in_phases(self):
+        self.now = 0.001
+        self.timing.start_handler("GET /accounts/{id}")
+        self.now = 0.002
+        self.timing.start_endpoint()
+        self.timing.add("db_sql", 0.003)
+        self.now = 0.01
+        self.timing.finish_endpoint()
+        self.now = 0.011
+        self.timing.finish_handler()
+        self.now = 0.012
+
+        self.assertEqual(
+            {
+                "parse": 0.001,
+                "app": 0.005,
+                "db_checkout": 0,
+                "db_sql": 0.003,
+                "serialize": 0.001,
+            },
+            {phase: round(value, 6) for phase, value in self.timing.phases.items()},
+        )
+        self.assertEqual(
+            "parse;dur=1.000, app;dur=5.000, db_checkout;dur=0.000, "
+            "db_sql;dur=3.000, serialize;dur=1.000, total;dur=12.000",
+            self.timing.server_timing(),
+        )
+
+    def test_should_record_the_phases_of_the_current_request_only(self):
+        record_request_phase("db_sql", 1.0)
+        token = current_request_timing.set(self.timing)
+
+        try:
+            record_request_phase("db_sql", 2.0)
+        finally:
+            current_request_timing.reset(token)
+
+        self.assertEqual(2.0, self.timing.phases["db_sql"])
+
+
+class TestPrometheus(unittest.TestCase):
+    def test_should_render_the_cumulative_buckets_of_the_histograms(self):
+        histogram = Histogram(buckets=[0.5, 1])
+
+        for value in (0.25, 0.75, 2):
+            histogram.observe(value)
+
+        self.assertEqual(
+            [
+                "# HELP latency_seconds The latency.",
+                "# TYPE latency_seconds histogram",
+                'latency_seconds_bucket{route="/a",le="0.5"} 1',
+                'latency_seconds_bucket{route="/a",le="1"} 2',
+                'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+                'latency_seconds_sum{route="/a"} 3.0',
+                'latency_seconds_count{route="/a"} 3',
+            ],
+            prometheus_histogram(
+                "latency_seconds", "The latency.", [({"route": "/a"}, histogram)]
+            ),
+        )
+
+    def test_should_escape_the_label_values(self):
+        self.assertEqual(
+            [
+                "# HELP requests_total The requests.",
+                "# TYPE requests_total counter",
+                'requests_total{path="a\\"b\\\\c\\n"} 2',
+                "requests_total 3",
+            ],
+            prometheus_metric(
+                "requests_total",
+                "The requests.",
+                "counter",
+                [({"path": 'a"b\\c\n'}, 2), ({}, 3)],
+            ),
+        )
@@ -0,0 +1,223 @@
+import asyncio
+import unittest
+from datetime import date, datetime, timedelta
+
+from banking import exceptions
+from banking.domain import DailyBalance, Money
+from banking.metrics import HistogramFamily
+from banking.services import (
+    Command,
+    CommandBus,
+    RetryMiddleware,
+    RetryPolicy,
+    TimingMiddleware,
+    retryable,
+    summarize_transactions,
+)
+
+
+class FlakyCommand:
+    """Fails with a concurrent modification a few times before succeed"""
+
+    def __init__(self, failures, retry_policy=None):
+        self.failures = failures
+        self.calls = 0
+        self.retry_policy = retry_policy
+
+    @retryable
+    def __call__(self):
+        self.calls += 1
+
+        if self.calls <= self.failures:
+            raise exceptions.ConcurrentModification("Stale account")
+
+        return self.calls
+
+
+class AsyncFlakyCommand(FlakyCommand):
+    @retryable
+    async def __call__(self):
+        self.calls += 1
+
+        if self.calls <= self.failures:
+            raise exceptions.ConcurrentModification("Stale account")
+
+        return self.calls
+
+
+class BusFlakyCommand(Command):
+    """Fails as many times as the `failures` left in the unit of work"""
+
+    @retryable
+    def __call__(self, value):
+        self.UnitOfWork["calls"] += 1
+
+        if self.UnitOfWork["calls"] <= self.UnitOfWork["failures"]:
+            raise exceptions.ConcurrentModification("Stale account")
+
+        return value
+
+
+class AsyncBusFlakyCommand(BusFlakyCommand):
+    @retryable
+    async def __call__(self, value):
+        self.UnitOfWork["calls"] += 1
+
+        if self.UnitOfWork["calls"] <= self.UnitOfWork["failures"]:
+            raise exceptions.ConcurrentModification("Stale account")
+
+        return value
+
+
+class BusReadCommand(Command):
+    def __call__(self):
+        self.UnitOfWork["calls"] += 1
+        raise exceptions.ConcurrentModification("Stale account")
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(attempts=3, delay=0, max_delay=0)
+
+    def test_should_retry_the_command_until_it_succeeds(self):
+        command = FlakyCommand(failures=2, retry_policy=self.policy)
+        self.assertEqual(3, command())
+
+    def test_should_raise_the_exception_when_the_attempts_are_exhausted(self):
+        command = FlakyCommand(failures=3, retry_policy=self.policy)
+
+        with self.assertRaises(exceptions.ConcurrentModification):
+            command()
+
+        self.assertEqual(3, command.calls)
+
+    def test_should_not_retry_when_the_command_has_no_policy(self):
+        command = FlakyCommand(failures=1)
+
+        with self.assertRaises(exceptions.ConcurrentModification):
+            command()
+
+        self.assertEqual(1, command.calls)
+
+    def test_should_not_retry_other_exceptions(self):
+        calls = []
+
+        def command():
+            calls.append(1)
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            self.policy(command)
+
+        self.assertEqual(1, len(calls))
+
+    def test_should_retry_async_commands(self):
+        command = AsyncFlakyCommand(failures=2, retry_policy=self.policy)
+        self.assertEqual(3, asyncio.run(command()))
+
+    def test_the_delays_should_be_bounded_by_the_max_delay(self):
+        policy = RetryPolicy(attempts=10, delay=0.01, max_delay=0.05)
+        delays = list(policy.delays())
+        self.assertEqual(9, len(delays))
+        self.assertTrue(all(0 <= delay <= 0.05 for delay in delays))
+
+
+class TestSummarizeTransactions(unittest.TestCase):
+    def setUp(self):
+        def row(created_at, withdraw, cents):
+            epoch = (created_at - datetime(1970, 1, 1)) // timedelta(microseconds=1)
+            return (epoch, withdraw, cents)
+
+        # The rows are not ordered by the database
+        self.rows = [
+            row(datetime(2021, 1, 3, 23), 1, 4000),
+            row(datetime(2021, 1, 1, 10), 0, 10000),
+            row(datetime(2021, 1, 3, 9), 0, 501),
+            row(datetime(2021, 1, 1, 18), 1, 2550),
+            row(datetime(2021, 1, 3, 23), 1, 1000),
+        ]
+
+    def test_should_sum_up_the_transactions_by_type(self):
+        summary = summarize_transactions(self.rows, Money(100))
+
+        self.assertEqual(2, summary.deposits.count)
+        self.assertEqual(Money(10501), summary.deposits.total)
+        self.assertEqual(Money(501), summary.deposits.min)
+        self.assertEqual(Money(10000), summary.deposits.max)
+        self.assertEqual(Money(5250), summary.deposits.mean)
+        self.assertEqual(3, summary.withdraws.count)
+        self.assertEqual(Money(7550), summary.withdraws.total)
+        self.assertEqual(Money(2517), summary.withdraws.mean)
+
+    def test_should_compute_the_net_flow_and_balance_of_each_day(self):
+        summary = summarize_transactions(self.rows, Money(100))
+
+        self.assertEqual(
+            [
+                DailyBalance(date(2021, 1, 1), Money(7450), Money(7550)),
+                DailyBalance(date(2021, 1, 3), Money(-4499), Money(3051)),
+            ],
+            summary.days,
+        )
+        self.assertEqual(Money(2951), summary.net_flow)
+        self.assertEqual(Money(100), summary.opening_balance)
+        self.assertEqual(Money(3051), summary.closing_balance)
+
+    def test_should_sum_up_an_empty_period(self):
+        summary = summarize_transactions([], Money(100))
+
+        self.assertEqual(0, summary.deposits.count)
+        self.assertIsNone(summary.withdraws.mean)
+        self.assertEqual([], summary.days)
+        self.assertEqual(Money(100), summary.closing_balance)
+
+
+class TestCommandBus(unittest.TestCase):
+    def setUp(self):
+        self.histograms = HistogramFamily()
+        self.bus = CommandBus(
+            [BusFlakyCommand, AsyncBusFlakyCommand, BusReadCommand],
+            middlewares=[
+                TimingMiddleware(self.histograms),
+                RetryMiddleware(RetryPolicy(attempts=3, delay=0, max_delay=0)),
+            ],
+        )
+
+    def test_should_dispatch_the_command_with_the_arguments(self):
+        uow = {"calls": 0, "failures": 0}
+        self.assertEqual(10, self.bus.dispatch(BusFlakyCommand, uow, 10))
+        self.assertEqual(1, uow["calls"])
+
+    def test_should_retry_the_retryable_commands(self):
+        uow = {"calls": 0, "failures": 2}
+        self.assertEqual(10, self.bus.dispatch(BusFlakyCommand, uow, 10))
+        self.assertEqual(3, uow["calls"])
+
+    def test_should_retry_the_retryable_async_commands(self):
+        uow = {"calls": 0, "failures": 2}
+        result = asyncio.run(self.bus.dispatch(AsyncBusFlakyCommand, uow, 10))
+        self.assertEqual(10, result)
+        self.assertEqual(3, uow["calls"])
+
+    def test_should_not_retry_the_other_commands(self):
+        uow = {"calls": 0}
+
+        with self.assertRaises(exceptions.ConcurrentModification):
+            self.bus.dispatch(BusReadCommand, uow)
+
+        self.assertEqual(1, uow["calls"])
+
+    def test_should_time_the_commands_failed_ones_included(self):
+        self.bus.dispatch(BusFlakyCommand, {"calls": 0, "failures": 0}, 1)
+
+        with self.assertRaises(exceptions.ConcurrentModification):
+            self.bus.dispatch(BusReadCommand, {"calls": 0})
+
+        snapshot = self.histograms.snapshot()
+        self.assertEqual(1, snapshot["BusFlakyCommand"]["count"])
+        self.assertEqual(1, snapshot["BusReadCommand"]["count"])
+        self.assertEqual(0, snapshot["AsyncBusFlakyCommand"]["count"])
+
+    def test_should_raise_lookup_error_for_unregistered_commands(self):
+        with self.assertRaises(LookupError):
+            self.bus.dispatch(Command, {})